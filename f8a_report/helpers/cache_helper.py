@@ -0,0 +1,77 @@
+"""Storage shared by the caches kept across the cron job runs."""
+
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__file__)
+
+# Directory kept across the cron job runs, the template mounts a persistent volume on it.
+F8A_CACHE_DIR = os.getenv('F8A_CACHE_DIR', '/tmp')
+
+
+def cache_path(name):
+    """Return the path of the named cache in F8A_CACHE_DIR."""
+    return os.path.join(F8A_CACHE_DIR, name)
+
+
+class SQLiteCache:
+    """Base of the caches stored in a SQLite database, opened on first use.
+
+    A cache is an optimisation only, so a database that cannot be opened or queried is
+    logged and then behaves as an empty cache. Subclasses set the description and the
+    schema, and call the query methods while holding self._lock.
+    """
+
+    description = 'cache'
+    schema = None
+    counters = ('hits', 'misses')
+
+    def __init__(self, path):
+        """Set up the cache, the database is opened by the first query."""
+        self.path = path
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(self.counters, 0)
+        self._conn = None
+        self._opened = False
+
+    def _open(self):
+        """Return the database connection, None when the database is not usable."""
+        if not self._opened:
+            self._opened = True
+            try:
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+                conn.execute(self.schema)
+                conn.commit()
+                self._conn = conn
+            except sqlite3.Error as e:
+                logger.warning('Unable to open %s %s: %r', self.description, self.path, e)
+        return self._conn
+
+    def _fetchone(self, query, params=()):
+        """Return the first row of the query, None when there is none or on errors."""
+        conn = self._open()
+        if conn is None:
+            return None
+        try:
+            return conn.execute(query, params).fetchone()
+        except sqlite3.Error as e:
+            logger.warning('Unable to read %s: %r', self.description, e)
+            return None
+
+    def _write(self, query, params_seq):
+        """Run the statement with each of the parameters and commit them."""
+        conn = self._open()
+        if conn is None:
+            return
+        try:
+            conn.executemany(query, params_seq)
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.warning('Unable to update %s: %r', self.description, e)
+
+    def stats(self):
+        """Return the counters of the cache."""
+        with self._lock:
+            return dict(self._stats)
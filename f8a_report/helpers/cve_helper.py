@@ -1,14 +1,25 @@
 """CVE Module to generate CVE Report."""
+import hashlib
+import json
 import requests
+import threading
 import time
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 from datetime import timedelta
-from f8a_report.helpers.graph_report_generator import get_session_retry, GREMLIN_SERVER_URL_REST
+from f8a_report.helpers.cache_helper import cache_path
+from f8a_report.helpers.graph_report_generator import batch_query_executor
 
 logger = logging.getLogger(__file__)
 
+# Github search responses are cached on disk by query, and revalidated with their ETag.
+# The cache is kept in F8A_CACHE_DIR, on the persistent volume of the cron job, and only
+# the GITHUB_CACHE_MAX_ENTRIES most recently used responses are kept.
+GITHUB_CACHE_DIR = os.getenv('GITHUB_CACHE_DIR', cache_path('github_cache'))
+GITHUB_CACHE_MAX_ENTRIES = int(os.getenv('GITHUB_CACHE_MAX_ENTRIES', 500))
+
 
 class CVE(object):
     """CVE class helper to validate and generate CVE report."""
@@ -21,6 +32,10 @@ class CVE(object):
         )
         self.github_rate_limits = 100
         self.github_rate_limit_reset = -1
+        # The rate limit budget is shared by the concurrent search calls
+        self._rate_limit_lock = threading.Lock()
+        self.session = requests.Session()
+        self.cache_dir = GITHUB_CACHE_DIR
 
     def get_cveids_from_cvedb_prs(self, updated_on):
         """Get all the merged CVEDB Pull Requests."""
@@ -48,32 +63,23 @@ class CVE(object):
             raise ValueError('%r' % e)
 
     def validate_cveids_in_graph(self, cve_ids):
-        """Identify CVEs ingested to graph or missed being ingested."""
-        ingested = []
-        missed = []
-        assert isinstance(cve_ids, list)
-        # Check whether CVE node is present in graph or not
-        try:
-            for cve_id in cve_ids:
-                gremlin_query = "g.V().has('cve_id', '{}').valueMap();".format(cve_id)
-                payload = {'gremlin': gremlin_query}
-                try:
-                    resp = get_session_retry().post(url=GREMLIN_SERVER_URL_REST, json=payload)
-                    if resp.status_code == 200:
-                        graph_resp = resp.json()
-                        if graph_resp.get('result', {}).get('data', []):
-                            ingested.append(cve_id)
-                        else:
-                            missed.append(cve_id)
-                    else:
-                        msg = "Error - CVEGraphValidation failed for CVE: {} with error: {}".format(
-                                cve_id, resp.status_code)
-                        logger.error(msg)
-                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
-                        requests.exceptions.RequestException) as e:
-                    logger.error('Error Connecting to Graph Instance : %r' % e)
-                    continue
+        """Identify CVEs ingested to graph or missed being ingested.
 
+        The ids are checked in batches, a traversal returning the ids found in the graph.
+        CVEs which could not be checked are neither ingested nor missed.
+        """
+        try:
+            assert isinstance(cve_ids, list)
+            failed = []
+            found = set(batch_query_executor(
+                "g.V().has('cve_id', within(cve_ids)).values('cve_id').dedup()",
+                list(dict.fromkeys(cve_ids)), lambda batch: {'cve_ids': batch},
+                failed=failed))
+            if failed:
+                logger.error("Error - CVEGraphValidation failed for CVEs: {}".format(failed))
+            ingested = [cve_id for cve_id in cve_ids if cve_id in found]
+            missed = [cve_id for cve_id in cve_ids
+                      if cve_id not in found and cve_id not in failed]
             return ingested, missed
 
         except (ValueError, AssertionError) as e:
@@ -90,21 +96,94 @@ class CVE(object):
         except (ValueError, TypeError) as e:
             raise ValueError('%r' % e)
 
+    def _cache_path(self, url):
+        """Return the cache file of the url."""
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def _read_cache(self, url):
+        """Return the cached response of the url, None when it is not cached."""
+        try:
+            path = self._cache_path(url)
+            with open(path) as f:
+                cached = json.load(f)
+            # Mark it as recently used, the least recently used entries are evicted first
+            os.utime(path)
+            return cached
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, url, etag, body):
+        """Cache the response of the url."""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._cache_path(url)
+            tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+            with open(tmp_path, 'w') as f:
+                json.dump({'url': url, 'etag': etag, 'body': body}, f)
+            os.replace(tmp_path, path)
+            self._evict_cache()
+        except OSError as e:
+            logger.warning('Unable to cache the Github response for %s: %r', url, e)
+
+    def _evict_cache(self):
+        """Remove the least recently used responses above GITHUB_CACHE_MAX_ENTRIES."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            try:
+                if not entry.name.endswith('.tmp'):
+                    entries.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                continue
+        entries.sort()
+        for _, path in entries[:max(len(entries) - GITHUB_CACHE_MAX_ENTRIES, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
     def call_github_api(self, query):
-        """Return the json output from Github APIs."""
+        """Return the json output from Github APIs.
+
+        Cached responses are revalidated with their ETag, and returned without any
+        request when the rate limit is exceeded.
+        """
+        url = self.github_url + query
+        cached = self._read_cache(url)
         # Check if we are above github rate limits
-        # If yes, wait till the limit is reset
-        if self.github_rate_limits <= 1 and self.github_rate_limit_reset > 0:
-            wait_time = self.github_rate_limit_reset - int(dt.now().timestamp())
+        # If yes, wait till the limit is reset, without holding the lock meanwhile
+        while True:
+            with self._rate_limit_lock:
+                if self.github_rate_limits > 1 or self.github_rate_limit_reset <= 0:
+                    # Take this call from the budget, the response headers then tell the
+                    # actual one
+                    self.github_rate_limits -= 1
+                    break
+                if cached is not None:
+                    logger.info("Github Rate Limits Exceeded. Using the cached response for "
+                                "query: {}".format(query))
+                    return cached['body'] or None
+                wait_time = self.github_rate_limit_reset - int(dt.now().timestamp())
+                if wait_time <= 0:
+                    self.github_rate_limit_reset = -1
+                    continue
             logger.info("Github Rate Limits Exceeded. Waiting for {} seconds".format(wait_time))
             time.sleep(wait_time)
-        try:
-            resp = requests.get(url=self.github_url + query,
-                                headers={"Accept": "application/vnd.github.symmetra-preview+json"})
-            self.github_rate_limits = int(resp.headers.get('X-RateLimit-Remaining', 0))
-            self.github_rate_limit_reset = int(resp.headers.get('X-RateLimit-Reset', -1))
 
-            return resp.json() or None
+        headers = {"Accept": "application/vnd.github.symmetra-preview+json"}
+        if cached is not None and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        try:
+            resp = self.session.get(url=url, headers=headers)
+            with self._rate_limit_lock:
+                self.github_rate_limits = int(resp.headers.get('X-RateLimit-Remaining', 0))
+                self.github_rate_limit_reset = int(resp.headers.get('X-RateLimit-Reset', -1))
+
+            if resp.status_code == 304 and cached is not None:
+                return cached['body'] or None
+            body = resp.json()
+            if resp.status_code == 200:
+                self._write_cache(url, resp.headers.get('ETag'), body)
+            return body or None
 
         except (ValueError, requests.exceptions.ConnectionError,
                 requests.exceptions.Timeout, requests.exceptions.RequestException) as e:
@@ -116,34 +195,43 @@ class CVE(object):
         cve_stats = {"github_stats": {"open_count": {}}}
         end_date = (dt.strptime(updated_on, "%Y-%m-%d") - timedelta(days=1)).strftime(
                     "%Y-%m-%d")
-        # Create a query to fetch PRs not acted for more than xx days
-        for day in [2, 7, 30, 365]:
-            open_key = str(day) + " days"
+
+        def get_open_count(day):
+            # Create a query to fetch PRs not acted for more than xx days
             start_date = (dt.strptime(updated_on, "%Y-%m-%d") - timedelta(days=day)).strftime(
                 "%Y-%m-%d")
             query = '+type:pr+is:open+created:{}..{}'.format(start_date, end_date)
             try:
-                cve_json = self.call_github_api(query=query)
+                return self.call_github_api(query=query)
+            except (ValueError, TypeError) as e:
+                logger.error('%r' % e)
+                return None
+
+        days = [2, 7, 30, 365]
+        with ThreadPoolExecutor(max_workers=len(days)) as executor:
+            for day, cve_json in zip(days, executor.map(get_open_count, days)):
                 if cve_json and isinstance(cve_json, dict):
+                    open_key = str(day) + " days"
                     cve_stats['github_stats']['open_count'][open_key] = \
                         cve_json.get('total_count', -1)
-            except (ValueError, TypeError) as e:
-                logger.error('%r' % e)
-                continue
         return cve_stats
 
     def generate_cve_report(self, updated_on):
         """Generate CVE statistics and CVE ingestion report."""
         try:
             assert dt.strptime(updated_on, "%Y-%m-%d")
-            # Add Open Count of CVEs for the last 2 days, week, month and year
-            cve_report = self.get_open_cves_count(updated_on)
-
-            # Add false positives PRs from yesterday
-            cve_report['github_stats']['false_positives'] = self.get_fp_cves_count(updated_on)
-
-            # Create CVE Ingestion Report
-            cves_from_github = self.get_cveids_from_cvedb_prs(updated_on)
+            # The Github searches are independent, run them concurrently
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                # Add Open Count of CVEs for the last 2 days, week, month and year
+                open_count = executor.submit(self.get_open_cves_count, updated_on)
+                # Add false positives PRs from yesterday
+                fp_count = executor.submit(self.get_fp_cves_count, updated_on)
+                merged_prs = executor.submit(self.get_cveids_from_cvedb_prs, updated_on)
+                cve_report = open_count.result()
+                cve_report['github_stats']['false_positives'] = fp_count.result()
+
+                # Create CVE Ingestion Report
+                cves_from_github = merged_prs.result()
             ingested_cves, missed_cves = self.validate_cveids_in_graph(cves_from_github)
             cve_report['ingestion'] = {'ingested': ingested_cves, 'missed': missed_cves}
 
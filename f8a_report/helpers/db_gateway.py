@@ -18,14 +18,27 @@
 
 from f8a_report.helpers.report_helper import Postgres
 from psycopg2 import sql
+from psycopg2.errors import UndefinedTable
+from psycopg2.extras import execute_values
 import logging
 import json
+import os
+from uuid import uuid4
+from datetime import date
 from datetime import datetime as dt
 from f8a_utils.user_token_utils import UserStatus
 
 logger = logging.getLogger(__file__)
 logging.basicConfig(level=logging.INFO)
 
+# Number of rows fetched per round trip by the server-side cursor while streaming
+# worker results, this bounds memory usage by batch size instead of date range.
+WORKER_RESULTS_ITERSIZE = int(os.getenv('WORKER_RESULTS_ITERSIZE', 1000))
+
+# Maximum number of stack ids rendered into a single IN (...) clause when worker
+# results are retrieved by id list instead of the date range join.
+STACK_IDS_CHUNK_SIZE = int(os.getenv('STACK_IDS_CHUNK_SIZE', 5000))
+
 
 def validate_and_process_date(date):
     """Validate the date format and apply the format YYYY-MM-DDTHH:MI:SSZ."""
@@ -46,6 +59,15 @@ class ReportQueries(Postgres):
         sql.Identifier('task_result')
     )
 
+    worker_results_by_date = sql.SQL('SELECT WR.{} FROM {} WR JOIN {} SAR ON WR.{} = SAR.{} '
+                                     'WHERE SAR.{} BETWEEN \'%s\' AND \'%s\' AND WR.{} = \'%s\' '
+                                     'AND WR.{}->\'_audit\'->>\'version\' = \'%s\'').format(
+        sql.Identifier('task_result'), sql.Identifier('worker_results'),
+        sql.Identifier('stack_analyses_request'), sql.Identifier('external_request_id'),
+        sql.Identifier('id'), sql.Identifier('submitTime'), sql.Identifier('worker'),
+        sql.Identifier('task_result')
+    )
+
     get_stack_ids = sql.SQL('SELECT {} FROM {} WHERE {} BETWEEN \'%s\' AND \'%s\'').format(
         sql.Identifier('id'),
         sql.Identifier('stack_analyses_request'),
@@ -81,6 +103,72 @@ class ReportQueries(Postgres):
 
         return data
 
+    def stream_worker_results_v2(self, worker, stack_ids, itersize=WORKER_RESULTS_ITERSIZE):
+        """Stream results for selected worker from RDB using a server-side cursor.
+
+        Unlike get_worker_results_v2, rows are yielded one at a time as they arrive in
+        batches of itersize, so the full result set is never held in memory.
+
+        :param worker: Name of the worker whose results are to be fetched.
+        :param stack_ids: Stack analyses request ids.
+        :param itersize: Number of rows fetched from the server per round trip.
+        :return: Generator of rows, each row being a tuple holding the task_result dict.
+        """
+        row_count = 0
+        # Ids are sent in bounded chunks to keep the SQL text and plan size small.
+        for index in range(0, len(stack_ids), STACK_IDS_CHUNK_SIZE):
+            id_list = list(map(sql.Literal, stack_ids[index:index + STACK_IDS_CHUNK_SIZE]))
+            ids = sql.SQL(', ').join(id_list).as_string(self.conn)
+            query = self.worker_results.as_string(self.conn) % (ids, worker, 'v2')
+
+            for row in self._stream_query(query, itersize):
+                row_count += 1
+                yield row
+
+        if not row_count:
+            raise Exception(f'No Data has been found for v2 stack analyses for worker {worker} ')
+
+        logger.info(f'Successfully streamed {row_count} results for {worker}.')
+
+    def stream_worker_results_v2_by_date(self, worker, start_date, end_date,
+                                         itersize=WORKER_RESULTS_ITERSIZE):
+        """Stream results for selected worker for stacks requested within a date range.
+
+        Stack analyses requests are joined with worker results on the server side,
+        so the request ids never have to be pulled into the client and sent back.
+
+        :param worker: Name of the worker whose results are to be fetched.
+        :param start_date: Date from where to start collecting stacks.
+        :param end_date: Date upto which to collect stacks.
+        :param itersize: Number of rows fetched from the server per round trip.
+        :return: Generator of rows, each row being a tuple holding the task_result dict.
+        """
+        try:
+            start_date = validate_and_process_date(start_date)
+            end_date = validate_and_process_date(end_date)
+        except ValueError:
+            raise ValueError("Invalid date format")
+
+        query = self.worker_results_by_date.as_string(self.conn) % (
+            start_date, end_date, worker, 'v2')
+        row_count = 0
+        for row in self._stream_query(query, itersize):
+            row_count += 1
+            yield row
+
+        logger.info(f'Successfully streamed {row_count} results for {worker}.')
+
+    def _stream_query(self, query, itersize):
+        """Execute query on a named (server-side) cursor and yield its rows."""
+        cursor = self.conn.cursor(name=f'stream_{uuid4().hex}')
+        cursor.itersize = itersize
+        try:
+            cursor.execute(query)
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
     def retrieve_stack_analyses_ids(self, start_date, end_date) -> list:
         """Retrieve results for stack analyses requests."""
         try:
@@ -115,36 +203,73 @@ class TokenValidationQueries(Postgres):
         """Class Constructor."""
         super().__init__()
 
-    def get_registered_user_tokens(self) -> dict:
-        """Tokens for registered users."""
+    def get_registered_user_tokens(self, window_days: int = 1) -> dict:
+        """Tokens for registered users.
+
+        With a window of more than one day, only the tokens of the users whose hash
+        bucket of user_id falls on today are returned, along with the ones that were
+        not validated within the window, so every token is checked once per window.
+        """
+        if window_days > 1:
+            # 28 bits of the md5 of user_id give a deterministic non negative bucket
+            get_registered_user_sql = """
+                select u.user_id, u.snyk_api_token from user_details u
+                left join snyk_token_validation v on v.user_id = u.user_id::text
+                where u.status = %s and (
+                    v.last_validated is null
+                    or v.last_validated < NOW() - make_interval(days => %s)
+                    or ('x' || substr(md5(u.user_id::text), 1, 7))::bit(28)::int %% %s = %s)
+            """
+            try:
+                self.cursor.execute(get_registered_user_sql,
+                                    (UserStatus.REGISTERED.name, window_days, window_days,
+                                     date.today().toordinal() % window_days))
+                return {row[0]: row[1] for row in self.cursor.fetchall()}
+            except UndefinedTable:
+                # The table comes with the migrations/ of the database, until it is
+                # applied every token is validated on each run
+                logger.warning("Table snyk_token_validation not found, validating all tokens")
+                self.conn.rollback()
+
+        get_registered_user_sql = \
+            sql.SQL("select user_id, snyk_api_token from user_details where status=\'%s\'")
+        self.cursor.execute(get_registered_user_sql.as_string(self.conn)
+                            % UserStatus.REGISTERED.name)
+        result = self.cursor.fetchall()
+        user_id_token_dict = {row[0]: row[1] for row in result}
+        return user_id_token_dict
+
+    def update_tokens_validated(self, validated_users: list):
+        """Record that the tokens of the users were validated now."""
+        if len(validated_users) == 0:
+            return
         try:
-            get_registered_user_sql = \
-                sql.SQL("select user_id, snyk_api_token from user_details where status=\'%s\'")
-            self.cursor.execute(get_registered_user_sql.as_string(self.conn)
-                                % UserStatus.REGISTERED.name)
-            result = self.cursor.fetchall()
-            user_id_token_dict = {row[0]: row[1] for row in result}
-            return user_id_token_dict
-        finally:
-            self.conn.close()
+            execute_values(self.cursor,
+                           "insert into snyk_token_validation (user_id, last_validated) "
+                           "values %s on conflict (user_id) do update set last_validated = NOW()",
+                           [(str(user_id),) for user_id in validated_users],
+                           template="(%s, NOW())")
+        except UndefinedTable:
+            logger.warning("Table snyk_token_validation not found, validations not recorded")
+            self.conn.rollback()
+            return
+        logger.info("Recorded the token validation of %d users" % len(validated_users))
+        self.conn.commit()
 
     def update_users_to_unregistered(self, unregistered_users: list):
         """Update status of unregistered users."""
         if len(unregistered_users) == 0:
             logger.info("No users to be moved to expired status")
             return
-        try:
-            unregistered_user_sql = \
-                sql.SQL("update user_details set status=\'%s\', updated_date= NOW() "
-                        "where user_id in (%s)")
-            id_list = list(map(sql.Literal, unregistered_users))
-            ids = sql.SQL(', ').join(id_list).as_string(self.conn)
+        unregistered_user_sql = \
+            sql.SQL("update user_details set status=\'%s\', updated_date= NOW() "
+                    "where user_id in (%s)")
+        id_list = list(map(sql.Literal, unregistered_users))
+        ids = sql.SQL(', ').join(id_list).as_string(self.conn)
 
-            self.cursor.execute(unregistered_user_sql.as_string(self.conn) %
-                                (UserStatus.EXPIRED.name, ids))
+        self.cursor.execute(unregistered_user_sql.as_string(self.conn) %
+                            (UserStatus.EXPIRED.name, ids))
 
-            logger.info("Updated %d users to expired status" % len(unregistered_users))
+        logger.info("Updated %d users to expired status" % len(unregistered_users))
 
-            self.conn.commit()
-        finally:
-            self.conn.close()
+        self.conn.commit()
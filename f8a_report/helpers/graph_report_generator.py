@@ -1,13 +1,18 @@
 """Helper functions related to to generate ingestion reports."""
 
-from f8a_utils.versions import get_latest_versions_for_ep
 import logging
 import os
 import requests
+import threading
+import time
 import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import ReadTimeoutError
 from requests.packages.urllib3.util.retry import Retry
 from datetime import timedelta
+from f8a_report.helpers.latest_version_cache import latest_version_cache
 
 _logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -16,7 +21,18 @@ GREMLIN_SERVER_URL_REST = "http://{host}:{port}".format(
     host=os.environ.get("BAYESIAN_GREMLIN_HTTP_SERVICE_HOST", "localhost"),
     port=os.environ.get("BAYESIAN_GREMLIN_HTTP_SERVICE_PORT", "8182"))
 
-GREMLIN_QUERY_SIZE = int(os.getenv('GREMLIN_QUERY_SIZE', 25))
+# Initial batch size, batches then grow up to GREMLIN_MAX_QUERY_SIZE while calls
+# finish within GREMLIN_TARGET_LATENCY seconds and shrink on slow or failed calls.
+GREMLIN_QUERY_SIZE = int(os.getenv('GREMLIN_QUERY_SIZE', 100))
+GREMLIN_MAX_QUERY_SIZE = int(os.getenv('GREMLIN_MAX_QUERY_SIZE', 1000))
+GREMLIN_TARGET_LATENCY = float(os.getenv('GREMLIN_TARGET_LATENCY', 5))
+GREMLIN_QUERY_RETRIES = int(os.getenv('GREMLIN_QUERY_RETRIES', 2))
+# Failed calls allowed per batched query, once spent the values left are given up.
+GREMLIN_FAILURE_BUDGET = int(os.getenv('GREMLIN_FAILURE_BUDGET', 10))
+GREMLIN_QUERY_WORKERS = int(os.getenv('GREMLIN_QUERY_WORKERS', 4))
+GREMLIN_POOL_SIZE = int(os.getenv('GREMLIN_POOL_SIZE', GREMLIN_QUERY_WORKERS))
+GREMLIN_CONNECT_TIMEOUT = float(os.getenv('GREMLIN_CONNECT_TIMEOUT', 10))
+GREMLIN_READ_TIMEOUT = float(os.getenv('GREMLIN_READ_TIMEOUT', 300))
 
 _SERVICE_HOST = os.environ.get("BAYESIAN_DATA_IMPORTER_SERVICE_HOST", "bayesian-data-importer")
 _SERVICE_PORT = os.environ.get("BAYESIAN_DATA_IMPORTER_SERVICE_PORT", "9192")
@@ -61,65 +77,81 @@ def generate_report_for_cves(cve_data):
     :param cve_data: list, list of CVEs
     :return json, list of cve information
     """
-    query_str = "g.V().has('cecosystem', '{arg0}')." \
-                "has('cve_id', '{arg1}').as('a').in('has_cve').as('b')." \
-                "select('a','b').by(valueMap('cve_id', 'pname', 'version'))." \
-                "dedup().fill(epv);"
+    query_str = "g.V().has('cecosystem', eco).has('cve_id', within(cve_ids)).as('a')" \
+                ".in('has_cve').as('b').select('a','b')" \
+                ".by(valueMap('cve_id', 'pname', 'version')).dedup()"
     report_result = {}
-    args = []
+    cve_ids = {}
     for k, v in cve_data.items():
         eco = v['ecosystem']
-        args.append({
-            "0": eco,
-            "1": k
-        })
+        cve_ids.setdefault(eco, []).append(k)
         for pkg in v['packages']:
             name = pkg['name']
             for ver in pkg['versions']:
                 key = k + "@DELIM@" + name + "@DELIM@" + ver
                 report_result[key] = "Not Found"
-    result_data = batch_query_executor(query_str, args)
-    if result_data is not None:
-        for res in result_data:
-            id = get_value(res['a'], 'cve_id') if 'a' in res else ""
-            pkg = get_value(res['b'], 'pname') if 'b' in res else ""
-            ver = get_value(res['b'], 'version') if 'b' in res else ""
-            key = id + "@DELIM@" + pkg + "@DELIM@" + ver
-            if key in report_result:
-                report_result[key] = "Found"
-            else:
-                report_result[key] = "False Positive"
+
+    result_data = []
+    for eco, ids in cve_ids.items():
+        result_data += batch_query_executor(
+            query_str, ids, lambda batch, eco=eco: {'eco': eco, 'cve_ids': batch})
+    for res in result_data:
+        id = get_value(res['a'], 'cve_id') if 'a' in res else ""
+        pkg = get_value(res['b'], 'pname') if 'b' in res else ""
+        ver = get_value(res['b'], 'version') if 'b' in res else ""
+        key = id + "@DELIM@" + pkg + "@DELIM@" + ver
+        if key in report_result:
+            report_result[key] = "Found"
+        else:
+            report_result[key] = "False Positive"
     return report_result
 
 
+def find_epvs_in_graph(ecosystem, pvlist):
+    """Look up the given package versions of an ecosystem in graph.
+
+    Names and versions are matched with within(), so vertices for package version
+    combinations that were not asked for are dropped from the result.
+
+    :param ecosystem: str, ecosystem of the packages
+    :param pvlist: list, list of (package, version) tuples
+    :return set, (package, version) tuples present in graph
+    """
+    query_str = "g.V().has('pecosystem', eco).has('pname', within(names))" \
+                ".has('version', within(versions))" \
+                ".valueMap('pecosystem', 'pname', 'version').dedup()"
+
+    def build_bindings(batch):
+        return {'eco': ecosystem,
+                'names': list(dict.fromkeys(pkg for pkg, _ in batch)),
+                'versions': list(dict.fromkeys(ver for _, ver in batch))}
+
+    requested = set(pvlist)
+    found = set()
+    for res in batch_query_executor(query_str, list(dict.fromkeys(pvlist)), build_bindings):
+        pv = (get_value(res, 'pname'), get_value(res, 'version'))
+        if pv in requested:
+            found.add(pv)
+    return found
+
+
 def generate_report_for_unknown_epvs(epv_list):
     """Generate a report for the unknown EPVs.
 
     :param epv_list: list, list of EPVs
     :return json, list of epv information
     """
-    query_str = "g.V().has('pecosystem', '{arg0}')." \
-                "has('pname', '{arg1}').has('version', '{arg2}')" \
-                ".valueMap().dedup().fill(epv);"
     report_result = {}
-    args = []
+    pvs = {}
     for epv in epv_list:
         eco = epv['ecosystem']
         pkg = epv['name']
         ver = epv['version']
-        args.append({
-            "0": eco,
-            "1": pkg,
-            "2": ver
-        })
+        pvs.setdefault(eco, []).append((pkg, ver))
         report_result[eco + "@DELIM@" + pkg + "@DELIM@" + ver] = "false"
 
-    result_data = batch_query_executor(query_str, args)
-    if result_data is not None:
-        for res in result_data:
-            eco = get_value(res, 'pecosystem')
-            pkg = get_value(res, 'pname')
-            ver = get_value(res, 'version')
+    for eco, pvlist in pvs.items():
+        for pkg, ver in find_epvs_in_graph(eco, pvlist):
             report_result[eco + "@DELIM@" + pkg + "@DELIM@" + ver] = "true"
     return report_result
 
@@ -130,29 +162,17 @@ def find_ingested_epv(ecosystem, pvlist):
     :param epv_list: list, list of EPVs
     :return json, list of epv information
     """
-    query_str = "g.V().has('pecosystem', '{arg0}')." \
-                "has('pname', '{arg1}').has('version', '{arg2}')" \
-                ".valueMap().dedup().fill(epv);"
     report_result = {}
-    args = []
     for pv in pvlist:
         pkg, ver = pv['name'], pv['version']
-        args.append({
-            "0": ecosystem,
-            "1": pkg,
-            "2": ver
-        })
         report_result['{pkg} {ver}'.format(pkg=pkg, ver=ver)] = 'Unknown'
 
-    result_data = batch_query_executor(query_str, args)
-    if result_data is not None:
-        for res in result_data:
-            pkg = get_value(res, 'pname')
-            ver = get_value(res, 'version')
-            report_result['{pkg} {ver}'.format(pkg=pkg, ver=ver)] = 'Ingested'
+    ingested = find_epvs_in_graph(ecosystem, [(pv['name'], pv['version']) for pv in pvlist])
+    for pkg, ver in ingested:
+        report_result['{pkg} {ver}'.format(pkg=pkg, ver=ver)] = 'Ingested'
 
     return {'total_previously_unknown_dependencies': len(pvlist),
-            'ingested_dependencies': len(result_data) if result_data else 0,
+            'ingested_dependencies': len(ingested),
             'report': report_result}
 
 
@@ -163,18 +183,15 @@ def generate_report_for_latest_version(epv_list, day):
     :return json, list of version information
     """
     _logger.info("generating report for latest version.")
-    query_str = "g.V().has('ecosystem', '{arg0}')." \
-                "has('name', '{arg1}')" \
-                ".valueMap().dedup().fill(epv);"
+    query_str = "g.V().has('ecosystem', eco).has('name', within(names))" \
+                ".valueMap('ecosystem', 'name', 'latest_version', 'latest_non_cve_version'," \
+                " 'latest_version_last_updated').dedup()"
     report_result = {}
-    args = []
+    names = {}
     for epv in epv_list:
         eco = epv['ecosystem']
         pkg = epv['name']
-        args.append({
-            "0": eco,
-            "1": pkg
-        })
+        names.setdefault(eco, {})[pkg] = None
         tmp = {
             "ecosystem": eco,
             "name": pkg,
@@ -184,53 +201,146 @@ def generate_report_for_latest_version(epv_list, day):
         }
         report_result[eco + "@DELIM@" + pkg] = tmp
 
-    result_data = batch_query_executor(query_str, args)
+    result_data = []
+    for eco, pkgs in names.items():
+        result_data += batch_query_executor(
+            query_str, list(pkgs), lambda batch, eco=eco: {'eco': eco, 'names': batch})
     today = day.strftime('%Y%m%d')
     yesterday = (day - timedelta(days=1)).strftime('%Y%m%d')
-    if result_data is not None:
-        for res in result_data:
-            eco = get_value(res, 'ecosystem')
-            pkg = get_value(res, 'name')
-            latest_pkg_version = get_value(res, 'latest_version')
-            non_cve_version = get_value(res, 'latest_non_cve_version')
-            last_updated_date = get_value(res, 'latest_version_last_updated')
-            if last_updated_date == today or last_updated_date == yesterday:
-                report_result[eco + "@DELIM@" + pkg]['actual_latest_version'] = latest_pkg_version
-            else:
-                _logger.info("Dates don't match. Will pick the version from upstream for {e} {p}"
-                             .format(e=eco, p=pkg))
-                latest = get_latest_versions_for_ep(eco, pkg)
-                report_result[eco + "@DELIM@" + pkg]['actual_latest_version'] = latest
-            report_result[eco + "@DELIM@" + pkg]['known_latest_version'] = latest_pkg_version
-            report_result[eco + "@DELIM@" + pkg]['non_cve_version'] = non_cve_version
+    stale = []
+    for res in result_data:
+        eco = get_value(res, 'ecosystem')
+        pkg = get_value(res, 'name')
+        latest_pkg_version = get_value(res, 'latest_version')
+        non_cve_version = get_value(res, 'latest_non_cve_version')
+        last_updated_date = get_value(res, 'latest_version_last_updated')
+        if last_updated_date == today or last_updated_date == yesterday:
+            report_result[eco + "@DELIM@" + pkg]['actual_latest_version'] = latest_pkg_version
+        else:
+            _logger.info("Dates don't match. Will pick the version from upstream for {e} {p}"
+                         .format(e=eco, p=pkg))
+            stale.append((eco, pkg))
+        report_result[eco + "@DELIM@" + pkg]['known_latest_version'] = latest_pkg_version
+        report_result[eco + "@DELIM@" + pkg]['non_cve_version'] = non_cve_version
+
+    # Upstream versions are served from the cache, misses are fetched concurrently
+    for (eco, pkg), latest in latest_version_cache.get_many(stale).items():
+        report_result[eco + "@DELIM@" + pkg]['actual_latest_version'] = latest
 
     return report_result
 
 
-def execute_gremlin_dsl(payload, url=GREMLIN_SERVER_URL_REST):
-    """Execute the gremlin query and return the response."""
+class GremlinClient:
+    """Thread-safe client for the Gremlin HTTP server.
+
+    Owns one pooled HTTP session, so all graph calls in the package share the same
+    keep-alive connections, and tracks per-call latency counters.
+    """
+
+    def __init__(self, url=GREMLIN_SERVER_URL_REST, pool_size=GREMLIN_POOL_SIZE,
+                 timeout=(GREMLIN_CONNECT_TIMEOUT, GREMLIN_READ_TIMEOUT), **retry_kwargs):
+        """Create the pooled session.
+
+        :param url: Gremlin HTTP server url.
+        :param pool_size: Maximum number of connections kept open to the server.
+        :param timeout: (connect, read) timeout in seconds for each call.
+        :param retry_kwargs: Retry policy passed on to get_session_retry.
+        """
+        self.url = url
+        self.timeout = timeout
+        self.session = get_session_retry(pool_maxsize=pool_size, **retry_kwargs)
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'errors': 0, 'total_latency': 0.0, 'max_latency': 0.0}
+
+    def post(self, payload, url=None):
+        """Post the payload to Gremlin and return the raw response."""
+        start = time.monotonic()
+        failed = True
+        try:
+            response = self.session.post(url or self.url, json=payload, timeout=self.timeout)
+            failed = response.status_code != 200
+            return response
+        finally:
+            self._record(time.monotonic() - start, failed)
+
+    def _record(self, latency, failed):
+        """Update the latency counters for one call."""
+        with self._lock:
+            self._stats['calls'] += 1
+            self._stats['errors'] += int(failed)
+            self._stats['total_latency'] += latency
+            self._stats['max_latency'] = max(self._stats['max_latency'], latency)
+
+    def stats(self):
+        """Return a snapshot of the latency counters."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['avg_latency'] = stats['total_latency'] / stats['calls'] if stats['calls'] else 0.0
+        return stats
+
+
+class GremlinQueryError(Exception):
+    """A Gremlin query failed, too_large tells if a smaller query may succeed."""
+
+    def __init__(self, message, too_large=False):
+        """Keep whether the failure points at the size of the query."""
+        super().__init__(message)
+        self.too_large = too_large
+
+
+# Words in the error of a failed call telling that the query was too large or too slow
+_TOO_LARGE_HINTS = ('timeout', 'timed out', 'too large', 'too long', 'max content length')
+
+
+def _response_too_large(response):
+    """Tell whether the failed response points at the size of the query."""
+    if response.status_code == 413:
+        return True
+    text = (getattr(response, 'text', '') or '').lower()
+    return response.status_code >= 500 and any(hint in text for hint in _TOO_LARGE_HINTS)
+
+
+def _exception_too_large(exception):
+    """Tell whether the failed call timed out waiting for the response."""
+    if isinstance(exception, requests.exceptions.ReadTimeout):
+        return True
+    # Read timeouts retried by urllib3 are reported as connection errors
+    reason = getattr(exception.args[0], 'reason', None) if exception.args else None
+    return isinstance(reason, ReadTimeoutError)
+
+
+def execute_gremlin_dsl(payload, url=GREMLIN_SERVER_URL_REST, raise_errors=False):
+    """Execute the gremlin query and return the response.
+
+    Errors are logged and None is returned, or GremlinQueryError is raised when
+    raise_errors is set.
+    """
     try:
-        response = get_session_retry().post(url, json=payload)
+        response = gremlin_client.post(payload, url=url)
         if response.status_code == 200:
             return response.json()
         else:
-            _logger.error(
-                "HTTP error {code}. Error retrieving data from {url}.".format(
-                    code=response.status_code, url=url))
-            return None
+            message = "HTTP error {code}. Error retrieving data from {url}.".format(
+                code=response.status_code, url=url)
+            error = GremlinQueryError(message, _response_too_large(response))
 
-    except Exception:
-        _logger.error(traceback.format_exc())
-        return None
+    except Exception as e:
+        message = traceback.format_exc()
+        error = GremlinQueryError(message, _exception_too_large(e))
+
+    _logger.error(message)
+    if raise_errors:
+        raise error
+    return None
 
 
 def get_session_retry(retries=5, backoff_factor=1.0, status_forcelist=(404, 500, 502, 504),
-                      session=None):
+                      session=None, pool_maxsize=10):
     """Set HTTP Adapter with retries to session."""
     session = session or requests.Session()
     retry = Retry(total=retries, read=retries, connect=retries,
                   backoff_factor=backoff_factor, status_forcelist=status_forcelist)
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize)
     session.mount('http://', adapter)
     return session
 
@@ -250,40 +360,148 @@ def get_value(json, attr):
     return ""
 
 
-def batch_query_executor(query_string, args):
-    """Execute the gremlin query in batches of 50."""
-    query = "epv=[];"
-    tmp_query = ""
-    counter = 0
-    result_data = []
-    for arg in args:
-        if len(arg) == 2:
-            tmp_query = query_string.format(arg0=arg['0'], arg1=arg['1'])
-            counter += 1
-        elif len(arg) == 3:
-            tmp_query = query_string.format(arg0=arg['0'], arg1=arg['1'], arg2=arg['2'])
-            counter += 1
-        if counter == 1:
-            query = "epv=[];"
-        query += tmp_query
-
-        if counter >= GREMLIN_QUERY_SIZE:
-            counter = 0
-            payload = {'gremlin': query}
-            gremlin_response = execute_gremlin_dsl(payload)
-            if gremlin_response is not None:
-                result_data += get_response_data(gremlin_response, [{0: 0}])
-            else:
-                _logger.error("Error while trying to fetch data from graph. "
-                              "Expected response, got None...Query->", query)
-
-    if counter < GREMLIN_QUERY_SIZE:
-        payload = {'gremlin': query}
-        gremlin_response = execute_gremlin_dsl(payload)
-        if gremlin_response is not None:
-            result_data += get_response_data(gremlin_response, [{0: 0}])
-        else:
-            _logger.error("Error while trying to fetch data from graph. "
-                          "Expected response, got None...Query->{}".format(query))
+class AdaptiveBatcher:
+    """Pick Gremlin batch sizes from the latency of previous batches.
+
+    The batch size grows by half while calls finish within the target latency, is
+    scaled down when they take longer and is halved when a call fails or times out.
+    """
 
+    def __init__(self, initial_size=GREMLIN_QUERY_SIZE, max_size=GREMLIN_MAX_QUERY_SIZE,
+                 target_latency=GREMLIN_TARGET_LATENCY):
+        """Set the initial batch size and its bounds."""
+        self.size = max(1, min(initial_size, max_size))
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self._lock = threading.Lock()
+        # Only the latest batches are kept, they are published in the ingestion report
+        self._batches = deque(maxlen=1000)
+        self._total = 0
+        self._failed = 0
+
+    def next_size(self):
+        """Return the size to be used for the next batch."""
+        with self._lock:
+            return self.size
+
+    def record(self, size, latency, succeeded):
+        """Record the outcome of one batch and adapt the batch size."""
+        with self._lock:
+            self._batches.append({'size': size, 'latency': round(latency, 3),
+                                  'succeeded': succeeded})
+            self._total += 1
+            self._failed += not succeeded
+            if not succeeded:
+                self.size = max(1, min(self.size, size) // 2)
+            elif latency > self.target_latency:
+                self.size = max(1, int(size * self.target_latency / latency))
+            elif size >= self.size:
+                self.size = min(self.max_size, self.size + max(1, self.size // 2))
+
+    def stats(self):
+        """Return the recorded batch sizes and timings."""
+        with self._lock:
+            return {'current_size': self.size,
+                    'total_batches': self._total,
+                    'failed_batches': self._failed,
+                    'batches': list(self._batches)}
+
+
+def batch_query_executor(query_string, values, build_bindings, batcher=None, failed=None):
+    """Execute a fixed gremlin script for values in adaptively sized batches.
+
+    Values are only ever passed as bindings, so Gremlin Server compiles the script
+    once and reuses it for every batch. Batches are sent concurrently by up to
+    GREMLIN_QUERY_WORKERS threads and sized by the batcher. A batch failing because
+    it was too large or too slow is split in two, other failures are retried up to
+    GREMLIN_QUERY_RETRIES times before the values are given up. Once
+    GREMLIN_FAILURE_BUDGET calls failed, all the values not fetched yet are given up
+    so that an unavailable Gremlin is not flooded. Results are returned in the order
+    of the values.
+
+    :param query_string: str, gremlin script referring to the bindings
+    :param values: list, values to be looked up
+    :param build_bindings: callable returning the bindings dict for a batch of values
+    :param batcher: AdaptiveBatcher, defaults to the one shared by the package
+    :param failed: list, when given the values which were given up are added to it
+    :return list, combined result data of all batches
+    """
+    batcher = batcher or gremlin_batcher
+    results = {}
+    # (start, end, attempt) ranges of values that failed and have to be sent again
+    retries = deque()
+    next_start = 0
+    in_flight = {}
+    failures = 0
+
+    def give_up(start, end):
+        if failed is not None:
+            failed.extend(values[start:end])
+        _logger.error("Error while trying to fetch data from graph. Expected "
+                      "response, got None...Bindings->{}".format(
+                          build_bindings(values[start:end])))
+
+    with ThreadPoolExecutor(max_workers=GREMLIN_QUERY_WORKERS) as executor:
+        while next_start < len(values) or retries or in_flight:
+            while len(in_flight) < GREMLIN_QUERY_WORKERS and (retries or
+                                                              next_start < len(values)):
+                if retries:
+                    start, end, attempt = retries.popleft()
+                else:
+                    start, attempt = next_start, 0
+                    end = next_start = min(len(values), start + batcher.next_size())
+                payload = {'gremlin': query_string,
+                           'bindings': build_bindings(values[start:end])}
+                future = executor.submit(_timed_execute, payload)
+                in_flight[future] = (start, end, attempt)
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                start, end, attempt = in_flight.pop(future)
+                gremlin_response, latency, error = future.result()
+                batcher.record(end - start, latency, error is None)
+                if error is None:
+                    results[start] = get_response_data(gremlin_response, [])
+                    continue
+                failures += 1
+                if failures >= GREMLIN_FAILURE_BUDGET:
+                    give_up(start, end)
+                elif error.too_large and end - start > 1:
+                    middle = (start + end) // 2
+                    retries.extend([(start, middle, attempt), (middle, end, attempt)])
+                elif attempt < GREMLIN_QUERY_RETRIES:
+                    retries.append((start, end, attempt + 1))
+                else:
+                    give_up(start, end)
+
+            if failures >= GREMLIN_FAILURE_BUDGET and (retries or next_start < len(values)):
+                _logger.error("{} Gremlin calls failed, giving up the remaining values".format(
+                    failures))
+                while retries:
+                    give_up(*retries.popleft()[:2])
+                if next_start < len(values):
+                    give_up(next_start, len(values))
+                    next_start = len(values)
+
+    result_data = []
+    for start in sorted(results):
+        result_data += results[start]
     return result_data
+
+
+def _timed_execute(payload):
+    """Execute the gremlin query and return the response, its latency and error."""
+    start = time.monotonic()
+    response, error = None, None
+    try:
+        response = execute_gremlin_dsl(payload, raise_errors=True)
+        if response is None:
+            error = GremlinQueryError('No response from Gremlin')
+    except GremlinQueryError as e:
+        error = e
+    return response, time.monotonic() - start, error
+
+
+# Shared by every graph access in the package.
+gremlin_client = GremlinClient()
+gremlin_batcher = AdaptiveBatcher()
@@ -65,10 +65,9 @@ def generate_ingestion_report(start_date: str, end_date: str, frequency='daily')
 
     :returns: Ingestion Results dump
     """
-    rds_obj = ReportQueries()
-
     # Query DB to fetch ingestion data
-    ingestion_db_data = rds_obj.retrieve_ingestion_results(start_date, end_date)
+    with ReportQueries() as rds_obj:
+        ingestion_db_data = rds_obj.retrieve_ingestion_results(start_date, end_date)
     if not ingestion_db_data:
         logger.error('No Ingestion data found in last 24 hours')
 
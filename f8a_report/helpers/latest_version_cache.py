@@ -0,0 +1,103 @@
+"""Persistent TTL cache for the upstream latest version lookups."""
+
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from f8a_utils.versions import get_latest_versions_for_ep
+from f8a_report.helpers.cache_helper import SQLiteCache, cache_path
+
+logger = logging.getLogger(__file__)
+
+LATEST_VERSION_CACHE_PATH = os.getenv('LATEST_VERSION_CACHE_PATH',
+                                      cache_path('latest_version_cache.db'))
+# Seconds for which an upstream latest version is served from the cache. Longer than the
+# daily cron period, so the next runs reuse the versions looked up by the previous ones.
+LATEST_VERSION_CACHE_TTL = int(os.getenv('LATEST_VERSION_CACHE_TTL', 3 * 24 * 60 * 60))
+LATEST_VERSION_LOOKUP_WORKERS = int(os.getenv('LATEST_VERSION_LOOKUP_WORKERS', 8))
+
+
+class LatestVersionCache(SQLiteCache):
+    """Cache upstream latest versions per (ecosystem, package) in memory and in SQLite.
+
+    Cache misses are looked up from the upstream registries in a bounded thread pool.
+    Without a usable database the in-memory layer is still used.
+    """
+
+    description = 'latest version cache'
+    schema = ('CREATE TABLE IF NOT EXISTS latest_version (ecosystem TEXT, package TEXT, '
+              'version TEXT, fetched_at REAL, PRIMARY KEY (ecosystem, package))')
+    counters = ('hits', 'misses', 'errors')
+
+    def __init__(self, path=LATEST_VERSION_CACHE_PATH, ttl=LATEST_VERSION_CACHE_TTL,
+                 workers=LATEST_VERSION_LOOKUP_WORKERS):
+        """Set up the cache, the database is opened by the first lookup."""
+        super().__init__(path)
+        self.ttl = ttl
+        self.workers = workers
+        self._memory = {}
+
+    def _get(self, eco, pkg, now):
+        """Return the cached version of the package if it has not expired."""
+        entry = self._memory.get((eco, pkg))
+        if entry is None:
+            row = self._fetchone('SELECT version, fetched_at FROM latest_version '
+                                 'WHERE ecosystem = ? AND package = ?', (eco, pkg))
+            if row is not None:
+                entry = self._memory[(eco, pkg)] = tuple(row)
+        if entry is not None and now - entry[1] < self.ttl:
+            return entry[0]
+        return None
+
+    def _set_many(self, versions, now):
+        """Store the fetched versions in both cache layers."""
+        for key, version in versions.items():
+            self._memory[key] = (version, now)
+        if versions:
+            self._write('INSERT OR REPLACE INTO latest_version VALUES (?, ?, ?, ?)',
+                        [(eco, pkg, version, now) for (eco, pkg), version in versions.items()])
+
+    @staticmethod
+    def _fetch(key):
+        """Fetch the latest version of the package from upstream."""
+        eco, pkg = key
+        try:
+            return get_latest_versions_for_ep(eco, pkg)
+        except Exception as e:
+            logger.error('Unable to fetch latest version for %s %s: %r', eco, pkg, e)
+            return None
+
+    def get_many(self, keys):
+        """Return the latest version for each (ecosystem, package) key.
+
+        :param keys: iterable of (ecosystem, package) tuples
+        :return dict, latest version by key, None when it could not be fetched
+        """
+        now = time.time()
+        result = {}
+        misses = []
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                version = self._get(key[0], key[1], now)
+                if version is None:
+                    misses.append(key)
+                else:
+                    result[key] = version
+            self._stats['hits'] += len(result)
+            self._stats['misses'] += len(misses)
+
+        if misses:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                fetched = dict(zip(misses, executor.map(self._fetch, misses)))
+            # Failed lookups are not cached, they are retried by the next run
+            found = {key: version for key, version in fetched.items() if version}
+            with self._lock:
+                self._stats['errors'] += len(fetched) - len(found)
+                self._set_many(found, now)
+            result.update(fetched)
+        return result
+
+
+# Shared by the ingestion reports, so repeated lookups in one run are cached as well.
+latest_version_cache = LatestVersionCache()
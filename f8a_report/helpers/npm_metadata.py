@@ -16,13 +16,152 @@
 #
 """Class to update NPM package details."""
 import datetime
+import hashlib
+import itertools
+import json
+import os
 import requests
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse, quote
+from requests.adapters import HTTPAdapter
 from f8a_report.helpers.s3_helper import S3Helper
 
 logger = logging.getLogger(__file__)
 
 NPM_PACKAGE_FILE_PATH = "training-utils/node-package-details.json"
+# Packages updated since the last full save are checkpointed under this prefix every
+# NPM_CHECKPOINT_PACKAGES packages or NPM_CHECKPOINT_SECONDS seconds, and merged back
+# when the next run starts, so an interrupted run does not lose its progress.
+NPM_CHECKPOINT_PREFIX = "training-utils/node-package-details-checkpoints/"
+NPM_CHECKPOINT_PACKAGES = int(os.getenv('NPM_CHECKPOINT_PACKAGES', 1000))
+NPM_CHECKPOINT_SECONDS = int(os.getenv('NPM_CHECKPOINT_SECONDS', 300))
+# Sharded layout of the package details, each package is stored in one of the shards
+# picked by the hash of its name, with an index of the shards. Once the file has been
+# converted (see npm_metadata_migration_main.py) only the shards with packages of the
+# manifest are read and only the shards with updated packages are written back. The
+# number of shards is a power of two sized at the migration for NPM_PACKAGES_PER_SHARD
+# packages per shard, so that a manifest touches a small part of the packages.
+NPM_PACKAGE_SHARDS_PREFIX = "training-utils/node-package-details/"
+NPM_PACKAGE_SHARD_INDEX = NPM_PACKAGE_SHARDS_PREFIX + "index.json"
+NPM_PACKAGES_PER_SHARD = int(os.getenv('NPM_PACKAGES_PER_SHARD', 50))
+# Shard count of the indexes written before the count was recorded in them
+DEFAULT_SHARD_COUNT = 256
+NPM_SHARD_WORKERS = int(os.getenv('NPM_SHARD_WORKERS', 8))
+# Rebuild NPM_PACKAGE_FILE_PATH from all the shards after each update. It reads and
+# writes every package, so by default the file is rebuilt by its own scheduled job
+# instead (see npm_package_file_main.py), for the readers not moved to the shards yet.
+NPM_WRITE_PACKAGE_FILE = os.getenv('NPM_WRITE_PACKAGE_FILE', 'false') in ('True', 'true', '1')
+NPM_REGISTRY_URL = os.getenv('NPM_REGISTRY_URL', 'https://registry.npmjs.org/')
+# Abbreviated metadata, without READMEs and the fields not needed to install a package
+NPM_ABBREVIATED_METADATA = 'application/vnd.npm.install-v1+json; q=1.0, application/json; q=0.8'
+
+# Number of packages fetched concurrently, and the number of concurrent requests sent
+# to the NPM registry. The Github API is only called from the main thread.
+NPM_FETCH_WORKERS = int(os.getenv('NPM_FETCH_WORKERS', 16))
+NPM_REGISTRY_CONCURRENCY = int(os.getenv('NPM_REGISTRY_CONCURRENCY', 16))
+# Requests answered with 429 or 5xx are retried this many times, waiting for the
+# Retry-After header or an exponential backoff starting at NPM_BACKOFF_FACTOR seconds.
+NPM_FETCH_RETRIES = int(os.getenv('NPM_FETCH_RETRIES', 5))
+NPM_BACKOFF_FACTOR = float(os.getenv('NPM_BACKOFF_FACTOR', 1.0))
+NPM_BACKOFF_MAX = float(os.getenv('NPM_BACKOFF_MAX', 60))
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
+# Repositories looked up per aliased GraphQL request
+GITHUB_GRAPHQL_BATCH_SIZE = int(os.getenv('GITHUB_GRAPHQL_BATCH_SIZE', 50))
+
+
+def shard_count_for(package_count):
+    """Return the number of shards for the packages, a power of two."""
+    shard_count = 1
+    while shard_count * NPM_PACKAGES_PER_SHARD < package_count:
+        shard_count *= 2
+    return shard_count
+
+
+def package_shard(package_name, shard_count=DEFAULT_SHARD_COUNT):
+    """Return the shard of the package, the leading bits of the md5 of its name in hex.
+
+    :param shard_count: int, power of two
+    """
+    bits = shard_count.bit_length() - 1
+    shard = int(hashlib.md5(package_name.encode('utf-8')).hexdigest()[:8], 16) >> (32 - bits)
+    return '{:0{width}x}'.format(shard, width=max((bits + 3) // 4, 1))
+
+
+def shard_key(shard):
+    """Return the S3 key of the shard."""
+    return '{prefix}shard-{shard}.json'.format(prefix=NPM_PACKAGE_SHARDS_PREFIX, shard=shard)
+
+
+def read_shards(s3Helper, bucket_name, shards):
+    """Read the packages of the shards concurrently."""
+    def read_shard(shard):
+        return dict(s3Helper.iter_json_object(bucket_name=bucket_name, obj_key=shard_key(shard)))
+
+    data = {}
+    with ThreadPoolExecutor(max_workers=NPM_SHARD_WORKERS) as executor:
+        for packages in executor.map(read_shard, sorted(shards)):
+            data.update(packages)
+    return data
+
+
+def write_shards(s3Helper, bucket_name, data, shards, index):
+    """Store the given shards of the package details, then the index updated with them.
+
+    :param data: dict, package details of at least every package in the shards
+    :param shards: iterable, shards to be written
+    :param index: dict, the shard index, updated in place
+    """
+    shard_count = index.setdefault('shard_count', DEFAULT_SHARD_COUNT)
+    by_shard = {shard: {} for shard in shards}
+    for package_name, details in data.items():
+        packages = by_shard.get(package_shard(package_name, shard_count))
+        if packages is not None:
+            packages[package_name] = details
+
+    def write_shard(item):
+        s3Helper.store_json_stream(content=item[1], bucket_name=bucket_name,
+                                   obj_key=shard_key(item[0]))
+
+    with ThreadPoolExecutor(max_workers=NPM_SHARD_WORKERS) as executor:
+        list(executor.map(write_shard, by_shard.items()))
+    index.setdefault('shards', {}).update(
+        {shard: len(packages) for shard, packages in by_shard.items()})
+    index['updated_timestamp'] = int(datetime.datetime.now().timestamp())
+    s3Helper.store_json_stream(content=index, bucket_name=bucket_name,
+                               obj_key=NPM_PACKAGE_SHARD_INDEX, encoding='compact')
+
+
+def write_package_file(s3Helper, bucket_name, index):
+    """Rebuild the node package details file from the shards of the index, one at a time."""
+    count = 0
+    with s3Helper.open_json_writer(bucket_name, NPM_PACKAGE_FILE_PATH) as writer:
+        writer.write('{')
+        for shard in sorted(index.get('shards', {})):
+            for package_name, details in s3Helper.iter_json_object(bucket_name=bucket_name,
+                                                                   obj_key=shard_key(shard)):
+                writer.write((',' if count else '') + json.dumps(package_name) + ':')
+                writer.write_json(details)
+                count += 1
+        writer.write('}')
+    logger.info("Stored %d packages into %s", count, NPM_PACKAGE_FILE_PATH)
+
+
+def migrate_to_shards(s3Helper, bucket_name):
+    """Convert the node package details file into the sharded layout.
+
+    :return dict, the shard index
+    """
+    data = dict(s3Helper.iter_json_object(bucket_name=bucket_name,
+                                          obj_key=NPM_PACKAGE_FILE_PATH))
+    index = {'shard_count': shard_count_for(len(data)), 'shards': {}}
+    write_shards(s3Helper, bucket_name, data,
+                 {package_shard(name, index['shard_count']) for name in data}, index)
+    logger.info("Stored %d packages in %d shards", len(data), len(index['shards']))
+    return index
 
 
 class NPMMetadata:
@@ -49,6 +188,25 @@ class NPMMetadata:
             'fetched_from_github': 0,
             'npm_fetch_errors': 0,
             'github_fetch_errors': 0,
+            'throttled_retries': 0,
+            'not_modified': 0,
+            'full_document_fetches': 0,
+            'github_requests': 0,
+            'resumed_count': self._resumed_count,
+            'checkpoints': 0,
+            'loaded_shards': self._loaded_shards,
+            'written_shards': 0,
+        }
+        self._stats_lock = threading.Lock()
+
+        # Pooled session shared by the fetch workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=NPM_FETCH_WORKERS)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._host_limits = {
+            urlparse(NPM_REGISTRY_URL).netloc:
+                threading.BoundedSemaphore(NPM_REGISTRY_CONCURRENCY),
         }
 
     def update(self):
@@ -56,16 +214,10 @@ class NPMMetadata:
         logger.debug("Existing node package length: %d", self.stats['existing_count'])
         logger.debug("Number of node package in manifest: %d", self.stats['unique_manifest_count'])
 
-        index = 0
         # Force update package after 30 days (2592000 seconds) to get latest version data.
         update_timestamp = int(datetime.datetime.now().timestamp()) - 2592000
+        to_fetch = []
         for package_name in self.package_list:
-            # Print progress for every 500 packages
-            if index % 500 == 0:
-                logger.debug("Processing [%d/%d %d%%] ==> '%s'", index + 1,
-                             self.stats['unique_manifest_count'],
-                             index * 100 / self.stats['unique_manifest_count'], package_name)
-            index += 1
             package_details = self.existing_data.get(package_name, None)
 
             if not package_details or \
@@ -74,26 +226,84 @@ class NPMMetadata:
 
                 if not package_details:
                     self._track_stats('new_packages', 1)
-
-                new_package_details = self._fetch(package_name)
-                if new_package_details:
-                    self._track_stats('updated_count', 1)
-                    self.existing_data[package_name] = new_package_details
-                else:
-                    self._track_stats('still_missing', 1)
+                to_fetch.append(package_name)
             else:
                 self._track_stats('metadata_exists', 1)
 
-        logger.info("Processing completed [%d/%d %d%%]", index,
-                    self.stats['unique_manifest_count'],
-                    index * 100 / self.stats['unique_manifest_count'])
+        index = 0
+        pending = []
+        last_checkpoint = time.monotonic()
+        queued = iter(to_fetch)
+        with ThreadPoolExecutor(max_workers=NPM_FETCH_WORKERS) as executor:
+            # Only a bounded window of fetches is in flight, so the fetched details are
+            # held once, in existing_data, as soon as they are merged
+            futures = {}
+            for package_name in itertools.islice(queued, NPM_FETCH_WORKERS * 2):
+                futures[executor.submit(self._fetch, package_name,
+                                        self.existing_data.get(package_name))] = package_name
+            # Results are merged here only, so existing_data is never shared between threads
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    package_name = futures.pop(future)
+                    for next_name in itertools.islice(queued, 1):
+                        futures[executor.submit(self._fetch, next_name,
+                                                self.existing_data.get(next_name))] = next_name
+                    # Print progress for every 500 packages
+                    if index % 500 == 0:
+                        logger.debug("Processing [%d/%d %d%%] ==> '%s'", index + 1,
+                                     len(to_fetch), index * 100 / len(to_fetch), package_name)
+                    index += 1
+                    new_package_details = future.result()
+                    if new_package_details:
+                        self._track_stats('updated_count', 1)
+                        self.existing_data[package_name] = new_package_details
+                        if self._shard_index is not None:
+                            self._dirty_shards.add(self._package_shard(package_name))
+                        pending.append(package_name)
+                    else:
+                        self._track_stats('still_missing', 1)
+
+                    if len(pending) >= NPM_CHECKPOINT_PACKAGES or \
+                       time.monotonic() - last_checkpoint >= NPM_CHECKPOINT_SECONDS:
+                        self._checkpoint(pending)
+                        pending = []
+                        last_checkpoint = time.monotonic()
+
+        self._add_github_keywords(pending)
+        logger.info("Processing completed [%d/%d packages fetched]", index,
+                    self.stats['unique_manifest_count'])
 
         self._save_data()
         self._print_stats()
 
     def _track_stats(self, key=str, addition=int):
         """Add the given number to stats key variable."""
-        self.stats[key] += addition
+        with self._stats_lock:
+            self.stats[key] += addition
+
+    def _request(self, method, url, **kwargs):
+        """Send the request through the pooled session, honouring the per host limits.
+
+        Throttled (429) and failed (5xx) requests are retried with a backoff.
+        """
+        limit = self._host_limits.get(urlparse(url).netloc)
+        for attempt in range(NPM_FETCH_RETRIES + 1):
+            if limit:
+                with limit:
+                    response = self.session.request(method, url, timeout=(10, 60), **kwargs)
+            else:
+                response = self.session.request(method, url, timeout=(10, 60), **kwargs)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == NPM_FETCH_RETRIES:
+                return response
+            self._track_stats('throttled_retries', 1)
+            try:
+                delay = float(response.headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                delay = NPM_BACKOFF_FACTOR * (2 ** attempt)
+            logger.info("Got %d for %s, retrying in %.1f seconds", response.status_code, url,
+                        delay)
+            time.sleep(min(delay, NPM_BACKOFF_MAX))
 
     def _print_stats(self):
         """Print statistics about operation."""
@@ -109,17 +319,37 @@ class NPMMetadata:
         logger.debug("    9. Registry fetch errors : %d", self.stats['npm_fetch_errors'])
         logger.debug("   10. Data fetched from github : %d", self.stats['fetched_from_github'])
         logger.debug("   11. Github fetch errors : %d", self.stats['github_fetch_errors'])
+        logger.debug("   12. Throttled request retries : %d", self.stats['throttled_retries'])
+        logger.debug("   13. Registry not modified : %d", self.stats['not_modified'])
+        logger.debug("   14. Full registry documents : %d", self.stats['full_document_fetches'])
+        logger.debug("   15. Github requests : %d", self.stats['github_requests'])
+        logger.debug("   16. Packages resumed from checkpoints : %d", self.stats['resumed_count'])
+        logger.debug("   17. Checkpoints stored : %d", self.stats['checkpoints'])
+        logger.debug("   18. Shards loaded : %d", self.stats['loaded_shards'])
+        logger.debug("   19. Shards written : %d", self.stats['written_shards'])
 
-    def _fetch(self, package_name=str):
+    def _fetch(self, package_name=str, package_details=None):
         """Fetch metadata for a package and return it as json."""
-        package_metadata = self._from_npm_registry(package_name)
+        return self._from_npm_registry(package_name, package_details)
 
+    def _add_github_keywords(self, package_names):
+        """Set the Github topics as keywords of the packages without keywords."""
         # If key words are not found in repository, get it from github.
-        if package_metadata and len(package_metadata.get("keywords", [])) == 0 and \
-           len(package_metadata.get("repositoryurl", "")) > 0:
-            package_metadata["keywords"] = self._from_github(package_metadata["repositoryurl"])
+        repos = {}
+        for package_name in package_names:
+            package_metadata = self.existing_data[package_name]
+            repo_url = package_metadata.get("repositoryurl", "")
+            if len(package_metadata.get("keywords", [])) == 0 and 'github.com' in repo_url:
+                repo = self._get_org_package_name(repo_url)
+                if all(repo):
+                    repos.setdefault(repo, []).append(package_name)
 
-        return package_metadata
+        repo_list = list(repos)
+        for start in range(0, len(repo_list), GITHUB_GRAPHQL_BATCH_SIZE):
+            batch = repo_list[start:start + GITHUB_GRAPHQL_BATCH_SIZE]
+            for repo, keywords in zip(batch, self._from_github(batch)):
+                for package_name in repos[repo]:
+                    self.existing_data[package_name]["keywords"] = keywords
 
     def _flatten_list(self, manifest_data):
         """Create a flatten list for given list of list."""
@@ -134,14 +364,89 @@ class NPMMetadata:
 
     def _load_data(self):
         """Load the node registry dump from S3 bucket and tranform into dict for quick access."""
-        return self.s3Helper.read_json_object(bucket_name=self.bucket_name,
-                                              obj_key=NPM_PACKAGE_FILE_PATH) or {}
+        # Resume from the checkpoints of an interrupted run, oldest first
+        self._checkpoint_keys = self.s3Helper.list_keys(self.bucket_name, NPM_CHECKPOINT_PREFIX)
+        checkpoints = [self.s3Helper.read_json_object(bucket_name=self.bucket_name,
+                                                      obj_key=key) or {}
+                       for key in self._checkpoint_keys]
+        self._dirty_shards = set()
+
+        if self.s3Helper.list_keys(self.bucket_name, NPM_PACKAGE_SHARD_INDEX):
+            self._shard_index = self.s3Helper.read_json_object(
+                bucket_name=self.bucket_name, obj_key=NPM_PACKAGE_SHARD_INDEX)
+            self._dirty_shards = {self._package_shard(name) for checkpoint in checkpoints
+                                  for name in checkpoint}
+            # Only the shards of the manifest packages, and of the checkpointed ones which
+            # have to be written back, are needed
+            shards = {self._package_shard(name) for name in self.package_list} | \
+                self._dirty_shards
+            shards &= set(self._shard_index.get('shards', {}))
+            data = read_shards(self.s3Helper, self.bucket_name, shards)
+            self._loaded_shards = len(shards)
+        else:
+            self._shard_index = None
+            self._loaded_shards = 0
+            # Parse the dump package by package instead of holding its raw body as well
+            data = dict(self.s3Helper.iter_json_object(bucket_name=self.bucket_name,
+                                                       obj_key=NPM_PACKAGE_FILE_PATH))
+
+        self._resumed_count = 0
+        for checkpoint in checkpoints:
+            self._resumed_count += len(checkpoint)
+            data.update(checkpoint)
+        if self._checkpoint_keys:
+            logger.info("Resumed %d packages from %d checkpoints", self._resumed_count,
+                        len(self._checkpoint_keys))
+        self._run_id = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        return data
+
+    def _package_shard(self, package_name):
+        """Return the shard of the package in the shard index."""
+        return package_shard(package_name,
+                             self._shard_index.get('shard_count', DEFAULT_SHARD_COUNT))
+
+    def _checkpoint(self, package_names):
+        """Store the packages updated since the previous checkpoint."""
+        if not package_names:
+            return
+        self._add_github_keywords(package_names)
+        key = '{prefix}{run}-{n:05d}.json'.format(prefix=NPM_CHECKPOINT_PREFIX, run=self._run_id,
+                                                  n=self.stats['checkpoints'])
+        try:
+            self.s3Helper.store_json_stream(
+                content={name: self.existing_data[name] for name in package_names},
+                bucket_name=self.bucket_name, obj_key=key, encoding='compact')
+            self._checkpoint_keys.append(key)
+            self._track_stats('checkpoints', 1)
+        except Exception as e:
+            logger.error("Unable to store the checkpoint %s, it throws %s", key, e)
 
     def _save_data(self):
-        """Get back data into original format and save it to a file."""
-        self.s3Helper.store_json_content(
-            content=self.existing_data, bucket_name=self.bucket_name,
-            obj_key=NPM_PACKAGE_FILE_PATH)
+        """Get back data into original format and save it to a file.
+
+        The checkpoints are compacted into the file, or into the updated shards, and
+        removed once they are stored. With the shards, the file is only rebuilt from them
+        when NPM_WRITE_PACKAGE_FILE is set.
+        """
+        try:
+            if self._shard_index is not None:
+                write_shards(self.s3Helper, self.bucket_name, self.existing_data,
+                             self._dirty_shards, self._shard_index)
+                self._track_stats('written_shards', len(self._dirty_shards))
+                if NPM_WRITE_PACKAGE_FILE:
+                    write_package_file(self.s3Helper, self.bucket_name, self._shard_index)
+            else:
+                self.s3Helper.store_json_stream(
+                    content=self.existing_data, bucket_name=self.bucket_name,
+                    obj_key=NPM_PACKAGE_FILE_PATH)
+        except Exception as e:
+            logger.error("Unable to store the node package details, keeping the checkpoints. "
+                         "It throws %s", e)
+            return
+        self._dirty_shards = set()
+        if self._checkpoint_keys:
+            self.s3Helper.delete_objects(self.bucket_name, self._checkpoint_keys)
+            self._checkpoint_keys = []
 
     def _get_org_package_name(self, repo_url):
         """Give the Query Parameters which are organization and package name respectively."""
@@ -152,6 +457,8 @@ class NPMMetadata:
             if 'github' not in url_chunks[1]:
                 org = url_chunks[1]
             package_name = url_chunks[2]
+            if package_name.endswith('.git'):
+                package_name = package_name[:-len('.git')]
             return org, package_name
         except Exception as e:
             logger.error("Could not as org and package name for repo %s, it throws error %s",
@@ -159,56 +466,112 @@ class NPMMetadata:
 
         return org, package_name
 
-    def _github_clean_response(self, response_json):
-        """Clean the api response json."""
-        topic_edges = response_json["data"]["organization"]["repository"]["repositoryTopics"]
-        topic_names = [i.get("node", {}).get("topic", {}).get("name", None)
+    @staticmethod
+    def _github_topics(repository):
+        """Get the topic names of a repository node of the api response json."""
+        topic_edges = (repository or {}).get("repositoryTopics") or {"edges": []}
+        topic_names = [(i.get("node") or {}).get("topic", {}).get("name", None)
                        for i in topic_edges["edges"]]
-        topic_names = [i for i in topic_names if i is not None]
-        return topic_names
+        return [i for i in topic_names if i is not None]
+
+    def _from_github(self, repos):
+        """Find the keywords of the (owner, name) repositories from the Github Graph QL.
 
-    def _from_github(self, repo_url=str):
-        """Find the keywords from the Github Graph QL."""
-        github_org, package_name = self._get_org_package_name(repo_url)
-        api_url = "https://api.github.com/graphql"
+        The repositories are looked up with one aliased query. When the rate limit left is
+        not enough for another such query, wait until it is reset.
+
+        :return list, keywords of each repository
+        """
+        variables = {}
+        fields = []
+        for i, (owner, name) in enumerate(repos):
+            variables['o%d' % i] = owner
+            variables['n%d' % i] = name
+            fields.append('r{i}: repository(owner: $o{i}, name: $n{i}) '
+                          '{{repositoryTopics(first: 10) {{edges {{node {{topic {{name}}}}}}}}}}'
+                          .format(i=i))
+        arguments = ', '.join('$o{i}: String!, $n{i}: String!'.format(i=i)
+                              for i in range(len(repos)))
         payload = {
-            "query": "query{organization(login:\"" + github_org + "\")"
-                     "{name url repository(name:\"" + package_name + "\")"
-                     "{name url description repositoryTopics(first: 10)"
-                     "{edges {node{topic{name}}}}}}}"
+            "query": "query({}) {{{} rateLimit {{cost remaining resetAt}}}}".format(
+                arguments, ' '.join(fields)),
+            "variables": variables,
         }
         headers = {"Authorization": "token %s" % self.github_token}
         try:
-            response = requests.post(url=api_url, json=payload, headers=headers)
-            keywords = list(self._github_clean_response(response.json()))
-            self._track_stats('fetched_from_github', 1)
-            return keywords
+            response = self._request('POST', GITHUB_GRAPHQL_URL, json=payload, headers=headers)
+            data = response.json().get("data") or {}
         except Exception as e:
-            self._track_stats('github_fetch_errors', 1)
-            logger.warning("Github response/token error for repo %s, it throws %s", repo_url, e)
+            self._track_stats('github_fetch_errors', len(repos))
+            logger.warning("Github response/token error for repos %s, it throws %s", repos, e)
+            return [[] for _ in repos]
+
+        self._track_stats('github_requests', 1)
+        keywords = []
+        for i, repo in enumerate(repos):
+            # Repositories which can not be resolved are null, with an entry in errors
+            if data.get('r%d' % i) is None:
+                self._track_stats('github_fetch_errors', 1)
+                logger.warning("Github repository %s/%s not found", *repo)
+            else:
+                self._track_stats('fetched_from_github', 1)
+            keywords.append(self._github_topics(data.get('r%d' % i)))
+        self._wait_for_rate_limit(data.get("rateLimit"))
+        return keywords
 
-        return []
+    @staticmethod
+    def _wait_for_rate_limit(rate_limit):
+        """Sleep until the rate limit is reset when the next query could exceed it."""
+        if not rate_limit or rate_limit.get("remaining", 0) > 2 * rate_limit.get("cost", 1):
+            return
+        reset_at = datetime.datetime.strptime(rate_limit["resetAt"], "%Y-%m-%dT%H:%M:%SZ")
+        delay = (reset_at - datetime.datetime.utcnow()).total_seconds()
+        if delay > 0:
+            logger.info("Github rate limit almost used, waiting %d seconds", delay)
+            time.sleep(delay)
 
-    def _from_npm_registry(self, package_name=str):
-        """Find the keywords from NPM registry(through api)."""
+    def _from_npm_registry(self, package_name=str, package_details=None):
+        """Find the keywords from NPM registry(through api).
+
+        The abbreviated install metadata is requested, conditionally on the ETag and
+        Last-Modified stored with the package details. It only has the versions and
+        their dependencies, the other fields are kept from the stored details when the
+        latest version did not change, or read from the latest version manifest.
+        """
         data_dict = None
-        api_url = "https://registry.npmjs.org/" + str(package_name)
+        api_url = NPM_REGISTRY_URL + quote(str(package_name), safe='@')
+        headers = {'Accept': NPM_ABBREVIATED_METADATA}
+        if package_details and package_details.get('etag'):
+            headers['If-None-Match'] = package_details['etag']
+        if package_details and package_details.get('last_modified'):
+            headers['If-Modified-Since'] = package_details['last_modified']
         try:
-            response = requests.get(api_url)
+            response = self._request('GET', api_url, headers=headers)
+            now = int(datetime.datetime.now().timestamp())
+            if response.status_code == 304 and package_details:
+                self._track_stats('not_modified', 1)
+                return dict(package_details, updated_timestamp=now)
+
             json_data = response.json()
             latest_version = json_data.get("dist-tags", {}).get("latest", None)
             if latest_version:
                 latest_version_data = json_data.get("versions", {}).get(latest_version, {})
+                if package_details and package_details.get("version") == latest_version:
+                    details = package_details
+                else:
+                    details = self._latest_version_details(api_url, json_data, latest_version)
                 data_dict = {
                     "name": json_data.get("name", ""),
-                    "description": json_data.get("description", ""),
+                    "description": details.get("description", ""),
                     "version": latest_version,
-                    "keywords": latest_version_data.get("keywords", []),
+                    "keywords": details.get("keywords", []),
                     "dependencies":
                         list(latest_version_data.get("dependencies", {}).keys()),
-                    "homepage": json_data.get("homepage", ""),
-                    "repositoryurl": json_data.get("repository", {}).get("url", ""),
-                    "updated_timestamp": int(datetime.datetime.now().timestamp()),
+                    "homepage": details.get("homepage", ""),
+                    "repositoryurl": details.get("repositoryurl", ""),
+                    "updated_timestamp": now,
+                    "etag": response.headers.get("ETag", ""),
+                    "last_modified": response.headers.get("Last-Modified", ""),
                 }
                 # Other fields that were present in past, but not used for training model are
                 # below. Removing this fields saves lot of space while storing pacakge data in
@@ -226,3 +589,26 @@ class NPMMetadata:
                          package_name, e)
 
         return data_dict
+
+    def _latest_version_details(self, api_url, json_data, latest_version):
+        """Get the fields missing in the abbreviated metadata for the latest version.
+
+        The manifest of the latest version is small, the full document with every README
+        is only downloaded when the manifest can not be fetched.
+        """
+        response = self._request('GET', api_url + '/' + quote(latest_version))
+        if response.status_code == 200:
+            version_data = response.json()
+            top_level_data = version_data
+        else:
+            self._track_stats('full_document_fetches', 1)
+            top_level_data = self._request('GET', api_url).json()
+            version_data = top_level_data.get("versions", {}).get(latest_version, {})
+        repository = top_level_data.get("repository", {})
+        return {
+            "description": top_level_data.get("description", ""),
+            "keywords": version_data.get("keywords", []),
+            "homepage": top_level_data.get("homepage", ""),
+            "repositoryurl": repository.get("url", "") if isinstance(repository, dict)
+            else repository,
+        }
@@ -6,6 +6,8 @@ import json
 import logging
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+import threading
 import itertools
 import requests
 import heapq
@@ -13,8 +15,11 @@ from operator import itemgetter
 from datetime import datetime as dt
 from psycopg2 import sql
 from collections import Counter
+from contextlib import contextmanager
 from f8a_report.helpers.graph_report_generator import generate_report_for_unknown_epvs, \
-    generate_report_for_latest_version, rectify_latest_version
+    generate_report_for_latest_version, rectify_latest_version, gremlin_client, \
+    gremlin_batcher
+from f8a_report.helpers.latest_version_cache import latest_version_cache
 from f8a_report.helpers.s3_helper import S3Helper
 from f8a_report.helpers.unknown_deps_report_helper import UnknownDepsReportHelper
 from f8a_report.helpers.sentry_report_helper import SentryReportHelper
@@ -24,19 +29,99 @@ from f8a_report.helpers.npm_metadata import NPMMetadata
 logger = logging.getLogger(__file__)
 
 
+PG_POOL_MIN_CONNECTIONS = int(os.getenv('PG_POOL_MIN_CONNECTIONS', 1))
+PG_POOL_MAX_CONNECTIONS = int(os.getenv('PG_POOL_MAX_CONNECTIONS', 5))
+# Seconds to wait for a free pooled connection before giving up.
+PG_POOL_TIMEOUT = float(os.getenv('PG_POOL_TIMEOUT', 300))
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises as soon as it is exhausted, this makes borrowers wait instead
+_connection_slots = threading.BoundedSemaphore(PG_POOL_MAX_CONNECTIONS)
+
+
+def get_connection_pool():
+    """Return the process wide Postgres connection pool, creating it on first use."""
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None or _connection_pool.closed:
+            conn_string = "host='{host}' dbname='{dbname}' user='{user}' password='{password}'". \
+                format(host=os.getenv('PGBOUNCER_SERVICE_HOST', 'bayesian-pgbouncer'),
+                       dbname=os.getenv('POSTGRESQL_DATABASE', 'coreapi'),
+                       user=os.getenv('POSTGRESQL_USER', 'coreapi'),
+                       password=os.getenv('POSTGRESQL_PASSWORD', 'coreapi'))
+            _connection_pool = psycopg2.pool.ThreadedConnectionPool(
+                PG_POOL_MIN_CONNECTIONS, PG_POOL_MAX_CONNECTIONS, conn_string)
+        return _connection_pool
+
+
+def borrow_connection():
+    """Borrow a connection from the pool, waiting for one to be handed back if needed."""
+    if not _connection_slots.acquire(timeout=PG_POOL_TIMEOUT):
+        raise psycopg2.pool.PoolError(
+            'no pooled connection was handed back within {} seconds'.format(PG_POOL_TIMEOUT))
+    try:
+        return get_connection_pool().getconn()
+    except Exception:
+        _connection_slots.release()
+        raise
+
+
+def return_connection(conn):
+    """Hand a borrowed connection back to the pool."""
+    try:
+        get_connection_pool().putconn(conn)
+    finally:
+        _connection_slots.release()
+
+
+@contextmanager
+def pooled_connection():
+    """Borrow a connection from the pool for the duration of the with block."""
+    conn = borrow_connection()
+    try:
+        yield conn
+    finally:
+        return_connection(conn)
+
+
 class Postgres:
-    """Postgres connection session handler."""
+    """Postgres connection session handler.
+
+    Connections are borrowed from a process wide pool, so all query classes share
+    at most PG_POOL_MAX_CONNECTIONS connections. Call close() or use the instance
+    as a context manager to hand the connection back.
+    """
 
     def __init__(self):
-        """Initialize the connection to Postgres database."""
-        conn_string = "host='{host}' dbname='{dbname}' user='{user}' password='{password}'". \
-            format(host=os.getenv('PGBOUNCER_SERVICE_HOST', 'bayesian-pgbouncer'),
-                   dbname=os.getenv('POSTGRESQL_DATABASE', 'coreapi'),
-                   user=os.getenv('POSTGRESQL_USER', 'coreapi'),
-                   password=os.getenv('POSTGRESQL_PASSWORD', 'coreapi'))
-        self.conn = psycopg2.connect(conn_string)
+        """Borrow a connection to Postgres database from the pool."""
+        self.released = True
+        self.conn = borrow_connection()
+        self.released = False
         self.cursor = self.conn.cursor()
 
+    def close(self):
+        """Return the connection to the pool."""
+        if not self.released:
+            self.released = True
+            return_connection(self.conn)
+
+    def __del__(self):
+        """Return the connection of an instance dropped without being closed."""
+        try:
+            self.close()
+        except Exception as e:
+            # The pool may already be gone when the interpreter shuts down
+            logger.debug('Unable to return the Postgres connection: %r', e)
+
+    def __enter__(self):
+        """Enter the runtime context."""
+        return self
+
+    def __exit__(self, *_exc_info):
+        """Return the connection to the pool on exit of the runtime context."""
+        self.close()
+
 
 class ReportHelper:
     """Stack Analyses report helper functions."""
@@ -44,9 +129,8 @@ class ReportHelper:
     def __init__(self):
         """Init method for the Report helper class."""
         self.s3 = S3Helper()
-        self.pg = Postgres()
-        self.conn = self.pg.conn
-        self.cursor = self.pg.cursor
+        # A pooled connection is only borrowed while queries run, see borrowed_connection
+        self.pg = None
         self.unknown_deps_helper = UnknownDepsReportHelper()
         self.sentry_helper = SentryReportHelper()
         self.github_token = os.environ.get('GITHUB_TOKEN')
@@ -66,6 +150,30 @@ class ReportHelper:
 
         self.emr_api = os.getenv('EMR_API', 'http://f8a-emr-deployment:6006')
 
+    @property
+    def conn(self):
+        """Return the connection of the running queries, borrowing one if needed."""
+        if self.pg is None:
+            self.pg = Postgres()
+        return self.pg.conn
+
+    @property
+    def cursor(self):
+        """Return the cursor of the running queries, borrowing a connection if needed."""
+        if self.pg is None:
+            self.pg = Postgres()
+        return self.pg.cursor
+
+    @contextmanager
+    def borrowed_connection(self):
+        """Hand the connection used by the queries of the with block back to the pool."""
+        try:
+            yield
+        finally:
+            pg, self.pg = self.pg, None
+            if pg is not None:
+                pg.close()
+
     def cleanup_tables(self, table_name, column_name, num_days):
         """Cleanup tables on a periodic basis."""
         # Query to delete data
@@ -74,19 +182,20 @@ class ReportHelper:
             sql.Identifier(column_name)
         )
         logger.debug('Starting to clean up "%s" table', table_name)
-        try:
-            # Executing query
-            self.cursor.execute(query, (num_days,))
-        except Exception as e:
-            logger.error("cleanup failed with exception %r", e)
-            self.conn.rollback()
-            return
+        with self.borrowed_connection():
+            try:
+                # Executing query
+                self.cursor.execute(query, (num_days,))
+            except Exception as e:
+                logger.error("cleanup failed with exception %r", e)
+                self.conn.rollback()
+                return
 
-        # Commiting
-        self.conn.commit()
-        # Log the message returned from db cursor
-        logger.info('Cleanup of  "%s" table has completed with status %r', table_name,
-                    self.cursor.statusmessage)
+            # Commiting
+            self.conn.commit()
+            # Log the message returned from db cursor
+            logger.info('Cleanup of  "%s" table has completed with status %r', table_name,
+                        self.cursor.statusmessage)
 
     def cleanup_reference(self, table_name, foreign_key, key, ftable_name, column_name, num_days):
         """Cleanup of tables with foreignkey reference on periodic basis."""
@@ -100,18 +209,19 @@ class ReportHelper:
                             sql.Identifier(column_name)
         )
         logger.debug('Starting to clean up of "%s" table', table_name)
-        try:
-            # Executing query
-            self.cursor.execute(query, (num_days,))
-        except Exception as e:
-            logger.error("cleanup failed with exception %r", e)
-            self.conn.rollback()
-            return
+        with self.borrowed_connection():
+            try:
+                # Executing query
+                self.cursor.execute(query, (num_days,))
+            except Exception as e:
+                logger.error("cleanup failed with exception %r", e)
+                self.conn.rollback()
+                return
 
-        # Commiting
-        self.conn.commit()
-        logger.info('Cleanup of "%s" table has completed with status %r', table_name,
-                    self.cursor.statusmessage)
+            # Commiting
+            self.conn.commit()
+            logger.info('Cleanup of "%s" table has completed with status %r', table_name,
+                        self.cursor.statusmessage)
 
     def cleanup_db_tables(self):
         """Cleanup RDS data tables on a periodic basis."""
@@ -169,10 +279,11 @@ class ReportHelper:
             sql.Identifier('stack_analyses_request'),
             sql.Identifier('submitTime')
         )
-        # Executing Query
-        self.cursor.execute(query.as_string(self.conn) % (start_date, end_date))
-        # Fetching all results
-        rows = self.cursor.fetchall()
+        with self.borrowed_connection():
+            # Executing Query
+            self.cursor.execute(query.as_string(self.conn) % (start_date, end_date))
+            # Fetching all results
+            rows = self.cursor.fetchall()
         # Appending all the stack-ids in a list
         id_list = []
         for row in rows:
@@ -202,10 +313,11 @@ class ReportHelper:
             sql.Identifier('requestJson'), sql.Identifier('stack_analyses_request'),
             sql.Identifier('submitTime')
         )
-        # Executing Query
-        self.cursor.execute(query.as_string(self.conn) % (start_date, end_date))
-        # Fetching all results
-        return self.cursor.fetchall()
+        with self.borrowed_connection():
+            # Executing Query
+            self.cursor.execute(query.as_string(self.conn) % (start_date, end_date))
+            # Fetching all results
+            return self.cursor.fetchall()
 
     def flatten_list(self, alist):
         """Convert a list of lists to a single list."""
@@ -259,14 +371,19 @@ class ReportHelper:
 
         # Get collated user input data
         collated_user_input_obj_key = 'user-input-data/collated-{freq}.json'.format(freq=frequency)
-        collated_user_input = self.s3.read_json_object(bucket_name=self.s3.report_bucket_name,
-                                                       obj_key=collated_user_input_obj_key) or {}
+        # The collated data covers all time, read it one ecosystem at a time
+        collated_user_input = self.s3.iter_json_object(bucket_name=self.s3.report_bucket_name,
+                                                       obj_key=collated_user_input_obj_key)
 
-        for eco in unique_stacks_with_recurrence_count.keys() | collated_user_input.keys():
+        for eco, collated in collated_user_input:
             result.update({eco: {
                 "user_input_stack": dict(
                     Counter(unique_stacks_with_recurrence_count.get(eco)) +
-                    Counter(collated_user_input.get(eco, {}).get('user_input_stack')))
+                    Counter((collated or {}).get('user_input_stack')))
+            }})
+        for eco in unique_stacks_with_recurrence_count.keys() - result.keys():
+            result.update({eco: {
+                "user_input_stack": dict(Counter(unique_stacks_with_recurrence_count.get(eco)))
             }})
 
         # Store user input collated data back to S3
@@ -275,14 +392,14 @@ class ReportHelper:
 
         # Get collated big query data
         collated_big_query_obj_key = 'big-query-data/collated.json'
-        collated_big_query_data = self.s3.read_json_object(bucket_name=self.s3.report_bucket_name,
-                                                           obj_key=collated_big_query_obj_key) or {}
+        collated_big_query_data = self.s3.iter_json_object(bucket_name=self.s3.report_bucket_name,
+                                                           obj_key=collated_big_query_obj_key)
 
-        for eco in collated_big_query_data.keys():
+        for eco, big_query_data in collated_big_query_data:
             if result.get(eco):
-                result[eco]["bigquery_data"] = collated_big_query_data.get(eco)
+                result[eco]["bigquery_data"] = big_query_data
             else:
-                result[eco] = {"bigquery_data": collated_big_query_data.get(eco)}
+                result[eco] = {"bigquery_data": big_query_data}
         return result
 
     def invoke_emr_api(self, bucket_name, ecosystem, data_version, github_repo):
@@ -397,12 +514,21 @@ class ReportHelper:
                               unique_stacks_with_recurrence_count, unique_stacks_with_deps_count,
                               avg_response_time, unknown_deps_ingestion_report):
         """Generate ecosystem specific stack summary."""
-        unique_dep_frequency = self.populate_key_count(self.flatten_list(all_deps[ecosystem]))
+        dep_counts = {ecosystem: self.populate_key_count(self.flatten_list(all_deps[ecosystem]))}
+        return self.get_ecosystem_summary_from_counts(
+            ecosystem, total_stack_requests, dep_counts, unique_stacks_with_recurrence_count,
+            unique_stacks_with_deps_count, avg_response_time, unknown_deps_ingestion_report)
+
+    def get_ecosystem_summary_from_counts(self, ecosystem, total_stack_requests, dep_counts,
+                                          unique_stacks_with_recurrence_count,
+                                          unique_stacks_with_deps_count, avg_response_time,
+                                          unknown_deps_ingestion_report):
+        """Generate ecosystem specific stack summary from already aggregated frequencies."""
+        unique_dep_frequency = dict(dep_counts[ecosystem])
         rectify_latest_version(unique_dep_frequency, ecosystem, True)
         return {
             'stack_requests_count': total_stack_requests[ecosystem],
-            'unique_dependencies_with_frequency':
-                self.populate_key_count(self.flatten_list(all_deps[ecosystem])),
+            'unique_dependencies_with_frequency': unique_dep_frequency,
             'unique_unknown_dependencies_with_frequency': unique_dep_frequency,
             'unique_stacks_with_frequency': unique_stacks_with_recurrence_count[ecosystem],
             'unique_stacks_with_deps_count': unique_stacks_with_deps_count[ecosystem],
@@ -410,8 +536,7 @@ class ReportHelper:
             'trending': {
                 'top_stacks':
                     self.get_trending(unique_stacks_with_recurrence_count[ecosystem], 3),
-                'top_deps': self.get_trending(
-                    self.populate_key_count(self.flatten_list(all_deps[ecosystem])), 5),
+                'top_deps': self.get_trending(unique_dep_frequency, 5),
             },
             'previously_unknown_dependencies': unknown_deps_ingestion_report[ecosystem]
         }
@@ -613,7 +738,6 @@ class ReportHelper:
         # convert the elements of the id_list to sql.Literal
         # so that the SQL query statement contains the IDs within quotes
         id_list = list(map(sql.Literal, id_list))
-        ids = sql.SQL(', ').join(id_list).as_string(self.conn)
 
         for worker in worker_list:
             # Selecting only versions = v1
@@ -624,9 +748,12 @@ class ReportHelper:
                 sql.Identifier('task_result')
             )
 
-            self.cursor.execute(query.as_string(self.conn) % (ids, worker, 'v1'))
-            data = json.dumps(self.cursor.fetchall())
-            if not self.cursor.rowcount:
+            with self.borrowed_connection():
+                ids = sql.SQL(', ').join(id_list).as_string(self.conn)
+                self.cursor.execute(query.as_string(self.conn) % (ids, worker, 'v1'))
+                data = json.dumps(self.cursor.fetchall())
+                found = self.cursor.rowcount
+            if not found:
                 logger.info('No Data has been found for v1 stack analyses.')
                 return result_interim
 
@@ -654,8 +781,9 @@ class ReportHelper:
                         ' AND AN.VERSION_ID = VR.ID AND VR.PACKAGE_ID = PK.ID'
                         ' AND PK.ECOSYSTEM_ID = EC.ID')
 
-        self.cursor.execute(query.as_string(self.conn) % (start_date, end_date))
-        data = json.dumps(self.cursor.fetchall())
+        with self.borrowed_connection():
+            self.cursor.execute(query.as_string(self.conn) % (start_date, end_date))
+            data = json.dumps(self.cursor.fetchall())
         result['EPV_DATA'] = data
         return self.normalize_ingestion_data(start_date, end_date, result, frequency)
 
@@ -846,6 +974,9 @@ class ReportHelper:
         # Call the function to get the availability of latest node
         logger.info("Checking if latest node exists in graph")
         template, missing_latest_nodes = self.check_latest_node(latest_epvs, template)
+        logger.info("Gremlin call statistics: %r", gremlin_client.stats())
+        template['ingestion_summary']['gremlin_batches'] = gremlin_batcher.stats()
+        template['ingestion_summary']['latest_version_cache'] = latest_version_cache.stats()
 
         # Saving the final report in the relevant S3 bucket
         try:
@@ -1,14 +1,323 @@
 """Various utility functions related to S3 storage."""
 
+import gzip
 import json
 import os
 import logging
+import threading
+import zlib
 import boto3
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 from werkzeug.exceptions import BadRequest
 
 logger = logging.getLogger(__file__)
 
+# Optional, faster JSON backend and zstd compression
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+# Incremental JSON parser used to stream large objects
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
+# How reports are serialised: 'pretty' (indented JSON), 'compact', 'gzip' or 'zstd'.
+# The compressed encodings write compact JSON and set the ContentEncoding of the object.
+REPORT_JSON_ENCODING = os.getenv('REPORT_JSON_ENCODING', 'pretty')
+# 'json' or 'orjson', the latter is used only when it is installed.
+REPORT_JSON_BACKEND = os.getenv('REPORT_JSON_BACKEND', 'json')
+
+# Streamed uploads are sent in parts of this many bytes (S3 requires at least 5 MiB),
+# by up to S3_UPLOAD_WORKERS threads.
+S3_MULTIPART_PART_SIZE = max(5 * 1024 * 1024,
+                             int(os.getenv('S3_MULTIPART_PART_SIZE', 8 * 1024 * 1024)))
+S3_UPLOAD_WORKERS = int(os.getenv('S3_UPLOAD_WORKERS', 4))
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# boto3 clients are thread-safe, while creating one loads the botocore service models.
+# They are therefore created once per credential set and shared by all S3Helper objects.
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+
+
+def get_s3_client(region_name, aws_access_key_id, aws_secret_access_key):
+    """Return the shared s3 client for the given credentials."""
+    key = (region_name, aws_access_key_id, aws_secret_access_key)
+    client = _s3_clients.get(key)
+    if client is None:
+        with _s3_clients_lock:
+            client = _s3_clients.get(key)
+            if client is None:
+                # The default boto3 session is not thread-safe, use a dedicated one
+                client = boto3.session.Session().client(
+                    's3', region_name=region_name, aws_access_key_id=aws_access_key_id,
+                    aws_secret_access_key=aws_secret_access_key)
+                _s3_clients[key] = client
+    return client
+
+
+def _dumps(content, pretty):
+    """Serialise the content to JSON bytes."""
+    if REPORT_JSON_BACKEND == 'orjson' and orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+        try:
+            return orjson.dumps(content, option=option)
+        except TypeError as e:
+            logger.warning('orjson could not serialise the content, using json: %r', e)
+    if pretty:
+        return json.dumps(content, indent=2).encode('utf-8')
+    return json.dumps(content, separators=(',', ':')).encode('utf-8')
+
+
+def encode_json(content, encoding=None):
+    """Encode the content as JSON.
+
+    :param content: JSON serialisable content
+    :param encoding: str, one of 'pretty', 'compact', 'gzip' or 'zstd'
+    :return tuple, encoded bytes and the ContentEncoding to be stored with them or None
+    """
+    encoding = encoding or REPORT_JSON_ENCODING
+    if encoding == 'zstd' and zstandard is None:
+        logger.warning('zstandard is not installed, using gzip for the report')
+        encoding = 'gzip'
+    body = _dumps(content, pretty=encoding == 'pretty')
+    if encoding == 'gzip':
+        return gzip.compress(body), 'gzip'
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor().compress(body), 'zstd'
+    if encoding not in ('pretty', 'compact'):
+        raise ValueError('Unknown report encoding {}'.format(encoding))
+    return body, None
+
+
+def decode_json(body, content_encoding=None):
+    """Decode JSON written by encode_json, detecting the compression used."""
+    encodings = [e.strip() for e in (content_encoding or '').split(',')]
+    if 'gzip' in encodings or body[:2] == _GZIP_MAGIC:
+        body = gzip.decompress(body)
+    elif 'zstd' in encodings or body[:4] == _ZSTD_MAGIC:
+        if zstandard is None:
+            raise ValueError('zstandard is needed to read zstd compressed reports')
+        body = zstandard.ZstdDecompressor().decompress(body)
+    if REPORT_JSON_BACKEND == 'orjson' and orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body.decode('utf-8'))
+
+
+class _PeekedStream:
+    """Readable stream giving back the bytes peeked from its beginning first."""
+
+    def __init__(self, head, stream):
+        """Wrap the stream, head are the bytes already read from it."""
+        self.head = head
+        self.stream = stream
+
+    def read(self, size=-1):
+        """Read up to size bytes."""
+        if self.head:
+            if size is None or size < 0:
+                data, self.head = self.head + self.stream.read(), b''
+            else:
+                data, self.head = self.head[:size], self.head[size:]
+            return data
+        return self.stream.read(size)
+
+
+def _skip_json_value(events):
+    """Consume the parser events of one value without building it."""
+    depth = 0
+    for _, event, _ in events:
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+        if depth == 0:
+            return
+
+
+def _iter_json_pairs(stream, keys):
+    """Yield the top level (key, value) pairs of the keys asked for from a JSON object."""
+    keys = set(keys)
+    events = ijson.parse(stream, use_float=True)
+    for prefix, event, key in events:
+        if prefix != '' or event != 'map_key':
+            continue
+        if key not in keys:
+            _skip_json_value(events)
+            continue
+        builder = ObjectBuilder()
+        depth = 0
+        for _, event, value in events:
+            builder.event(event, value)
+            if event in ('start_map', 'start_array'):
+                depth += 1
+            elif event in ('end_map', 'end_array'):
+                depth -= 1
+            if depth == 0:
+                break
+        yield key, builder.value
+        keys.discard(key)
+        if not keys:
+            return
+
+
+def open_json_stream(body, content_encoding=None):
+    """Return a readable stream of the JSON in the body, decompressing it on the fly."""
+    encodings = [e.strip() for e in (content_encoding or '').split(',')]
+    head = body.read(4)
+    stream = _PeekedStream(head, body)
+    if 'gzip' in encodings or head[:2] == _GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=stream)
+    if 'zstd' in encodings or head[:4] == _ZSTD_MAGIC:
+        if zstandard is None:
+            raise ValueError('zstandard is needed to read zstd compressed reports')
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    return stream
+
+
+class MultipartUploadWriter:
+    """File like writer streaming its content to an S3 object with a multipart upload.
+
+    Parts are uploaded in parallel while the content is being written. At most
+    S3_UPLOAD_WORKERS parts are buffered at a time, so the memory used does not depend
+    on the size of the object. Content smaller than one part is stored with a single
+    put. Use it as a context manager, the upload is aborted when an exception is raised.
+    """
+
+    def __init__(self, client, bucket_name, obj_key, encoding=None,
+                 part_size=S3_MULTIPART_PART_SIZE, workers=S3_UPLOAD_WORKERS):
+        """Prepare the upload, see encode_json for the encodings."""
+        self.client = client
+        self.bucket_name = bucket_name
+        self.obj_key = obj_key
+        self.encoding = encoding or REPORT_JSON_ENCODING
+        if self.encoding == 'zstd' and zstandard is None:
+            logger.warning('zstandard is not installed, using gzip for the report')
+            self.encoding = 'gzip'
+        if self.encoding == 'gzip':
+            self._compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+            self.content_encoding = 'gzip'
+        elif self.encoding == 'zstd':
+            self._compressor = zstandard.ZstdCompressor().compressobj()
+            self.content_encoding = 'zstd'
+        elif self.encoding in ('pretty', 'compact'):
+            self._compressor = None
+            self.content_encoding = None
+        else:
+            raise ValueError('Unknown report encoding {}'.format(self.encoding))
+        self.part_size = part_size
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers)
+
+    def _object_args(self):
+        """Return the arguments describing the stored object."""
+        args = {'Bucket': self.bucket_name, 'Key': self.obj_key,
+                'ContentType': 'application/json'}
+        if self.content_encoding:
+            args['ContentEncoding'] = self.content_encoding
+        return args
+
+    def _upload_part(self, part_number, data):
+        """Upload one part, freeing its slot once done."""
+        try:
+            resp = self.client.upload_part(Bucket=self.bucket_name, Key=self.obj_key,
+                                           UploadId=self._upload_id, PartNumber=part_number,
+                                           Body=data)
+            return {'PartNumber': part_number, 'ETag': resp['ETag']}
+        finally:
+            self._slots.release()
+
+    def _submit_part(self, data):
+        """Queue the data as the next part, blocking while all workers are busy."""
+        if self._upload_id is None:
+            self._upload_id = self.client.create_multipart_upload(
+                **self._object_args())['UploadId']
+        self._slots.acquire()
+        self._parts.append(self._executor.submit(self._upload_part, len(self._parts) + 1,
+                                                 bytes(data)))
+
+    def write(self, data):
+        """Write str or bytes to the object."""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            self._submit_part(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+
+    def write_json(self, content, pretty=None):
+        """Encode the content as JSON incrementally and write it to the object."""
+        if pretty is None:
+            pretty = self.encoding == 'pretty'
+        encoder = json.JSONEncoder(indent=2) if pretty else \
+            json.JSONEncoder(separators=(',', ':'))
+        chunks = []
+        size = 0
+        for chunk in encoder.iterencode(content):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= 64 * 1024:
+                self.write(''.join(chunks))
+                chunks = []
+                size = 0
+        self.write(''.join(chunks))
+
+    def close(self):
+        """Upload the remaining content and complete the upload."""
+        if self._compressor is not None:
+            self._buffer += self._compressor.flush()
+            self._compressor = None
+        try:
+            if self._upload_id is None:
+                self.client.put_object(Body=bytes(self._buffer), **self._object_args())
+            else:
+                if self._buffer:
+                    self._submit_part(self._buffer)
+                parts = [part.result() for part in self._parts]
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket_name, Key=self.obj_key, UploadId=self._upload_id,
+                    MultipartUpload={'Parts': parts})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            self._executor.shutdown()
+
+    def abort(self):
+        """Abort the upload, dropping the parts uploaded so far."""
+        self._executor.shutdown()
+        if self._upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.obj_key,
+                                               UploadId=self._upload_id)
+            self._upload_id = None
+
+    def __enter__(self):
+        """Return the writer."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Complete the upload, or abort it when an exception was raised."""
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
 
 class S3Helper:
     """Helper class for storing reports to S3."""
@@ -53,49 +362,58 @@ class S3Helper:
         self.s3_endpoint_url = os.environ.get('S3_ENDPOINT_URL') or 'http://localhost'
 
     def s3_client(self, bucket_name):
-        """Provide s3 client for each bucket."""
+        """Provide the shared s3 client for each bucket."""
         if bucket_name == os.environ.get('REPORT_BUCKET_NAME'):
-            s3 = boto3.resource('s3', region_name=self.region_name,
-                                aws_access_key_id=self.aws_s3_access_key_report_bucket,
-                                aws_secret_access_key=self.aws_s3_secret_access_key_report_bucket)
+            credentials = (self.aws_s3_access_key_report_bucket,
+                           self.aws_s3_secret_access_key_report_bucket)
         elif bucket_name == os.getenv('PYPI_MODEL_BUCKET'):
-            s3 = boto3.resource('s3', region_name=self.region_name,
-                                aws_access_key_id=self.aws_s3_access_key_pypi_bucket,
-                                aws_secret_access_key=self.aws_s3_secret_access_key_pypi_bucket)
+            credentials = (self.aws_s3_access_key_pypi_bucket,
+                           self.aws_s3_secret_access_key_pypi_bucket)
         elif bucket_name == os.getenv('GOLANG_MODEL_BUCKET'):
-            s3 = boto3.resource('s3', region_name=self.region_name,
-                                aws_access_key_id=self.aws_s3_access_key_golang_bucket,
-                                aws_secret_access_key=self.aws_s3_secret_access_key_golang_bucket)
+            credentials = (self.aws_s3_access_key_golang_bucket,
+                           self.aws_s3_secret_access_key_golang_bucket)
         elif bucket_name == os.getenv('MAVEN_MODEL_BUCKET'):
-            s3 = boto3.resource('s3', region_name=self.region_name,
-                                aws_access_key_id=self.aws_s3_access_key_mvn_bucket,
-                                aws_secret_access_key=self.aws_s3_secret_access_key_mvn_bucket)
+            credentials = (self.aws_s3_access_key_mvn_bucket,
+                           self.aws_s3_secret_access_key_mvn_bucket)
         elif bucket_name == os.getenv('NPM_MODEL_BUCKET'):
-            s3 = boto3.resource('s3', region_name=self.region_name,
-                                aws_access_key_id=self.aws_s3_access_key_npm_bucket,
-                                aws_secret_access_key=self.aws_s3_secret_access_key_npm_bucket)
+            credentials = (self.aws_s3_access_key_npm_bucket,
+                           self.aws_s3_secret_access_key_npm_bucket)
         else:
-            s3 = boto3.resource('s3', region_name=self.region_name,
-                                aws_access_key_id=self.aws_s3_access_key,
-                                aws_secret_access_key=self.aws_s3_secret_access_key)
-        return s3
+            credentials = (self.aws_s3_access_key, self.aws_s3_secret_access_key)
+        return get_s3_client(self.region_name, *credentials)
 
-    def store_json_content(self, content, bucket_name, obj_key):
-        """Store the report content to the S3 storage."""
+    def store_json_content(self, content, bucket_name, obj_key, encoding=None):
+        """Store the report content to the S3 storage.
+
+        The encoding defaults to REPORT_JSON_ENCODING, see encode_json.
+        """
         s3 = self.s3_client(bucket_name)
         try:
             logger.info('Storing the report into the S3 file %s' % obj_key)
-            s3.Object(bucket_name, obj_key).put(
-                Body=json.dumps(content, indent=2).encode('utf-8'))
+            body, content_encoding = encode_json(content, encoding)
+            extra_args = {'ContentEncoding': content_encoding} if content_encoding else {}
+            s3.put_object(Bucket=bucket_name, Key=obj_key, Body=body,
+                          ContentType='application/json', **extra_args)
         except Exception as e:
             logger.exception('%r' % e)
 
+    def open_json_writer(self, bucket_name, obj_key, encoding=None):
+        """Open a streaming writer for a report, see MultipartUploadWriter."""
+        return MultipartUploadWriter(self.s3_client(bucket_name), bucket_name, obj_key,
+                                     encoding=encoding)
+
+    def store_json_stream(self, content, bucket_name, obj_key, encoding=None):
+        """Store the report content encoding it incrementally with a multipart upload."""
+        logger.info('Streaming the report into the S3 file %s' % obj_key)
+        with self.open_json_writer(bucket_name, obj_key, encoding) as writer:
+            writer.write_json(content)
+
     def read_json_object(self, bucket_name, obj_key):
         """Get the report json object found on the S3 bucket."""
         s3 = self.s3_client(bucket_name)
         try:
-            obj = s3.Object(bucket_name, obj_key)
-            result = json.loads(obj.get()['Body'].read().decode('utf-8'))
+            obj = s3.get_object(Bucket=bucket_name, Key=obj_key)
+            result = decode_json(obj['Body'].read(), obj.get('ContentEncoding'))
             return result
         except ClientError as e:
             if e.response['Error']['Code'] == 'NoSuchKey':
@@ -106,16 +424,68 @@ class S3Helper:
                 logger.exception('%r' % e)
             return None
 
+    def iter_json_object(self, bucket_name, obj_key, keys=None):
+        """Iterate over the top level (key, value) pairs of a JSON object stored on S3.
+
+        The object is parsed incrementally from the body stream, so only one value is
+        held in memory at a time. Values of keys not asked for are skipped while parsing
+        without being built, and parsing stops once all the asked keys were found.
+
+        :param keys: iterable, top level keys to return, all keys when None
+        """
+        yield from self._iter_json(bucket_name, obj_key, pairs=True,
+                                   keys=None if keys is None else set(keys))
+
+    def iter_json_array(self, bucket_name, obj_key):
+        """Iterate over the items of a JSON array stored on S3, see iter_json_object."""
+        yield from self._iter_json(bucket_name, obj_key, pairs=False)
+
+    def _iter_json(self, bucket_name, obj_key, pairs, keys=None):
+        """Parse the object incrementally, falling back to reading it when ijson is missing."""
+        s3 = self.s3_client(bucket_name)
+        try:
+            obj = s3.get_object(Bucket=bucket_name, Key=obj_key)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                logger.exception('No Such Key %s exists' % obj_key)
+            elif e.response['Error']['Code'] == 'NoSuchBucket':
+                logger.exception('ERROR - No Such Bucket %s exists' % bucket_name)
+            else:
+                logger.exception('%r' % e)
+            return
+        stream = open_json_stream(obj['Body'], obj.get('ContentEncoding'))
+        if ijson is not None:
+            if pairs and keys is not None:
+                yield from _iter_json_pairs(stream, keys)
+            elif pairs:
+                yield from ijson.kvitems(stream, '', use_float=True)
+            else:
+                yield from ijson.items(stream, 'item', use_float=True)
+        else:
+            logger.warning('ijson is not installed, reading the whole %s' % obj_key)
+            data = json.load(stream)
+            if pairs:
+                yield from ((key, value) for key, value in data.items()
+                            if keys is None or key in keys)
+            else:
+                yield from data
+
     def list_objects(self, bucket_name, frequency):
         """Fetch the list of objects found on the S3 bucket."""
-        s3 = self.s3_client(bucket_name)
         prefix = '{dp}/{freq}'.format(dp=self.deployment_prefix, freq=frequency)
-        res = {'objects': []}
+        return {'objects': self.list_keys(bucket_name, prefix)}
+
+    def list_keys(self, bucket_name, prefix):
+        """Fetch the keys of the objects found under the prefix, in lexicographical order."""
+        s3 = self.s3_client(bucket_name)
+        keys = []
 
         try:
-            for obj in s3.Bucket(bucket_name).objects.filter(Prefix=prefix):
-                if os.path.basename(obj.key) != '':
-                    res['objects'].append(obj.key)
+            paginator = s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+                for obj in page.get('Contents', []):
+                    if os.path.basename(obj['Key']) != '':
+                        keys.append(obj['Key'])
         except ClientError as e:
             if e.response['Error']['Code'] == 'NoSuchKey':
                 logger.exception('ERROR - No Such Key %s exists' % prefix)
@@ -124,7 +494,16 @@ class S3Helper:
             else:
                 logger.exception('%r' % e)
 
-        return res
+        return keys
+
+    def delete_objects(self, bucket_name, obj_keys):
+        """Delete the objects from the S3 bucket."""
+        s3 = self.s3_client(bucket_name)
+        # A delete request takes at most 1000 keys
+        for start in range(0, len(obj_keys), 1000):
+            s3.delete_objects(Bucket=bucket_name, Delete={
+                'Objects': [{'Key': key} for key in obj_keys[start:start + 1000]],
+                'Quiet': True})
 
     def store_file_object(self, file_path, bucket_name, file_name):
         """Store the manifest file to the S3 storage."""
@@ -137,6 +516,6 @@ class S3Helper:
             logger.info(
                 'Storing the manifest file {0} into the S3 bucket {1}.'.format(
                     file_name, bucket_name))
-            s3.meta.client.upload_file(file_path, bucket_name, file_name)
+            s3.upload_file(file_path, bucket_name, file_name)
         except ClientError as e:
             logger.exception('%r' % e)
@@ -0,0 +1,59 @@
+"""Persistent cache for the parsed latest events of Sentry issues."""
+
+import json
+import os
+import time
+
+from f8a_report.helpers.cache_helper import SQLiteCache, cache_path
+
+SENTRY_EVENT_CACHE_PATH = os.getenv('SENTRY_EVENT_CACHE_PATH',
+                                    cache_path('sentry_event_cache.db'))
+# Days after which the events of issues that are not seen any more are dropped.
+SENTRY_EVENT_CACHE_DAYS = int(os.getenv('SENTRY_EVENT_CACHE_DAYS', 30))
+
+
+class SentryEventCache(SQLiteCache):
+    """Cache the parsed latest event of each Sentry issue in SQLite.
+
+    An entry is keyed by the issue id and the time the issue was last seen, which
+    only changes when the issue gets a new event.
+    """
+
+    description = 'Sentry event cache'
+    schema = ('CREATE TABLE IF NOT EXISTS sentry_event (issue_id TEXT PRIMARY KEY, '
+              'last_seen TEXT, events TEXT, stored_at REAL)')
+
+    def __init__(self, path=SENTRY_EVENT_CACHE_PATH, days=SENTRY_EVENT_CACHE_DAYS):
+        """Set up the cache, the database is opened by the first call."""
+        super().__init__(path)
+        self.days = days
+
+    def get(self, issue_id, last_seen):
+        """Return the cached events of the issue, None when it has a newer event."""
+        if not last_seen:
+            return None
+        with self._lock:
+            if self._open() is None:
+                return None
+            row = self._fetchone('SELECT events FROM sentry_event WHERE issue_id = ? '
+                                 'AND last_seen = ?', (issue_id, last_seen))
+            self._stats['hits' if row else 'misses'] += 1
+        return json.loads(row[0]) if row else None
+
+    def set(self, issue_id, last_seen, events):
+        """Store the events of the issue, replacing the ones of its older event."""
+        if not last_seen:
+            return
+        with self._lock:
+            self._write('INSERT OR REPLACE INTO sentry_event VALUES (?, ?, ?, ?)',
+                        [(issue_id, last_seen, json.dumps(events), time.time())])
+
+    def prune(self):
+        """Drop the events of the issues that were not stored for the retention period."""
+        with self._lock:
+            self._write('DELETE FROM sentry_event WHERE stored_at < ?',
+                        [(time.time() - self.days * 24 * 60 * 60,)])
+
+
+# Shared by the daily Sentry reports, so unchanged issues are parsed only once.
+sentry_event_cache = SentryEventCache()
@@ -1,13 +1,23 @@
 """Various functions related to sentry reporting."""
 
+import itertools
 import os
 import logging
 import requests as requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from f8a_report.helpers.s3_helper import S3Helper
+from f8a_report.helpers.sentry_event_cache import sentry_event_cache
 from datetime import datetime as dt
 
 logger = logging.getLogger(__file__)
 
+# Number of issue events fetched from Sentry concurrently.
+SENTRY_EVENT_WORKERS = int(os.getenv('SENTRY_EVENT_WORKERS', 8))
+# Maximum number of issues in the daily report, 0 for all of them.
+SENTRY_MAX_ISSUES = int(os.getenv('SENTRY_MAX_ISSUES', 0))
+
 
 class SentryReportHelper:
     """Various functions related to sentry reporting."""
@@ -20,57 +30,86 @@ class SentryReportHelper:
             'SENTRY_API_ISSUES', '/api/0/projects/sentry/fabric8-analytics-production/issues/')
         self.sentry_api_tags = self.sentry_url + os.getenv('SENTRY_API_TAGS', '/api/0/issues/')
         self.sentry_token = os.getenv('SENTRY_AUTH_TOKEN', '')
+        # Keep the connections to Sentry alive across the issue and event calls
+        self.session = requests.Session()
+        self.session.mount(self.sentry_url, HTTPAdapter(pool_maxsize=SENTRY_EVENT_WORKERS))
 
     def retrieve_sentry_logs(self, start_date, end_date):
         """Retrieve results for selected worker from RDB."""
         result = {}
-        try:
-            # Invoke Sentry API to run the error collection
-            auth = 'Bearer {token}'.format(token=self.sentry_token)
-            resp = requests.get(url=self.sentry_api_issues + '?statsPeriod=24h',
-                                headers={"Authorization": auth})
-            # Checking for status code
-            # If status is not success, log it as an error
-            if resp.status_code == 200:
-                logger.info('Successfully invoked Sentry API')
-                # associate the retrieved data to result
-                result = self.normalize_sentry_data(start_date, end_date, resp.json())
-            else:
-                logger.error('Error received from Sentry API \n {resp}'.format(resp=resp.json()))
-        except requests.exceptions.RequestException as e:
-            logger.error('Unable to invoke Sentry API. Reason: %r' % e)
-        except requests.exceptions.Timeout as e:
-            logger.error('Timeout occured while invoking Sentry API. Reason: %r' % e)
+        pages = self.iter_sentry_issue_pages()
+        # The first page tells whether Sentry could be queried at all
+        first_page = next(pages, None)
+        if first_page is not None:
+            # Later pages are fetched while the events of the previous ones are
+            # being retrieved
+            issues = (item for page in itertools.chain([first_page], pages) for item in page)
+            result = self.normalize_sentry_data(start_date, end_date, issues)
         return result
 
+    def iter_sentry_issue_pages(self, max_issues=SENTRY_MAX_ISSUES):
+        """Yield the pages of issues of the last 24 hours, following the Sentry cursor.
+
+        :param max_issues: stop after this many issues, 0 for no limit
+        """
+        auth = 'Bearer {token}'.format(token=self.sentry_token)
+        url = self.sentry_api_issues + '?statsPeriod=24h'
+        count = 0
+        while url:
+            try:
+                # Invoke Sentry API to run the error collection
+                resp = self.session.get(url=url, headers={"Authorization": auth})
+                # Checking for status code
+                # If status is not success, log it as an error
+                if resp.status_code != 200:
+                    logger.error('Error received from Sentry API \n {resp}'.format(
+                        resp=resp.json()))
+                    return
+                logger.info('Successfully invoked Sentry API')
+                issues = resp.json()
+            except requests.exceptions.Timeout as e:
+                logger.error('Timeout occured while invoking Sentry API. Reason: %r' % e)
+                return
+            except requests.exceptions.RequestException as e:
+                logger.error('Unable to invoke Sentry API. Reason: %r' % e)
+                return
+
+            if max_issues:
+                issues = issues[:max_issues - count]
+            count += len(issues)
+            yield issues
+
+            if max_issues and count >= max_issues:
+                logger.info('Reached the limit of {} Sentry issues'.format(max_issues))
+                return
+            # Sentry always sends a next cursor, its results attribute tells if it has any
+            next_page = resp.links.get('next', {})
+            url = next_page.get('url') if next_page.get('results') == 'true' else None
+
     def normalize_sentry_data(self, start_date, end_date, errorlogs):
-        """Retrieve results for selected worker from RDB."""
+        """Retrieve results for selected worker from RDB.
+
+        :param errorlogs: iterable of Sentry issues, consumed as their events are fetched
+        """
         report_type = 'sentry-error-data'
         report_name = dt.strptime(end_date, '%Y-%m-%d').strftime('%Y-%m-%d')
         result = {
             "error_report": {}
         }
-        # Iterating all the error logs
+        # Fetching the latest event of the issues concurrently as they come in, the
+        # errors of each call are handled by retrieve_events itself. The issues are
+        # added to the report in their order, with a bounded number in flight.
+        pending = deque()
         try:
-            for item in errorlogs:
-                errors = {}
-                events = self.retrieve_events(item['id'])
-                errors['id'] = item['id']
-                errors['last_seen'] = item['lastSeen']
-                errors[events['pods_impacted']] = item['metadata']['type'] + ": " + \
-                    item['metadata']['value'] if item['metadata'].get('type')\
-                    else item['metadata']['title']
-                errors['stacktrace'] = events['stacktrace']
-                # Detecting the endpoint services
-                server_name = "-".join(events['pods_impacted'].split("-")[:-2])
-                result['error_report'][server_name] = result['error_report'][server_name] \
-                    if result['error_report'].get(server_name) else {}
-                # Calculating total errors
-                result['error_report'][server_name]['total_errors'] = \
-                    result.get('error_report').get(server_name).get('total_errors', 0) + 1
-                if not result['error_report'][server_name].get('errors'):
-                    result['error_report'][server_name]['errors'] = []
-                result['error_report'][server_name]['errors'].append(errors)
+            with ThreadPoolExecutor(max_workers=SENTRY_EVENT_WORKERS) as executor:
+                for item in errorlogs:
+                    event = executor.submit(self.retrieve_events, item['id'],
+                                            item.get('lastSeen')) if 'id' in item else None
+                    pending.append((item, event))
+                    if len(pending) > SENTRY_EVENT_WORKERS * 2:
+                        self._add_error(result, *pending.popleft())
+                while pending:
+                    self._add_error(result, *pending.popleft())
         except KeyError as e:
             logger.error('Key not found while parsing. Reason: %r' % e)
             # Saving the final report in the relevant S3 bucket
@@ -84,18 +123,50 @@ class SentryReportHelper:
         except Exception as e:
             logger.exception('Unable to store the report on S3. Reason: %r' % e)
 
+        sentry_event_cache.prune()
+        logger.info('Sentry event cache: {}'.format(sentry_event_cache.stats()))
         return result
 
-    def retrieve_events(self, issue_id):
-        """Retrieve results for issue events."""
+    @staticmethod
+    def _add_error(result, item, event):
+        """Add the issue with its latest event to the report."""
+        errors = {}
+        events = event.result() if event else {}
+        errors['id'] = item['id']
+        errors['last_seen'] = item['lastSeen']
+        errors[events['pods_impacted']] = item['metadata']['type'] + ": " + \
+            item['metadata']['value'] if item['metadata'].get('type')\
+            else item['metadata']['title']
+        errors['stacktrace'] = events['stacktrace']
+        # Detecting the endpoint services
+        server_name = "-".join(events['pods_impacted'].split("-")[:-2])
+        result['error_report'][server_name] = result['error_report'][server_name] \
+            if result['error_report'].get(server_name) else {}
+        # Calculating total errors
+        result['error_report'][server_name]['total_errors'] = \
+            result.get('error_report').get(server_name).get('total_errors', 0) + 1
+        if not result['error_report'][server_name].get('errors'):
+            result['error_report'][server_name]['errors'] = []
+        result['error_report'][server_name]['errors'].append(errors)
+
+    def retrieve_events(self, issue_id, last_seen=None):
+        """Retrieve results for issue events.
+
+        The parsed events are cached by issue and the time it was last seen, only
+        issues with a new event are fetched again.
+        """
+        cached = sentry_event_cache.get(issue_id, last_seen)
+        if cached is not None:
+            return cached
+
         events = {'stacktrace': ''}
         output = {}
 
         try:
             # Invoke Sentry API to run the event collection
             auth = 'Bearer {token}'.format(token=self.sentry_token)
-            resp = requests.get(url=self.sentry_api_tags + issue_id + '/events/latest/',
-                                headers={"Authorization": auth})
+            resp = self.session.get(url=self.sentry_api_tags + issue_id + '/events/latest/',
+                                    headers={"Authorization": auth})
             # Check for status code
             # If status is not success, log it as an error
             if resp.status_code == 200:
@@ -137,6 +208,9 @@ class SentryReportHelper:
             logger.error('Index not found while parsing. Reason: %r' % e)
         except NameError as e:
             logger.error('Name not found while parsing. Reason: %r' % e)
+        else:
+            if 'pods_impacted' in events:
+                sentry_event_cache.set(issue_id, last_seen, events)
         return events
 
 
@@ -0,0 +1,23 @@
+"""Convert the NPM package details file into the sharded layout."""
+
+import logging
+import os
+from f8a_report.helpers.npm_metadata import migrate_to_shards
+from f8a_report.helpers.s3_helper import S3Helper
+
+logger = logging.getLogger(__file__)
+
+
+def main():
+    """Store the NPM package details in shards, the existing file is left in place."""
+    bucket_name = os.getenv('NPM_MODEL_BUCKET')
+    try:
+        index = migrate_to_shards(S3Helper(), bucket_name)
+        logger.info("Migrated the NPM package details into %d shards", len(index['shards']))
+    except Exception as e:
+        logger.exception("Exception encountered when migrating the NPM package details")
+        raise e
+
+
+if __name__ == '__main__':
+    main()
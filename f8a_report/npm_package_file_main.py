@@ -0,0 +1,27 @@
+"""Rebuild the NPM package details file from its shards."""
+
+import logging
+import os
+from f8a_report.helpers.npm_metadata import NPM_PACKAGE_SHARD_INDEX, write_package_file
+from f8a_report.helpers.s3_helper import S3Helper
+
+logger = logging.getLogger(__file__)
+
+
+def main():
+    """Write the NPM package details file for the readers not moved to the shards yet."""
+    bucket_name = os.getenv('NPM_MODEL_BUCKET')
+    s3Helper = S3Helper()
+    try:
+        if not s3Helper.list_keys(bucket_name, NPM_PACKAGE_SHARD_INDEX):
+            logger.info("The NPM package details are not sharded, nothing to rebuild")
+            return
+        write_package_file(s3Helper, bucket_name, s3Helper.read_json_object(
+            bucket_name=bucket_name, obj_key=NPM_PACKAGE_SHARD_INDEX))
+    except Exception as e:
+        logger.exception("Exception encountered when rebuilding the NPM package details file")
+        raise e
+
+
+if __name__ == '__main__':
+    main()
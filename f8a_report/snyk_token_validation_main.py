@@ -1,14 +1,25 @@
 """Snyk Token Validation."""
 
+from concurrent.futures import ThreadPoolExecutor
 from f8a_report.helpers.db_gateway import TokenValidationQueries
 from f8a_utils.user_token_utils import decrypt_api_token, is_snyk_token_valid
 import logging
 import requests
 import tenacity
+import threading
+import time
 import os
 
 logger = logging.getLogger(__file__)
 
+# Number of tokens being validated with Snyk at the same time.
+SNYK_VALIDATION_WORKERS = int(os.environ.get("SNYK_VALIDATION_WORKERS", 8))
+# Maximum number of validation requests sent to Snyk per second, 0 for no limit.
+SNYK_VALIDATION_RATE = float(os.environ.get("SNYK_VALIDATION_RATE", 25))
+SNYK_VALIDATION_RETRIES = int(os.environ.get("SNYK_VALIDATION_RETRIES", 3))
+# Days over which all the registered tokens are revalidated, 1 validates all of them daily.
+SNYK_VALIDATION_WINDOW_DAYS = int(os.environ.get("SNYK_VALIDATION_WINDOW_DAYS", 1))
+
 _USER_CACHE_API_URL = "http://{host}:{port}/internal/ingestions/refresh_user_cache".format(
     host=os.environ.get("CACHE_SERVICE_HOST", "bayesian-jobs"),
     port=os.environ.get("CACHE_SERVICE_PORT", "34000"),)
@@ -16,22 +27,80 @@ _USER_CACHE_API_URL = "http://{host}:{port}/internal/ingestions/refresh_user_cac
 
 def main():
     """Snyk Token Validation."""
-    user_to_tokens = TokenValidationQueries().get_registered_user_tokens()
-    unregistered_users = call_snyk_api(user_to_tokens)
-    TokenValidationQueries().update_users_to_unregistered(unregistered_users)
+    # Connection is handed back to the pool while tokens are being validated.
+    with TokenValidationQueries() as token_queries:
+        user_to_tokens = token_queries.get_registered_user_tokens(SNYK_VALIDATION_WINDOW_DAYS)
+    validated_users = validate_user_tokens(user_to_tokens)
+    unregistered_users = [user_id for user_id, is_valid in validated_users.items()
+                          if not is_valid]
+    with TokenValidationQueries() as token_queries:
+        token_queries.update_users_to_unregistered(unregistered_users)
+        token_queries.update_tokens_validated(list(validated_users))
     cache_all_users()
 
 
-def call_snyk_api(user_to_tokens: dict) -> list:
-    """Snyk API invocation to figure out unregistered users."""
-    unregistered_users = list()
-    for user_id, token in user_to_tokens.items():
-        decrypted_token = decrypt_api_token(token)
-        if not is_snyk_token_valid(decrypted_token.decode()):
-            logger.info("User id %s has an invalid token", user_id)
-            unregistered_users.append(user_id)
+class RateLimiter:
+    """Space out the calls made from all the threads to a maximum rate."""
+
+    def __init__(self, rate):
+        """Allow `rate` calls per second, any number when it is 0."""
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self._lock = threading.Lock()
+        self._next_call = 0.0
+
+    def wait(self):
+        """Block until the next call is allowed."""
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_call - now
+            self._next_call = max(now, self._next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+@tenacity.retry(reraise=True, stop=tenacity.stop_after_attempt(SNYK_VALIDATION_RETRIES),
+                wait=tenacity.wait_exponential(multiplier=0.5, max=10),
+                retry=tenacity.retry_if_exception_type(requests.exceptions.RequestException))
+def validate_token(token, rate_limiter: RateLimiter) -> bool:
+    """Validate the encrypted token with Snyk, retrying transient failures."""
+    rate_limiter.wait()
+    return is_snyk_token_valid(decrypt_api_token(token).decode())
+
+
+def validate_user_tokens(user_to_tokens: dict, workers: int = SNYK_VALIDATION_WORKERS,
+                         rate: float = SNYK_VALIDATION_RATE) -> dict:
+    """Validate the tokens of the users with Snyk.
+
+    Tokens are validated concurrently by `workers` threads, sending at most `rate`
+    requests per second. Users whose token could not be checked are left out.
+    """
+    validated_users = dict()
+    rate_limiter = RateLimiter(rate)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = [(user_id, executor.submit(validate_token, token, rate_limiter))
+                   for user_id, token in user_to_tokens.items()]
+        for user_id, result in results:
+            try:
+                validated_users[user_id] = result.result()
+            except requests.exceptions.RequestException as e:
+                logger.error("Unable to validate the token of user id %s: %r", user_id, e)
+                continue
+            if not validated_users[user_id]:
+                logger.info("User id %s has an invalid token", user_id)
+
+    return validated_users
+
+
+def call_snyk_api(user_to_tokens: dict, workers: int = SNYK_VALIDATION_WORKERS,
+                  rate: float = SNYK_VALIDATION_RATE) -> list:
+    """Snyk API invocation to figure out unregistered users.
 
-    return unregistered_users
+    Users whose token could not be checked stay registered.
+    """
+    return [user_id for user_id, is_valid in
+            validate_user_tokens(user_to_tokens, workers, rate).items() if not is_valid]
 
 
 @tenacity.retry(reraise=True, stop=tenacity.stop_after_attempt(3), wait=tenacity.wait_fixed(1))
@@ -18,6 +18,9 @@
 
 import logging
 import json
+from collections import Counter
+import os
+import itertools
 
 from f8a_report.helpers.cve_helper import CVE
 from datetime import datetime as dt
@@ -27,6 +30,10 @@ from f8a_report.helpers.s3_helper import S3Helper
 
 logger = logging.getLogger(__file__)
 
+# 'join' retrieves worker results for the date range in a single server-side join,
+# 'ids' retrieves the stack ids first and queries worker results in id chunks.
+WORKER_RESULTS_QUERY_MODE = os.getenv('WORKER_RESULTS_QUERY_MODE', 'join')
+
 
 class StackReportBuilder():
     """Namespace for Report Builder v2.
@@ -40,19 +47,18 @@ class StackReportBuilder():
         self.supported_ecosystems = ['npm', 'golang', 'pypi', 'maven']
         self.total_stack_requests = {eco: 0 for eco in self.supported_ecosystems}
         self.total_stack_requests.update({'all': 0})
-        self.all_deps = {eco: [] for eco in self.supported_ecosystems}
-        self.all_unknown_deps = {eco: [] for eco in self.supported_ecosystems}
+        # Frequencies are aggregated incrementally as each stack is analysed,
+        # so per stack dependency lists never need to be kept in memory.
+        self.dep_counts = {eco: Counter() for eco in self.supported_ecosystems}
+        self.stack_counts = {eco: Counter() for eco in self.supported_ecosystems}
+        self.unknown_license_counts = Counter()
         self.unique_stacks_with_deps_count = 0
         self.unique_stacks_with_recurrence_count = 0
         self.avg_response_time = {eco: {} for eco in self.supported_ecosystems}
-        self.unknown_licenses = []
-        self.all_cve_list = []
         self.total_response_time = {eco: 0.0 for eco in self.supported_ecosystems}
         self.total_response_time.update({'all': 0.0})
         self.start_date = 'YYYY-MM-DD'
         self.end_date = 'YYYY-MM-DD'
-        self.stacks_list = {eco: [] for eco in self.supported_ecosystems}
-        self.all_unknown_lic = []
         self.avg_response_time = {}
 
     @staticmethod
@@ -126,8 +132,6 @@ class StackReportBuilder():
             stack = stack[0]
             ecosystem = stack.get('ecosystem')
             analysed_dependencies = stack.get('analyzed_dependencies', [])
-            unknown_dependencies = stack.get('unknown_dependencies', [])
-            normalised_unknown_dependencies = self.normalize_deps_list(unknown_dependencies)
             unknown_licenses = self.get_unknown_licenses(stack)
             try:
                 if len(analysed_dependencies) == 0:
@@ -138,11 +142,11 @@ class StackReportBuilder():
                 normalised_stacks = self.normalize_deps_list(
                     analysed_dependencies)
 
-                self.all_deps[ecosystem].append(normalised_stacks)
+                self.dep_counts[ecosystem].update(normalised_stacks)
                 stack_str = ','.join(normalised_stacks)
-                self.stacks_list[ecosystem].append(stack_str)
-                self.all_unknown_deps[ecosystem].append(normalised_unknown_dependencies)
-                self.all_unknown_lic.append(unknown_licenses)
+                self.stack_counts[ecosystem][stack_str] += 1
+                self.unknown_license_counts.update(
+                    lic_dict['license'] for lic_dict in unknown_licenses if 'license' in lic_dict)
                 ended_at, started_at = self.get_audit_timelines(stack)
                 response_time = self.report_helper.datediff_in_millisecs(started_at, ended_at)
                 self.total_response_time['all'] += response_time
@@ -161,17 +165,16 @@ class StackReportBuilder():
 
         summary = {
             'total_stack_requests_count': self.total_stack_requests['all'],
-            'unique_unknown_licenses_with_frequency':
-                self.report_helper.populate_key_count(self.unknown_licenses),
-            'unique_cves':
-                self.report_helper.populate_key_count(self.all_cve_list),
+            'unique_unknown_licenses_with_frequency': dict(self.unknown_license_counts),
+            # CVEs are not collected from the v2 stacks, see cve_report instead
+            'unique_cves': {},
             'total_average_response_time': '{} ms'.format(
                 self.total_response_time['all'] / self.total_stack_requests['all']),
             'cve_report': CVE().generate_cve_report(updated_on=self.start_date)
         }
-        ecosystem_summary = {ecosystem: self.report_helper.get_ecosystem_summary(
+        ecosystem_summary = {ecosystem: self.report_helper.get_ecosystem_summary_from_counts(
             ecosystem, self.total_stack_requests,
-            self.all_deps, self.all_unknown_deps,
+            self.dep_counts,
             self.unique_stacks_with_recurrence_count,
             self.unique_stacks_with_deps_count,
             self.avg_response_time,
@@ -194,30 +197,26 @@ class StackReportBuilder():
         """Parser for worker data for Stack Analyses v2.
 
         :arg:
-            stacks_data: Stacks Collected from DB within time-frame.
+            stacks_data: Stacks Collected from DB within time-frame, either as a
+                JSON dump or as an iterable of rows streamed from DB.
             frequency: Frequency of Report ( daily/monthly )
         :return: Final Venus Report Generated.
         """
         logger.info("Normalising v2 Stack Data.")
-        stacks_data = json.loads(stacks_data)
+        if isinstance(stacks_data, str):
+            stacks_data = json.loads(stacks_data)
         report_name = self.report_helper.get_report_name(frequency, self.end_date)
         report_template = self.get_report_template(self.start_date, self.end_date)
 
         report_content = self.analyse_stack(stacks_data, report_template)
 
         self.unique_stacks_with_recurrence_count = {
-            eco: self.report_helper.populate_key_count(self.stacks_list[eco])
-            for eco in self.supported_ecosystems
+            eco: dict(self.stack_counts[eco]) for eco in self.supported_ecosystems
         }
         self.unique_stacks_with_deps_count = \
             self.report_helper.set_unique_stack_deps_count(self.unique_stacks_with_recurrence_count)
         self.set_average_response_time()
 
-        # Get a list of unknown licenses
-        for lic_dict in self.report_helper.flatten_list(self.all_unknown_lic):
-            if 'license' in lic_dict:
-                self.unknown_licenses.append(lic_dict['license'])
-
         unknown_deps_ingestion_report = UnknownDepsReportHelperV2().get_current_ingestion_status()
 
         report_content['stacks_summary'] = self.build_report_summary(
@@ -246,18 +245,35 @@ class StackReportBuilder():
         logger.info(f"Venus Report Triggered for freq. {frequency}")
         self.start_date = start_date
         self.end_date = end_date
-        rds_obj = ReportQueries()
-        ids = rds_obj.retrieve_stack_analyses_ids(start_date, end_date)
         worker = 'stack_aggregator_v2'
 
-        if not len(ids):
-            logger.info(f'No stack analyses found from {start_date} to {end_date} '
-                        f'to generate an aggregated report')
-            return False
-
-        query_data = rds_obj.get_worker_results_v2(worker=worker, stack_ids=ids)
-
-        generated_report = self.normalize_worker_data(query_data, retrain, frequency)
+        # The pooled connection is held only while worker results are streamed, it is
+        # handed back as soon as the last row is read, before the report is built.
+        rds_obj = ReportQueries()
+        try:
+            # Rows are streamed through a server-side cursor so that peak memory
+            # is bounded by the fetch batch size rather than by the date range.
+            if WORKER_RESULTS_QUERY_MODE == 'join':
+                query_data = rds_obj.stream_worker_results_v2_by_date(
+                    worker=worker, start_date=start_date, end_date=end_date)
+                first_row = next(query_data, None)
+                if first_row is None:
+                    logger.info(f'No stack analyses found from {start_date} to {end_date} '
+                                f'to generate an aggregated report')
+                    return False
+                query_data = itertools.chain([first_row], query_data)
+            else:
+                ids = rds_obj.retrieve_stack_analyses_ids(start_date, end_date)
+                if not len(ids):
+                    logger.info(f'No stack analyses found from {start_date} to {end_date} '
+                                f'to generate an aggregated report')
+                    return False
+                query_data = rds_obj.stream_worker_results_v2(worker=worker, stack_ids=ids)
+
+            generated_report = self.normalize_worker_data(
+                self.release_when_consumed(query_data, rds_obj), retrain, frequency)
+        finally:
+            rds_obj.close()
 
         worker_result = {}
         if not generated_report:
@@ -268,6 +284,15 @@ class StackReportBuilder():
 
         return worker_result
 
+    @staticmethod
+    def release_when_consumed(rows, rds_obj):
+        """Yield the streamed rows, then hand the connection of rds_obj back to the pool."""
+        try:
+            for row in rows:
+                yield row
+        finally:
+            rds_obj.close()
+
     def create_venus_report(self, venus_input):
         """Create venus report."""
         # Retrieve input variables
@@ -291,8 +316,9 @@ class StackReportBuilder():
         try:
             s3 = S3Helper()
             obj_key = f'v2/{frequency}/{report_name}.json'
-            s3.store_json_content(content=content, obj_key=obj_key,
-                                  bucket_name=s3.report_bucket_name)
+            # Monthly reports are large, encode and upload them in parts
+            s3.store_json_stream(content=content, obj_key=obj_key,
+                                 bucket_name=s3.report_bucket_name)
             logger.info(f"Successfully saved report in {obj_key}.")
             return True
         except Exception as e:
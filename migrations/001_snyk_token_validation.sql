@@ -0,0 +1,7 @@
+-- Time each user's Snyk token was last validated, written by the Snyk token validation
+-- job so that with SNYK_VALIDATION_WINDOW_DAYS above 1 each token is checked once per
+-- window instead of every day.
+CREATE TABLE IF NOT EXISTS snyk_token_validation (
+    user_id TEXT PRIMARY KEY,
+    last_validated TIMESTAMP NOT NULL
+);
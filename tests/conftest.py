@@ -0,0 +1,35 @@
+"""Helpers shared by the tests."""
+
+import functools
+import threading
+
+
+class InFlightTracker:
+    """Count the calls of a function running at the same time, and the peak of them."""
+
+    def __init__(self, hold=True):
+        """Set up the counters, with hold the first call waits until a second one runs."""
+        self.hold = hold
+        self.now = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+        self._overlapped = threading.Event()
+
+    def wrap(self, func):
+        """Return func counting the calls in flight."""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self._lock:
+                self.now += 1
+                self.peak = max(self.peak, self.now)
+                if self.now > 1:
+                    self._overlapped.set()
+            try:
+                # Hold the first call until a second one is in flight as well
+                if self.hold:
+                    self._overlapped.wait(5)
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.now -= 1
+        return wrapper
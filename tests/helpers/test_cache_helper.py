@@ -0,0 +1,40 @@
+"""Test module for the storage shared by the caches."""
+
+import os
+from unittest import mock
+from f8a_report.helpers.cache_helper import SQLiteCache, cache_path
+
+
+class KeyValueCache(SQLiteCache):
+    """Minimal cache on top of the shared SQLite storage."""
+
+    schema = 'CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)'
+
+
+def test_cache_path():
+    """Test the caches are kept in F8A_CACHE_DIR."""
+    with mock.patch('f8a_report.helpers.cache_helper.F8A_CACHE_DIR', '/var/cache/f8a'):
+        assert cache_path('github_cache') == os.path.join('/var/cache/f8a', 'github_cache')
+
+
+def test_sqlite_cache(tmp_path):
+    """Test the database is opened by the first query and its errors are not raised."""
+    cache = KeyValueCache(str(tmp_path / 'kv.db'))
+    assert not (tmp_path / 'kv.db').exists()
+    cache._write('INSERT INTO kv VALUES (?, ?)', [('a', '1'), ('b', '2')])
+    assert (tmp_path / 'kv.db').exists()
+    assert cache._fetchone('SELECT value FROM kv WHERE key = ?', ('b',)) == ('2',)
+
+    # A broken query behaves as a cache miss, or a write that did not happen
+    assert cache._fetchone('SELECT value FROM missing') is None
+    cache._write('INSERT INTO kv VALUES (?, ?)', [('a', '3')])
+    assert cache._fetchone('SELECT value FROM kv WHERE key = ?', ('a',)) == ('1',)
+    assert cache.stats() == {'hits': 0, 'misses': 0}
+
+
+def test_sqlite_cache_unusable_path():
+    """Test a database that cannot be opened behaves as an empty cache."""
+    cache = KeyValueCache('/nonexistent/dir/kv.db')
+    assert cache._open() is None
+    cache._write('INSERT INTO kv VALUES (?, ?)', [('a', '1')])
+    assert cache._fetchone('SELECT value FROM kv') is None
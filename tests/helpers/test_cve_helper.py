@@ -1,6 +1,8 @@
 """Tests for classes from cve_report_helper module."""
 import pytest
 import json
+import os
+import responses
 from unittest import mock
 from f8a_report.helpers.cve_helper import CVE
 from datetime import datetime as dt
@@ -14,6 +16,13 @@ with open('tests/data/github_data.json', 'r') as f:
     github_api_response = json.load(f)
 
 
+@pytest.fixture(autouse=True)
+def github_cache(tmp_path):
+    """Point the Github response cache to an empty temporary directory."""
+    with mock.patch.object(cve, 'cache_dir', str(tmp_path)):
+        yield tmp_path
+
+
 def mock_github_get(*_args, **_kwargs):
     """Mock the call to the insights service."""
     class MockResponse:
@@ -52,8 +61,8 @@ def mock_graph_post_error(*_args, **_kwargs):
     return MockResponse(graph_cve_response, 500)
 
 
-def mock_graph_post(*_args, **_kwargs):
-    """Mock the call to the insights service."""
+def mock_graph_post(*_args, **kwargs):
+    """Mock the call to the graph, returning the bound CVE ids found in the graph."""
     class MockResponse:
         """Mock response object."""
 
@@ -68,8 +77,11 @@ def mock_graph_post(*_args, **_kwargs):
 
     with open('tests/data/graph_cve_data.json', 'r') as f:
         graph_cve_response = json.loads(f.read())
+    graph_cve_ids = {cve['cve_id'][0] for cve in graph_cve_response['result']['data']}
+    cve_ids = kwargs['json']['bindings']['cve_ids']
 
-    return MockResponse(graph_cve_response, 200)
+    return MockResponse({"result": {"data": [cve_id for cve_id in cve_ids
+                                             if cve_id in graph_cve_ids]}}, 200)
 
 
 @mock.patch('f8a_report.helpers.cve_helper.CVE.call_github_api')
@@ -95,6 +107,17 @@ def test_validate_cveids_in_graph(_mock1):
     assert ingested is not None
     assert len(ingested) == 1
 
+    # Test that the CVEs are checked in one request
+    _mock1.reset_mock()
+    ingested, missed = cve.validate_cveids_in_graph(
+        cve_ids=['CVE-2017-1000116', 'CVE-2099-0001', 'CVE-2017-1000116'])
+    assert ingested == ['CVE-2017-1000116', 'CVE-2017-1000116']
+    assert missed == ['CVE-2099-0001']
+    assert _mock1.call_count == 1
+    payload = _mock1.call_args[1]['json']
+    assert payload['bindings'] == {'cve_ids': ['CVE-2017-1000116', 'CVE-2099-0001']}
+    assert "values('cve_id')" in payload['gremlin']
+
     # Test an invalid status-code 500 use-case
     _mock1.side_effect = mock_graph_post_error
     ingested, missed = cve.validate_cveids_in_graph(cve_ids=['CVE-2017-1000116'])
@@ -121,7 +144,7 @@ def test_get_fp_cves_count(_mock1):
         assert fp_cves_count is None
 
 
-@mock.patch('requests.get')
+@mock.patch('requests.Session.get')
 def test_call_github_api(_mock1):
     """Test call github api."""
     # Test valid response from github
@@ -135,6 +158,65 @@ def test_call_github_api(_mock1):
         cve.call_github_api('')
 
 
+@responses.activate
+def test_call_github_api_cache():
+    """Test the Github responses are cached and revalidated with their ETag."""
+    helper = CVE()
+    helper.cache_dir = cve.cache_dir
+    url = helper.github_url + '+type:pr'
+    headers = {'ETag': '"v1"', 'X-RateLimit-Remaining': '10', 'X-RateLimit-Reset': '0'}
+    responses.add(responses.GET, url, json=github_api_response, headers=headers)
+    responses.add(responses.GET, url, status=304, headers=headers)
+
+    assert helper.call_github_api('+type:pr') == github_api_response
+    assert helper.call_github_api('+type:pr') == github_api_response
+    assert len(responses.calls) == 2
+    assert 'If-None-Match' not in responses.calls[0].request.headers
+    assert responses.calls[1].request.headers['If-None-Match'] == '"v1"'
+
+    # Rate limit exhausted, the cached response is served without waiting for the reset
+    helper.github_rate_limits = 0
+    helper.github_rate_limit_reset = int(dt.now().timestamp()) + 3600
+    with mock.patch('time.sleep') as sleep:
+        assert helper.call_github_api('+type:pr') == github_api_response
+    sleep.assert_not_called()
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_call_github_api_waits_without_lock():
+    """Test the rate limit reset is awaited without holding the rate limit lock."""
+    helper = CVE()
+    helper.cache_dir = cve.cache_dir
+    responses.add(responses.GET, helper.github_url + '+type:issue', json=github_api_response,
+                  headers={'X-RateLimit-Remaining': '10', 'X-RateLimit-Reset': '0'})
+    helper.github_rate_limits = 0
+    helper.github_rate_limit_reset = int(dt.now().timestamp()) + 3600
+
+    def sleep(seconds):
+        assert not helper._rate_limit_lock.locked()
+        assert 3590 < seconds <= 3600
+        helper.github_rate_limit_reset = int(dt.now().timestamp())
+
+    with mock.patch('time.sleep', side_effect=sleep) as sleep_mock:
+        assert helper.call_github_api('+type:issue') == github_api_response
+    assert sleep_mock.call_count == 1
+    assert len(responses.calls) == 1
+
+
+@mock.patch('f8a_report.helpers.cve_helper.GITHUB_CACHE_MAX_ENTRIES', 2)
+def test_github_cache_evicts_least_recently_used(github_cache):
+    """Test only the most recently used Github responses are kept."""
+    for i, url in enumerate(('a', 'b')):
+        cve._write_cache(url, None, {'url': url})
+        os.utime(cve._cache_path(url), (i, i))
+    assert cve._read_cache('a') == {'url': 'a', 'etag': None, 'body': {'url': 'a'}}
+    cve._write_cache('c', None, {'url': 'c'})
+    assert sorted(os.listdir(str(github_cache))) == \
+        sorted(os.path.basename(cve._cache_path(url)) for url in ('a', 'c'))
+    assert cve._read_cache('b') is None
+
+
 @mock.patch('f8a_report.helpers.cve_helper.CVE.call_github_api')
 def test_get_open_cves_count(_mock1):
     """Test open CVEs count."""
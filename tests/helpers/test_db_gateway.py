@@ -1,7 +1,10 @@
 """Tests DB Gateway v2."""
 
 from unittest import TestCase
-from f8a_report.helpers.db_gateway import ReportQueries
+from datetime import date
+from unittest.mock import MagicMock, patch
+from psycopg2.errors import UndefinedTable
+from f8a_report.helpers.db_gateway import ReportQueries, TokenValidationQueries
 from tests.helpers.test_stack_report_helper import MockPostgres
 
 
@@ -37,6 +40,49 @@ class TestReportQueries(TestCase):
         result = self.ReportQueries.get_worker_results_v2(self.worker, stack_ids)
         self.assertIsNotNone(result)
 
+    @patch.object(ReportQueries, '_stream_query')
+    def test_stream_worker_results_v2(self, _mock_stream):
+        """Test Streaming Worker Results."""
+        _mock_stream.return_value = iter([({'ecosystem': 'npm'},), ({'ecosystem': 'pypi'},)])
+        stack_ids = ('09aa6480a3ce477881109d9635c30257',)
+        result = self.ReportQueries.stream_worker_results_v2(self.worker, stack_ids, itersize=1)
+        self.assertListEqual([row[0]['ecosystem'] for row in result], ['npm', 'pypi'])
+        self.assertEqual(_mock_stream.call_args[0][1], 1)
+
+    @patch.object(ReportQueries, '_stream_query', return_value=iter([]))
+    def test_stream_worker_results_v2_exception(self, _mock_stream):
+        """Test Streaming Worker Results Exception."""
+        stack_ids = ('09aa6480a3ce477881109d9635c30257',)
+        result = self.ReportQueries.stream_worker_results_v2(self.worker, stack_ids)
+        self.assertRaises(Exception, list, result)
+
+    @patch('f8a_report.helpers.db_gateway.STACK_IDS_CHUNK_SIZE', 2)
+    @patch.object(ReportQueries, '_stream_query')
+    def test_stream_worker_results_v2_chunked(self, _mock_stream):
+        """Test Streaming Worker Results in id chunks."""
+        _mock_stream.side_effect = lambda *_args: iter([({'ecosystem': 'npm'},)])
+        stack_ids = ['id1', 'id2', 'id3', 'id4', 'id5']
+        result = list(self.ReportQueries.stream_worker_results_v2(self.worker, stack_ids))
+        self.assertEqual(len(result), 3)
+        self.assertEqual(_mock_stream.call_count, 3)
+
+    @patch.object(ReportQueries, '_stream_query')
+    def test_stream_worker_results_v2_by_date(self, _mock_stream):
+        """Test Streaming Worker Results joined on date range."""
+        _mock_stream.return_value = iter([({'ecosystem': 'npm'},)])
+        result = list(self.ReportQueries.stream_worker_results_v2_by_date(
+            self.worker, '2020-01-01', '2020-01-02'))
+        self.assertEqual(len(result), 1)
+        query = _mock_stream.call_args[0][0]
+        self.assertIn('JOIN', query)
+        self.assertNotIn(' IN (', query)
+
+    def test_stream_worker_results_v2_by_date_exception(self):
+        """Test Streaming Worker Results with invalid dates."""
+        result = self.ReportQueries.stream_worker_results_v2_by_date(
+            self.worker, '201-10-09', '18-10-09')
+        self.assertRaises(ValueError, list, result)
+
     def test_retrieve_stack_analyses_ids(self):
         """Test Retrieve Stack Analyses."""
         self.ReportQueries.cursor = MockPostgres()
@@ -55,3 +101,50 @@ class TestReportQueries(TestCase):
         self.ReportQueries.cursor = MockPostgres()
         ids = self.ReportQueries.retrieve_ingestion_results('2018-10-09', '2018-10-19')
         self.assertIsNotNone(ids)
+
+
+class TestTokenValidationQueries(TestCase):
+    """Test namespace for Snyk Token Validation Queries."""
+
+    @classmethod
+    def setUp(cls):
+        """Initialise class with a mocked cursor."""
+        cls.TokenQueries = TokenValidationQueries()
+        cls.TokenQueries.cursor = MagicMock()
+        cls.TokenQueries.cursor.fetchall.return_value = [('user-1', 'token-1')]
+
+    def test_get_registered_user_tokens_incremental(self):
+        """Test only today's bucket and the overdue tokens are queried."""
+        result = self.TokenQueries.get_registered_user_tokens(window_days=7)
+        self.assertEqual(result, {'user-1': 'token-1'})
+        query, params = self.TokenQueries.cursor.execute.call_args[0]
+        self.assertIn('snyk_token_validation', query)
+        self.assertEqual(params, ('REGISTERED', 7, 7, date.today().toordinal() % 7))
+        self.assertNotIn('create table', query.lower())
+
+    @patch('f8a_report.helpers.db_gateway.sql.SQL')
+    def test_get_registered_user_tokens_missing_table(self, _mock_sql):
+        """Test every token is queried when the validation table is missing."""
+        _mock_sql.return_value.as_string.return_value = 'select all %s'
+        self.TokenQueries.cursor.execute.side_effect = [UndefinedTable(), None]
+        with patch.object(self.TokenQueries, 'conn') as conn:
+            result = self.TokenQueries.get_registered_user_tokens(window_days=7)
+        self.assertEqual(result, {'user-1': 'token-1'})
+        conn.rollback.assert_called_once()
+        self.assertEqual(self.TokenQueries.cursor.execute.call_args[0], ('select all REGISTERED',))
+
+    @patch('f8a_report.helpers.db_gateway.execute_values')
+    def test_update_tokens_validated(self, _mock_execute_values):
+        """Test the validation time of the users is recorded."""
+        self.TokenQueries.update_tokens_validated([])
+        _mock_execute_values.assert_not_called()
+        self.TokenQueries.update_tokens_validated(['user-1', 'user-2'])
+        rows = _mock_execute_values.call_args[0][2]
+        self.assertEqual(rows, [('user-1',), ('user-2',)])
+
+        # Without the validation table the run goes on, nothing is recorded
+        _mock_execute_values.side_effect = UndefinedTable()
+        with patch.object(self.TokenQueries, 'conn') as conn:
+            self.TokenQueries.update_tokens_validated(['user-1'])
+        conn.rollback.assert_called_once()
+        conn.commit.assert_not_called()
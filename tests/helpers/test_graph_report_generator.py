@@ -2,9 +2,25 @@
 
 from f8a_report.helpers.graph_report_generator import execute_gremlin_dsl, \
     generate_report_for_unknown_epvs, generate_report_for_latest_version, \
-    generate_report_for_cves, find_ingested_epv, rectify_latest_version
+    generate_report_for_cves, find_ingested_epv, rectify_latest_version, batch_query_executor, \
+    GremlinClient, GremlinQueryError, gremlin_client, AdaptiveBatcher
+from f8a_report.helpers.latest_version_cache import LatestVersionCache
 from unittest import mock
 from datetime import date
+import pytest
+import random
+import requests
+import time
+
+
+@pytest.fixture(autouse=True)
+def fresh_batcher():
+    """Start each test from a new Gremlin batcher and an empty latest version cache."""
+    with mock.patch('f8a_report.helpers.graph_report_generator.gremlin_batcher',
+                    AdaptiveBatcher()), \
+            mock.patch('f8a_report.helpers.graph_report_generator.latest_version_cache',
+                       LatestVersionCache(path=':memory:')):
+        yield
 
 
 def mock_post_with_payload_check(*_args, **kwargs):
@@ -255,3 +271,152 @@ def test_rectify_latest_version2(mocker):
     lst = {'express 4.0.0': 2, 'npm 6.2.0': 2, 'serve-static 1.7.1': 2}
     resp = rectify_latest_version(lst, "npm", True)
     assert resp == "Success"
+
+
+def mock_gremlin_echo(payload, **_kwargs):
+    """Mock the Gremlin service, echoing back the bound names after a random delay."""
+    time.sleep(random.uniform(0, 0.01))
+    if 'fail' in payload['bindings']['names']:
+        raise GremlinQueryError('Script evaluation exceeded the configured timeout',
+                                too_large=True)
+    return {"result": {"data": payload['bindings']['names']}}
+
+
+@mock.patch('f8a_report.helpers.graph_report_generator.GREMLIN_QUERY_RETRIES', 1)
+@mock.patch("f8a_report.helpers.graph_report_generator.execute_gremlin_dsl",
+            side_effect=mock_gremlin_echo)
+def test_batch_query_executor_keeps_order(mocker):
+    """Test that batches keep their order and failed batches are split and retried."""
+    names = ["pkg{}".format(i) for i in range(9)]
+    names[4] = "fail"
+    query_str = "g.V().has('name', within(names))"
+    batcher = AdaptiveBatcher(initial_size=2, max_size=2)
+    out = batch_query_executor(query_str, names, lambda batch: {'names': batch}, batcher)
+    # Only the failing value is given up after its retry
+    assert out == ["pkg0", "pkg1", "pkg2", "pkg3", "pkg5", "pkg6", "pkg7", "pkg8"]
+    # 5 batches, the failed one split in two halves and the failing half retried once
+    assert mocker.call_count == 8
+    stats = batcher.stats()
+    assert stats['failed_batches'] == 3
+    assert sum(b['size'] for b in stats['batches'] if b['succeeded']) == 8
+    # The script is fixed, values are only sent as bindings
+    assert {call[0][0]['gremlin'] for call in mocker.call_args_list} == {query_str}
+
+
+@mock.patch('f8a_report.helpers.graph_report_generator.GREMLIN_QUERY_RETRIES', 1)
+@mock.patch("f8a_report.helpers.graph_report_generator.execute_gremlin_dsl",
+            side_effect=GremlinQueryError('HTTP error 503'))
+def test_batch_query_executor_failures_not_split(mocker):
+    """Test that failures unrelated to the query size are retried without splitting."""
+    names = ["pkg{}".format(i) for i in range(4)]
+    failed = []
+    batcher = AdaptiveBatcher(initial_size=4, max_size=4)
+    out = batch_query_executor("g.V().has('name', within(names))", names,
+                               lambda batch: {'names': batch}, batcher, failed)
+    assert out == []
+    assert failed == names
+    # The batch and its single retry
+    assert mocker.call_count == 2
+
+
+@mock.patch('f8a_report.helpers.graph_report_generator.GREMLIN_FAILURE_BUDGET', 3)
+@mock.patch("f8a_report.helpers.graph_report_generator.execute_gremlin_dsl",
+            side_effect=GremlinQueryError('Read timed out', too_large=True))
+def test_batch_query_executor_failure_budget(mocker):
+    """Test that the remaining values are given up once the failure budget is spent."""
+    names = ["pkg{}".format(i) for i in range(100)]
+    failed = []
+    batcher = AdaptiveBatcher(initial_size=10, max_size=10)
+    with mock.patch('f8a_report.helpers.graph_report_generator.GREMLIN_QUERY_WORKERS', 1):
+        out = batch_query_executor("g.V().has('name', within(names))", names,
+                                   lambda batch: {'names': batch}, batcher, failed)
+    assert out == []
+    assert sorted(failed) == sorted(names)
+    assert mocker.call_count == 3
+
+
+def test_execute_gremlin_dsl_errors():
+    """Test that errors tell whether the query was too large."""
+    payload = {'gremlin': "g.V().has('name', within(names))", 'bindings': {'names': []}}
+    too_large = mock.Mock(status_code=413, text='')
+    unavailable = mock.Mock(status_code=503, text='Service Unavailable')
+    timed_out = mock.Mock(status_code=597, text='Script evaluation exceeded the timeout')
+    for response, expected in [(too_large, True), (unavailable, False), (timed_out, True)]:
+        with mock.patch.object(gremlin_client, 'post', return_value=response):
+            assert execute_gremlin_dsl(payload) is None
+            with pytest.raises(GremlinQueryError) as e:
+                execute_gremlin_dsl(payload, raise_errors=True)
+            assert e.value.too_large is expected
+
+    with mock.patch.object(gremlin_client, 'post',
+                           side_effect=requests.exceptions.ReadTimeout()):
+        with pytest.raises(GremlinQueryError) as e:
+            execute_gremlin_dsl(payload, raise_errors=True)
+        assert e.value.too_large
+
+
+def test_adaptive_batcher():
+    """Test that the batch size follows the observed latency and failures."""
+    batcher = AdaptiveBatcher(initial_size=100, max_size=300, target_latency=2)
+    batcher.record(100, 0.5, True)
+    assert batcher.next_size() == 150
+    batcher.record(150, 0.5, True)
+    batcher.record(225, 0.5, True)
+    assert batcher.next_size() == 300
+    batcher.record(300, 6, True)
+    assert batcher.next_size() == 100
+    batcher.record(100, 1, False)
+    assert batcher.next_size() == 50
+    stats = batcher.stats()
+    assert stats['current_size'] == 50
+    assert stats['failed_batches'] == 1
+    assert stats['total_batches'] == 5
+    assert [b['size'] for b in stats['batches']] == [100, 150, 225, 300, 100]
+
+
+@mock.patch("f8a_report.helpers.graph_report_generator.execute_gremlin_dsl")
+def test_batch_query_executor_no_args(mocker):
+    """Test that no request is made when there is nothing to query."""
+    assert batch_query_executor("g.V().has('name', within(names))", [],
+                                lambda batch: {'names': batch}) == []
+    mocker.assert_not_called()
+
+
+@mock.patch("f8a_report.helpers.graph_report_generator.execute_gremlin_dsl")
+def test_find_ingested_epv_bindings(mocker):
+    """Test that package names are sent as bindings and not spliced into the script."""
+    mocker.return_value = {"result": {"data": [
+        {"pname": ["it's-a-pkg"], "pecosystem": ["npm"], "version": ["1.0.0"]},
+        {"pname": ["it's-a-pkg"], "pecosystem": ["npm"], "version": ["2.0.0"]}]}}
+    pvlist = [{"name": "it's-a-pkg", "version": "1.0.0"},
+              {"name": "other", "version": "2.0.0"}]
+    out = find_ingested_epv('npm', pvlist)
+    payload = mocker.call_args[0][0]
+    assert "it's-a-pkg" not in payload['gremlin']
+    assert payload['bindings'] == {'eco': 'npm', 'names': ["it's-a-pkg", 'other'],
+                                   'versions': ['1.0.0', '2.0.0']}
+    # it's-a-pkg 2.0.0 was not asked for, so it is not reported
+    assert out['ingested_dependencies'] == 1
+    assert out['report'] == {"it's-a-pkg 1.0.0": 'Ingested', 'other 2.0.0': 'Unknown'}
+
+
+@mock.patch('requests.Session.post', side_effect=mock_post_with_payload_check)
+def test_gremlin_client(mocker):
+    """Test that the Gremlin client reuses its session and tracks call latency."""
+    client = GremlinClient(url='http://gremlin:8182', pool_size=2, timeout=(1, 2))
+    session = client.session
+    for _ in range(3):
+        resp = client.post({'gremlin': 'g.V().count()'})
+        assert resp.status_code == 200
+    assert client.session is session
+    assert mocker.call_args[1]['timeout'] == (1, 2)
+    stats = client.stats()
+    assert stats['calls'] == 3
+    assert stats['errors'] == 0
+    assert stats['max_latency'] >= stats['avg_latency'] >= 0
+
+
+def test_shared_gremlin_client():
+    """Test that graph calls share one pooled client."""
+    from f8a_report.helpers import report_helper
+    assert report_helper.gremlin_client is gremlin_client
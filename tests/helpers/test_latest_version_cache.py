@@ -0,0 +1,64 @@
+"""Test module for the latest version cache."""
+
+from unittest import mock
+from f8a_report.helpers.latest_version_cache import LatestVersionCache
+
+
+@mock.patch('f8a_report.helpers.latest_version_cache.get_latest_versions_for_ep',
+            side_effect=lambda eco, pkg: pkg + '-1.0.0')
+def test_get_many(mocker, tmp_path):
+    """Test that lookups are served from memory and from disk until they expire."""
+    path = str(tmp_path / 'cache.db')
+    cache = LatestVersionCache(path=path, ttl=60, workers=2)
+    # The database is only created by the first lookup
+    assert not (tmp_path / 'cache.db').exists()
+    keys = [('npm', 'lodash'), ('maven', 'io.vertx:vertx-web'), ('npm', 'lodash')]
+    expected = {('npm', 'lodash'): 'lodash-1.0.0',
+                ('maven', 'io.vertx:vertx-web'): 'io.vertx:vertx-web-1.0.0'}
+    assert cache.get_many(keys) == expected
+    assert mocker.call_count == 2
+    assert cache.get_many(keys) == expected
+    assert mocker.call_count == 2
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'errors': 0}
+
+    # A new process reuses the versions stored on disk
+    assert LatestVersionCache(path=path, ttl=60).get_many(keys) == expected
+    assert mocker.call_count == 2
+
+    # Expired entries are fetched again
+    assert LatestVersionCache(path=path, ttl=0).get_many(keys) == expected
+    assert mocker.call_count == 4
+
+
+@mock.patch('f8a_report.helpers.latest_version_cache.get_latest_versions_for_ep',
+            return_value='1.0.0')
+def test_default_ttl_spans_daily_runs(mocker, tmp_path):
+    """Test that with the default TTL the next day's run reuses the stored versions."""
+    path = str(tmp_path / 'cache.db')
+    with mock.patch('time.time', return_value=1000000.0):
+        LatestVersionCache(path=path).get_many([('npm', 'lodash')])
+    with mock.patch('time.time', return_value=1000000.0 + 24 * 60 * 60):
+        assert LatestVersionCache(path=path).get_many([('npm', 'lodash')]) == \
+            {('npm', 'lodash'): '1.0.0'}
+    assert mocker.call_count == 1
+
+
+@mock.patch('f8a_report.helpers.latest_version_cache.get_latest_versions_for_ep',
+            side_effect=Exception('registry down'))
+def test_get_many_errors(mocker):
+    """Test that failed lookups are reported and not cached."""
+    cache = LatestVersionCache(path=':memory:')
+    assert cache.get_many([('npm', 'lodash')]) == {('npm', 'lodash'): None}
+    assert cache.get_many([('npm', 'lodash')]) == {('npm', 'lodash'): None}
+    assert mocker.call_count == 2
+    assert cache.stats() == {'hits': 0, 'misses': 2, 'errors': 2}
+
+
+def test_unusable_path():
+    """Test that the cache falls back to memory when the database cannot be opened."""
+    cache = LatestVersionCache(path='/nonexistent/dir/cache.db')
+    with mock.patch('f8a_report.helpers.latest_version_cache.get_latest_versions_for_ep',
+                    return_value='1.0.0'):
+        assert cache.get_many([('npm', 'lodash')]) == {('npm', 'lodash'): '1.0.0'}
+        assert cache.get_many([('npm', 'lodash')]) == {('npm', 'lodash'): '1.0.0'}
+    assert cache.stats()['hits'] == 1
@@ -0,0 +1,336 @@
+"""Tests for classes from npm_metadata module."""
+
+import datetime
+import hashlib
+import json
+from unittest import mock
+
+import boto3
+import os
+import responses
+from moto import mock_s3
+
+from f8a_report.helpers.npm_metadata import NPMMetadata, NPM_PACKAGE_FILE_PATH, \
+    NPM_CHECKPOINT_PREFIX, NPM_PACKAGE_SHARDS_PREFIX, migrate_to_shards, package_shard, \
+    shard_count_for, shard_key
+from f8a_report import npm_package_file_main
+from f8a_report.helpers.s3_helper import S3Helper
+
+REGISTRY_URL = 'https://registry.npmjs.org/'
+GITHUB_URL = 'https://api.github.com/graphql'
+
+
+def packument(name, keywords):
+    """Build a full registry response for the package."""
+    return {
+        "name": name,
+        "description": name + " description",
+        "dist-tags": {"latest": "1.0.0"},
+        "versions": {"1.0.0": {"keywords": keywords, "dependencies": {"dep": "^1.0.0"}}},
+        "homepage": "https://example.com/" + name,
+        "repository": {"url": "git+https://github.com/org/" + name},
+    }
+
+
+def abbreviated(name):
+    """Build an abbreviated registry response for the package."""
+    return {"name": name, "dist-tags": {"latest": "1.0.0"},
+            "versions": {"1.0.0": {"dependencies": {"dep": "^1.0.0"}}}}
+
+
+def version_manifest(name, keywords):
+    """Build the registry response for the latest version of the package."""
+    return {"name": name, "version": "1.0.0", "description": name + " description",
+            "keywords": keywords, "dependencies": {"dep": "^1.0.0"},
+            "homepage": "https://example.com/" + name,
+            "repository": {"url": "git+https://github.com/org/" + name}}
+
+
+def npm_metadata(existing_data, packages):
+    """Create the NPMMetadata object for a manifest with the given packages."""
+    s3 = mock.Mock()
+    s3.iter_json_object.return_value = iter(existing_data.items())
+    s3.list_keys.return_value = []
+    manifest = {"package_dict": {"user_input_stack": [packages], "bigquery_data": []}}
+    return NPMMetadata(s3, 'token', 'bucket', manifest)
+
+
+@responses.activate
+@mock.patch('f8a_report.helpers.npm_metadata.time.sleep')
+def test_update(sleep):
+    """Test that stale and new packages are fetched concurrently with retries on 429."""
+    now = int(datetime.datetime.now().timestamp())
+    existing = {"fresh": {"name": "fresh", "updated_timestamp": now},
+                "stale": {"name": "stale", "updated_timestamp": 0}}
+    responses.add(responses.GET, REGISTRY_URL + 'stale', json=abbreviated('stale'))
+    responses.add(responses.GET, REGISTRY_URL + 'stale/1.0.0',
+                  json=version_manifest('stale', ['old']))
+    responses.add(responses.GET, REGISTRY_URL + 'new', status=429, headers={'Retry-After': '3'})
+    responses.add(responses.GET, REGISTRY_URL + 'new', json=abbreviated('new'))
+    responses.add(responses.GET, REGISTRY_URL + 'new/1.0.0', json=version_manifest('new', []))
+    responses.add(responses.GET, REGISTRY_URL + 'gone', status=404, json={"error": "Not found"})
+    responses.add(responses.POST, GITHUB_URL, json={"data": {
+        "r0": {"repositoryTopics": {"edges": [{"node": {"topic": {"name": "topic"}}}]}},
+        "rateLimit": {"cost": 1, "remaining": 4999, "resetAt": "2020-01-01T00:00:00Z"}}})
+
+    metadata = npm_metadata(existing, ['fresh', 'stale', 'new', 'gone'])
+    metadata.update()
+
+    assert metadata.existing_data['fresh'] == existing['fresh']
+    assert metadata.existing_data['stale']['keywords'] == ['old']
+    assert metadata.existing_data['new']['keywords'] == ['topic']
+    assert metadata.existing_data['new']['dependencies'] == ['dep']
+    assert 'gone' not in metadata.existing_data
+    sleep.assert_called_once_with(3.0)
+    assert metadata.stats == {
+        'existing_count': 2, 'unique_manifest_count': 4, 'metadata_exists': 1,
+        'total_missing': 3, 'new_packages': 2, 'updated_count': 2, 'still_missing': 1,
+        'fetched_from_npm': 2, 'fetched_from_github': 1, 'npm_fetch_errors': 0,
+        'github_fetch_errors': 0, 'throttled_retries': 1, 'not_modified': 0,
+        'full_document_fetches': 0, 'github_requests': 1, 'resumed_count': 0,
+        'checkpoints': 0, 'loaded_shards': 0, 'written_shards': 0}
+    metadata.s3Helper.store_json_stream.assert_called_once()
+
+
+@responses.activate
+@mock.patch('f8a_report.helpers.npm_metadata.NPM_FETCH_RETRIES', 2)
+@mock.patch('f8a_report.helpers.npm_metadata.time.sleep')
+def test_fetch_throttled(sleep):
+    """Test that requests throttled on every attempt are given up after the retries."""
+    responses.add(responses.GET, REGISTRY_URL + 'busy', status=429)
+    metadata = npm_metadata({}, ['busy'])
+    assert metadata._fetch('busy') is None
+    assert len(responses.calls) == 3
+    assert [c[0][0] for c in sleep.call_args_list] == [1.0, 2.0]
+    assert metadata.stats['npm_fetch_errors'] == 1
+
+
+@responses.activate
+def test_fetch_conditional():
+    """Test conditional requests and the reuse of the stored details of unchanged versions."""
+    stored = {"name": "pkg", "description": "stored", "version": "1.0.0", "keywords": ["k"],
+              "dependencies": [], "homepage": "", "repositoryurl": "", "updated_timestamp": 0,
+              "etag": '"abc"', "last_modified": "Mon, 01 Jun 2020 00:00:00 GMT"}
+    metadata = npm_metadata({}, ['pkg'])
+
+    responses.add(responses.GET, REGISTRY_URL + 'pkg', status=304)
+    details = metadata._fetch('pkg', stored)
+    request = responses.calls[0].request
+    assert request.headers['If-None-Match'] == '"abc"'
+    assert request.headers['If-Modified-Since'] == stored['last_modified']
+    assert 'application/vnd.npm.install-v1+json' in request.headers['Accept']
+    assert details['updated_timestamp'] > 0
+    assert dict(details, updated_timestamp=0) == stored
+    assert metadata.stats['not_modified'] == 1
+
+    # Changed document with the same latest version, only the dependencies are updated
+    responses.replace(responses.GET, REGISTRY_URL + 'pkg', json=abbreviated('pkg'),
+                      headers={'ETag': '"def"'})
+    details = metadata._fetch('pkg', stored)
+    assert details['description'] == 'stored'
+    assert details['dependencies'] == ['dep']
+    assert details['etag'] == '"def"'
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_fetch_full_document_fallback():
+    """Test that the full document is read when the version manifest is not available."""
+    responses.add(responses.GET, REGISTRY_URL + '@scope%2Fpkg', json=abbreviated('@scope/pkg'))
+    responses.add(responses.GET, REGISTRY_URL + '@scope%2Fpkg/1.0.0', status=404)
+    responses.add(responses.GET, REGISTRY_URL + '@scope%2Fpkg',
+                  json=packument('@scope/pkg', ['full']))
+    metadata = npm_metadata({}, ['@scope/pkg'])
+    details = metadata._fetch('@scope/pkg')
+    assert details['keywords'] == ['full']
+    assert details['repositoryurl'] == 'git+https://github.com/org/@scope/pkg'
+    assert metadata.stats['full_document_fetches'] == 1
+
+
+def mock_graphql(request):
+    """Mock the Github GraphQL API, answering topics named after the bound repositories."""
+    variables = json.loads(request.body)['variables']
+    data = {}
+    for key, owner in variables.items():
+        if key.startswith('o'):
+            alias = 'r' + key[1:]
+            name = variables['n' + key[1:]]
+            data[alias] = None if name == 'missing' else {"repositoryTopics": {"edges": [
+                {"node": {"topic": {"name": owner + '-' + name}}}]}}
+    reset_at = (datetime.datetime.utcnow() + datetime.timedelta(seconds=30)).strftime(
+        '%Y-%m-%dT%H:%M:%SZ')
+    data['rateLimit'] = {"cost": 1, "remaining": 1, "resetAt": reset_at}
+    return 200, {}, json.dumps({"data": data})
+
+
+@responses.activate
+@mock.patch('f8a_report.helpers.npm_metadata.GITHUB_GRAPHQL_BATCH_SIZE', 2)
+@mock.patch('f8a_report.helpers.npm_metadata.time.sleep')
+def test_add_github_keywords(sleep):
+    """Test that repositories are looked up in aliased batches, waiting for the rate limit."""
+    responses.add_callback(responses.POST, GITHUB_URL, callback=mock_graphql)
+    metadata = npm_metadata({}, [])
+    metadata.existing_data = {
+        "a": {"keywords": [], "repositoryurl": "git+https://github.com/org/a.git"},
+        "a-cli": {"keywords": [], "repositoryurl": "git+https://github.com/org/a.git"},
+        "b": {"keywords": [], "repositoryurl": "git+ssh://git@github.com/user/b.git"},
+        "c": {"keywords": [], "repositoryurl": "https://github.com/org/missing"},
+        "d": {"keywords": ["kept"], "repositoryurl": "https://github.com/org/d"},
+        "e": {"keywords": [], "repositoryurl": "https://gitlab.com/org/e"},
+    }
+    metadata._add_github_keywords(list(metadata.existing_data))
+
+    assert len(responses.calls) == 2
+    query = json.loads(responses.calls[0].request.body)['query']
+    assert 'org' not in query and 'rateLimit' in query
+    keywords = {name: details['keywords'] for name, details in metadata.existing_data.items()}
+    assert keywords == {"a": ["org-a"], "a-cli": ["org-a"], "b": ["user-b"], "c": [],
+                        "d": ["kept"], "e": []}
+    assert metadata.stats['github_requests'] == 2
+    assert metadata.stats['fetched_from_github'] == 2
+    assert metadata.stats['github_fetch_errors'] == 1
+    assert sleep.call_count == 2
+    assert 0 < sleep.call_args[0][0] <= 30
+
+
+@mock_s3
+@mock.patch('f8a_report.helpers.npm_metadata.NPM_CHECKPOINT_PACKAGES', 2)
+@mock.patch('f8a_report.helpers.s3_helper._s3_clients', {})
+@mock.patch.dict(os.environ, {'AWS_REQUEST_CHECKSUM_CALCULATION': 'when_required'})
+def test_update_checkpoint_resume():
+    """Test that an interrupted refresh resumes from its checkpoints and compacts them."""
+    bucket = os.environ.get('NPM_MODEL_BUCKET')
+    boto3.client('s3').create_bucket(Bucket=bucket)
+    s3 = S3Helper()
+    s3.store_json_content({"old": {"name": "old", "updated_timestamp": 0}}, bucket,
+                          NPM_PACKAGE_FILE_PATH)
+    manifest = {"package_dict": {"user_input_stack": [['a', 'b', 'c']]}}
+
+    def mock_registry(registry):
+        for name in 'abc':
+            registry.add(responses.GET, REGISTRY_URL + name, json=abbreviated(name))
+            registry.add(responses.GET, REGISTRY_URL + name + '/1.0.0',
+                         json=version_manifest(name, ['k']))
+
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as registry:
+        mock_registry(registry)
+        metadata = NPMMetadata(s3, 'token', bucket, manifest)
+        # The pod is killed before the final save
+        with mock.patch.object(metadata, '_save_data'):
+            metadata.update()
+    assert metadata.stats['checkpoints'] == 1
+    assert len(s3.list_keys(bucket, NPM_CHECKPOINT_PREFIX)) == 1
+
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as registry:
+        mock_registry(registry)
+        metadata = NPMMetadata(s3, 'token', bucket, manifest)
+        assert metadata.stats['resumed_count'] == 2
+        metadata.update()
+        # Only the package fetched after the checkpoint is fetched again
+        assert len(registry.calls) == 2
+
+    assert metadata.stats['metadata_exists'] == 2
+    assert s3.list_keys(bucket, NPM_CHECKPOINT_PREFIX) == []
+    saved = s3.read_json_object(bucket, NPM_PACKAGE_FILE_PATH)
+    assert sorted(saved) == ['a', 'b', 'c', 'old']
+
+
+@mock_s3
+@mock.patch('f8a_report.helpers.s3_helper._s3_clients', {})
+@mock.patch('f8a_report.helpers.npm_metadata.NPM_PACKAGES_PER_SHARD', 4)
+@mock.patch.dict(os.environ, {'AWS_REQUEST_CHECKSUM_CALCULATION': 'when_required'})
+def test_sharded_update():
+    """Test that only the shards of the manifest are read and the updated ones written."""
+    bucket = os.environ.get('NPM_MODEL_BUCKET')
+    boto3.client('s3').create_bucket(Bucket=bucket)
+    s3 = S3Helper()
+    now = int(datetime.datetime.now().timestamp())
+    packages = {"pkg{}".format(i): {"name": "pkg{}".format(i), "updated_timestamp": now}
+                for i in range(50)}
+    packages['stale'] = {"name": "stale", "updated_timestamp": 0}
+    s3.store_json_content(packages, bucket, NPM_PACKAGE_FILE_PATH)
+
+    index = migrate_to_shards(s3, bucket)
+    # 51 packages at 4 per shard
+    assert index['shard_count'] == 16
+
+    def shard(name):
+        return package_shard(name, 16)
+
+    shards = {shard(name) for name in packages}
+    assert set(index['shards']) == shards
+    assert sum(index['shards'].values()) == len(packages)
+    assert dict(s3.iter_json_object(bucket, shard_key(shard('stale'))))['stale'] == \
+        packages['stale']
+
+    manifest = {"package_dict": {"user_input_stack": [['pkg0', 'stale', 'new']]}}
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as registry:
+        for name in ('stale', 'new'):
+            registry.add(responses.GET, REGISTRY_URL + name, json=abbreviated(name))
+            registry.add(responses.GET, REGISTRY_URL + name + '/1.0.0',
+                         json=version_manifest(name, ['k']))
+        metadata = NPMMetadata(s3, 'token', bucket, manifest)
+        loaded = {shard(name) for name in ('pkg0', 'stale', 'new')} & shards
+        assert metadata.stats['loaded_shards'] == len(loaded)
+        assert set(metadata.existing_data) == \
+            {name for name in packages if shard(name) in loaded}
+        with mock.patch.object(s3, 'store_json_stream', wraps=s3.store_json_stream) as store, \
+                mock.patch.object(s3, 'open_json_writer', wraps=s3.open_json_writer) as writer:
+            metadata.update()
+
+    # Only the updated shards and the index are written, the package file is left alone
+    assert NPM_PACKAGE_FILE_PATH not in {call[0][1] for call in writer.call_args_list}
+    written = {call[1]['obj_key'] for call in store.call_args_list}
+    assert written == {shard_key(shard('stale')), shard_key(shard('new')),
+                       NPM_PACKAGE_SHARDS_PREFIX + 'index.json'}
+    assert metadata.stats['written_shards'] == len(written) - 1
+    new_shard = dict(s3.iter_json_object(bucket, shard_key(shard('new'))))
+    assert new_shard['new']['keywords'] == ['k']
+    assert set(new_shard) == {name for name in list(packages) + ['new']
+                              if shard(name) == shard('new')}
+    index = s3.read_json_object(bucket, NPM_PACKAGE_SHARDS_PREFIX + 'index.json')
+    assert sum(index['shards'].values()) == len(packages) + 1
+    assert index['shard_count'] == 16
+
+    # The package file still read by the npm training is rebuilt by its own job
+    with mock.patch('f8a_report.npm_package_file_main.S3Helper', return_value=s3):
+        npm_package_file_main.main()
+    package_file = s3.read_json_object(bucket, NPM_PACKAGE_FILE_PATH)
+    assert set(package_file) == set(packages) | {'new'}
+    assert package_file['new']['keywords'] == ['k']
+    assert package_file['pkg1'] == packages['pkg1']
+
+    # Or after each update when asked to
+    with mock.patch('f8a_report.helpers.npm_metadata.NPM_WRITE_PACKAGE_FILE', True), \
+            mock.patch('f8a_report.helpers.npm_metadata.write_package_file') as write_file:
+        NPMMetadata(s3, 'token', bucket, manifest)._save_data()
+    write_file.assert_called_once()
+
+
+def test_package_shard():
+    """Test the shards are sized from the package count and keep the 256 shard layout."""
+    assert [shard_count_for(count) for count in (0, 50, 51, 1000000)] == [1, 1, 2, 32768]
+    assert package_shard('lodash') == hashlib.md5(b'lodash').hexdigest()[:2]
+    assert package_shard('lodash', 1) == '0'
+    assert len(package_shard('lodash', 32768)) == 4
+    assert len({package_shard('pkg{}'.format(i), 16) for i in range(1000)}) == 16
+
+
+@mock.patch('f8a_report.helpers.npm_metadata.NPM_FETCH_WORKERS', 2)
+def test_update_bounded_fetches():
+    """Test that only a bounded window of fetches is queued at any time."""
+    names = ['pkg{}'.format(i) for i in range(20)]
+    metadata = npm_metadata({}, names)
+    queued = []
+
+    def fetch(name, _details):
+        queued.append(name)
+        # Fetches are submitted as earlier ones are merged, at most 4 ahead of them
+        assert len(queued) - metadata.stats['updated_count'] <= 4
+        return {"name": name, "updated_timestamp": 1}
+
+    with mock.patch.object(metadata, '_fetch', side_effect=fetch), \
+            mock.patch.object(metadata, '_add_github_keywords'):
+        metadata.update()
+    assert sorted(queued) == sorted(names)
+    assert set(metadata.existing_data) == set(names)
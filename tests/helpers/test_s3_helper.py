@@ -1,15 +1,32 @@
 """Tests for classes from s3_helper module."""
 
-from f8a_report.helpers.s3_helper import S3Helper
+from f8a_report.helpers.s3_helper import S3Helper, encode_json, decode_json, \
+    MultipartUploadWriter
+from concurrent.futures import ThreadPoolExecutor
+from ijson.common import ObjectBuilder
+from unittest import mock
 from moto import mock_s3
 import boto3
+import gzip
+import json
 import os
+import pytest
 
 BUCKET = os.environ.get('MANIFESTS_BUCKET')
 AWS_KEY = os.environ.get('AWS_S3_ACCESS_KEY_ID')
 AWS_SECRET = os.environ.get('AWS_S3_SECRET_ACCESS_KEY')
 
 
+@pytest.fixture(autouse=True)
+def fresh_s3_clients():
+    """Drop the shared clients, they keep the credentials of the test creating them."""
+    # Newer botocore sends uploaded parts aws-chunked with checksums, which moto stores
+    # verbatim, so only compute checksums where required; older botocore ignores it.
+    with mock.patch('f8a_report.helpers.s3_helper._s3_clients', {}), \
+            mock.patch.dict(os.environ, {'AWS_REQUEST_CHECKSUM_CALCULATION': 'when_required'}):
+        yield
+
+
 def test_s3_helper():
     """Test to validate the s3_helper constructor function."""
     assert S3Helper()
@@ -66,3 +83,159 @@ def test_store_file_object():
     S3.store_file_object('tests/data/dev/weekly/data.json', BUCKET, 'dev/weekly/data.json')
     obj = S3.list_objects(BUCKET, 'weekly')
     assert len(obj['objects']) > 0
+
+
+def test_s3_client_shared():
+    """Test that the s3 client is created once per credential set and shared."""
+    with mock.patch('boto3.session.Session', wraps=boto3.session.Session) as session:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clients = list(executor.map(
+                lambda _: S3Helper(aws_access_key_id=AWS_KEY,
+                                   aws_secret_access_key=AWS_SECRET).s3_client(BUCKET),
+                range(16)))
+        assert all(client is clients[0] for client in clients)
+        assert session.call_count == 1
+        # Buckets with their own credentials get their own client
+        with mock.patch.dict(os.environ, {'AWS_S3_ACCESS_KEY_ID_NPM_BUCKET': 'npm-key',
+                                          'AWS_S3_SECRET_ACCESS_KEY_NPM_BUCKET': 'npm-secret'}):
+            npm_client = S3Helper().s3_client(os.environ.get('NPM_MODEL_BUCKET'))
+        assert npm_client is not clients[0]
+        assert session.call_count == 2
+
+
+@mock_s3
+def test_s3_client_reused_across_calls():
+    """Test that repeated reads reuse one client instead of building one per call."""
+    s3 = boto3.resource('s3')
+    s3.create_bucket(Bucket=BUCKET)
+    s3.meta.client.upload_file('tests/data/data.json', BUCKET, 'data.json')
+    client = boto3.session.Session.client
+    with mock.patch.object(boto3.session.Session, 'client', autospec=True,
+                           side_effect=client) as new_client, \
+            mock.patch('boto3.resource') as resource:
+        for _ in range(20):
+            S3 = S3Helper(aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET)
+            assert S3.read_json_object(BUCKET, 'data.json')
+        assert new_client.call_count == 1
+        resource.assert_not_called()
+
+
+@mock_s3
+@pytest.mark.parametrize('encoding,content_encoding', [
+    ('pretty', None), ('compact', None), ('gzip', 'gzip')])
+def test_store_json_content_encoding(encoding, content_encoding):
+    """Test that encoded reports are stored with their encoding and read back transparently."""
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=BUCKET)
+    content = {"npm": {"lodash": [1, 2, 3]}, "maven": {}}
+    S3 = S3Helper(aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET)
+    S3.store_json_content(content, BUCKET, 'report.json', encoding=encoding)
+    obj = s3.get_object(Bucket=BUCKET, Key='report.json')
+    assert obj['ContentType'] == 'application/json'
+    if content_encoding:
+        assert content_encoding in obj['ContentEncoding']
+    assert S3.read_json_object(BUCKET, 'report.json') == content
+
+
+def test_encode_json():
+    """Test the size of the report encodings."""
+    content = {"stack{}".format(i): {"lodash 4.17.{}".format(i): i} for i in range(100)}
+    pretty, _ = encode_json(content, 'pretty')
+    compact, _ = encode_json(content, 'compact')
+    compressed, content_encoding = encode_json(content, 'gzip')
+    assert pretty == json.dumps(content, indent=2).encode('utf-8')
+    assert len(compressed) < len(compact) < len(pretty)
+    assert gzip.decompress(compressed) == compact
+    # Compressed bodies are detected without the ContentEncoding header as well
+    assert decode_json(compressed) == decode_json(compact) == content
+    with pytest.raises(ValueError):
+        encode_json(content, 'bzip2')
+
+
+def test_encode_json_orjson():
+    """Test that the orjson backend produces the same JSON."""
+    orjson = pytest.importorskip('orjson')
+    content = {"npm": {"lodash": [1, 2.5, None, "x"]}, "maven": {}}
+    with mock.patch('f8a_report.helpers.s3_helper.REPORT_JSON_BACKEND', 'orjson'):
+        body, _ = encode_json(content, 'compact')
+        assert body == orjson.dumps(content)
+        assert decode_json(body) == content
+
+
+@mock_s3
+@pytest.mark.parametrize('encoding', ['pretty', 'gzip'])
+def test_store_json_stream(encoding):
+    """Test that streamed reports are uploaded in parts and read back unchanged."""
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=BUCKET)
+    content = {"stack{}".format(i): os.urandom(1024).hex() for i in range(12 * 1024)}
+    S3 = S3Helper(aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET)
+    with mock.patch.object(S3, 's3_client', return_value=mock.Mock(wraps=s3)) as client:
+        S3.store_json_stream(content, BUCKET, 'report.json', encoding=encoding)
+        # 24 MiB of hex content does not compress below one 8 MiB part with gzip either
+        assert client.return_value.upload_part.call_count >= 2
+        client.return_value.put_object.assert_not_called()
+    assert S3.read_json_object(BUCKET, 'report.json') == content
+    if encoding == 'pretty':
+        body = s3.get_object(Bucket=BUCKET, Key='report.json')['Body'].read()
+        assert body == json.dumps(content, indent=2).encode('utf-8')
+
+
+@mock_s3
+def test_json_writer_small_and_abort():
+    """Test that small content is put at once and failed uploads are aborted."""
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=BUCKET)
+    S3 = S3Helper(aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET)
+    with S3.open_json_writer(BUCKET, 'small.json', encoding='compact') as writer:
+        writer.write('{"sections":[')
+        writer.write_json({"a": 1})
+        writer.write(',')
+        writer.write_json({"b": 2})
+        writer.write(']}')
+    assert S3.read_json_object(BUCKET, 'small.json') == {"sections": [{"a": 1}, {"b": 2}]}
+
+    with pytest.raises(RuntimeError):
+        with MultipartUploadWriter(s3, BUCKET, 'failed.json', encoding='compact',
+                                   part_size=5 * 1024 * 1024) as writer:
+            writer.write(b'x' * 6 * 1024 * 1024)
+            raise RuntimeError('report builder failed')
+    assert s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []) == []
+    assert 'Contents' not in s3.list_objects_v2(Bucket=BUCKET, Prefix='failed.json')
+
+
+@mock_s3
+@pytest.mark.parametrize('encoding', ['pretty', 'gzip'])
+def test_iter_json_object(encoding):
+    """Test that objects are iterated key by key, skipping keys not asked for."""
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=BUCKET)
+    content = {"npm": {"lodash": {"version": "4.17.21", "score": 0.5}},
+               "maven": {"io.vertx:vertx-web": {}}, "pypi": {}}
+    S3 = S3Helper(aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET)
+    S3.store_json_content(content, BUCKET, 'packages.json', encoding=encoding)
+    assert dict(S3.iter_json_object(BUCKET, 'packages.json')) == content
+    assert list(S3.iter_json_object(BUCKET, 'packages.json', keys={'maven'})) == \
+        [("maven", {"io.vertx:vertx-web": {}})]
+    # Only the values asked for are built
+    with mock.patch('f8a_report.helpers.s3_helper.ObjectBuilder',
+                    wraps=ObjectBuilder) as builder:
+        assert dict(S3.iter_json_object(BUCKET, 'packages.json', keys=['pypi', 'npm'])) == \
+            {"npm": content["npm"], "pypi": {}}
+    assert builder.call_count == 2
+    with mock.patch('f8a_report.helpers.s3_helper.ijson', None):
+        assert dict(S3.iter_json_object(BUCKET, 'packages.json')) == content
+        assert dict(S3.iter_json_object(BUCKET, 'packages.json', keys={'pypi'})) == \
+            {"pypi": {}}
+    assert list(S3.iter_json_object(BUCKET, 'missing.json')) == []
+
+
+@mock_s3
+def test_iter_json_array():
+    """Test that arrays are iterated item by item."""
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=BUCKET)
+    content = [{"a": 1}, [1, 2], "x", 2.5]
+    S3 = S3Helper(aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET)
+    S3.store_json_content(content, BUCKET, 'items.json', encoding='gzip')
+    assert list(S3.iter_json_array(BUCKET, 'items.json')) == content
@@ -0,0 +1,35 @@
+"""Test module for the Sentry event cache."""
+
+from f8a_report.helpers.sentry_event_cache import SentryEventCache
+
+events = {'stacktrace': 'Not Available', 'pods_impacted': 'bayesian-api-1-abcde'}
+
+
+def test_get_set(tmp_path):
+    """Test that events are reused until the issue is seen again."""
+    path = str(tmp_path / 'cache.db')
+    cache = SentryEventCache(path=path)
+    # The database is only created by the first call
+    assert not (tmp_path / 'cache.db').exists()
+    assert cache.get('12666', '2019-05-15T06:50:10Z') is None
+    assert (tmp_path / 'cache.db').exists()
+    cache.set('12666', '2019-05-15T06:50:10Z', events)
+    assert cache.get('12666', '2019-05-15T06:50:10Z') == events
+    assert cache.stats() == {'hits': 1, 'misses': 1}
+
+    # A new process reuses the events stored on disk, until the issue has a new event
+    cache = SentryEventCache(path=path)
+    assert cache.get('12666', '2019-05-15T06:50:10Z') == events
+    assert cache.get('12666', '2019-05-16T01:00:00Z') is None
+
+    # Issues without a last seen time are not cached
+    cache.set('12667', None, events)
+    assert cache.get('12667', None) is None
+
+
+def test_prune(tmp_path):
+    """Test that the events stored before the retention period are dropped."""
+    cache = SentryEventCache(path=str(tmp_path / 'cache.db'), days=0)
+    cache.set('12666', '2019-05-15T06:50:10Z', events)
+    cache.prune()
+    assert cache.get('12666', '2019-05-15T06:50:10Z') is None
@@ -1,10 +1,25 @@
 """Tests for classes from sentry_report_helper module."""
 
 from f8a_report.helpers.sentry_report_helper import SentryReportHelper
+from f8a_report.helpers.sentry_event_cache import SentryEventCache
+from unittest import mock
+from tests.conftest import InFlightTracker
+import json
+import pytest
+import re
 import responses
 
 sobj = SentryReportHelper()
 
+
+@pytest.fixture(autouse=True)
+def event_cache():
+    """Replace the Sentry event cache with an empty in-memory one."""
+    with mock.patch('f8a_report.helpers.sentry_report_helper.sentry_event_cache',
+                    SentryEventCache(path=':memory:')) as cache:
+        yield cache
+
+
 sentry_issues_res = [{
     "lastSeen": "2019-05-15T06:50:10Z",
     "id": "12666",
@@ -138,3 +153,85 @@ def test_retrieve_sentry_logs_nostacktrace():
                                                     "TypeError: must be str, not list",
                                                 "stacktrace": "Not Available"}]}}}
     assert (res == expected_output)
+
+
+@responses.activate
+@mock.patch('f8a_report.helpers.sentry_report_helper.SENTRY_EVENT_WORKERS', 4)
+def test_normalize_sentry_data_concurrent():
+    """Test the issue events are fetched concurrently, with a bounded number in flight."""
+    in_flight = InFlightTracker()
+
+    @in_flight.wrap
+    def latest_event(_request):
+        return 200, {}, json.dumps(sentry_tags_res)
+
+    helper = SentryReportHelper()
+    responses.add_callback(responses.GET, re.compile(
+        re.escape(helper.sentry_api_tags) + r'\d+/events/latest/'), callback=latest_event)
+    issues = [dict(sentry_issues_res[0], id=str(i)) for i in range(20)]
+    with mock.patch.object(helper.s3, 'store_json_content') as store:
+        res = helper.normalize_sentry_data('2019-05-14', '2019-05-15', issues)
+    store.assert_called_once()
+
+    report = res['error_report']['bayesian-data-importer']
+    assert report['total_errors'] == len(issues)
+    assert [error['id'] for error in report['errors']] == [item['id'] for item in issues]
+    assert len(responses.calls) == len(issues)
+    assert 2 <= in_flight.peak <= 4
+
+
+@responses.activate
+def test_retrieve_sentry_logs_pagination():
+    """Test all the pages of issues are followed through the Sentry cursor."""
+    issues_url = 'https://sentry.devshift.net/api/0/projects/sentry/' \
+                 'fabric8-analytics-production/issues/'
+    link = '<{url}?statsPeriod=24h&cursor={prev}>; rel="previous"; results="false"; ' \
+           'cursor="{prev}", <{url}?statsPeriod=24h&cursor={next}>; rel="next"; ' \
+           'results="{results}"; cursor="{next}"'
+    pages = [[dict(sentry_issues_res[0], id=str(page * 2 + i)) for i in range(2)]
+             for page in range(3)]
+    for page, issues in enumerate(pages):
+        query = 'statsPeriod=24h' + ('&cursor=c{}'.format(page) if page else '')
+        responses.add(responses.GET, '{}?{}'.format(issues_url, query), json=issues,
+                      headers={'Link': link.format(url=issues_url, prev='p', next='c{}'.format(
+                          page + 1), results='true' if page < 2 else 'false')})
+    for issue_id in range(6):
+        responses.add(responses.GET, 'https://sentry.devshift.net/api/0/issues/'
+                                     '{}/events/latest/'.format(issue_id), json=sentry_tags_res)
+
+    helper = SentryReportHelper()
+    with mock.patch.object(helper.s3, 'store_json_content'):
+        res = helper.retrieve_sentry_logs('2019-05-14', '2019-05-15')
+    errors = res['error_report']['bayesian-data-importer']['errors']
+    assert [error['id'] for error in errors] == [str(i) for i in range(6)]
+
+    # The issues can be capped, the remaining pages are then not fetched
+    calls = len(responses.calls)
+    assert [len(page) for page in helper.iter_sentry_issue_pages(max_issues=3)] == [2, 1]
+    assert len(responses.calls) == calls + 2
+
+
+@responses.activate
+def test_retrieve_sentry_logs_cached_events():
+    """Test only the issues with a new event are fetched again by the next run."""
+    issues_url = 'https://sentry.devshift.net/api/0/projects/sentry/' \
+                 'fabric8-analytics-production/issues/?statsPeriod=24h'
+    events_url = 'https://sentry.devshift.net/api/0/issues/{}/events/latest/'
+    issues = [dict(sentry_issues_res[0], id='1'), dict(sentry_issues_res[0], id='2')]
+    responses.add(responses.GET, issues_url, json=issues)
+    for issue in issues:
+        responses.add(responses.GET, events_url.format(issue['id']), json=sentry_tags_res)
+    with mock.patch.object(sobj.s3, 'store_json_content'):
+        first = sobj.retrieve_sentry_logs('2019-05-14', '2019-05-15')
+        assert len(responses.calls) == 3
+
+        # Issue 2 has a new event since the last run
+        issues[1]['lastSeen'] = '2019-05-16T01:00:00Z'
+        responses.replace(responses.GET, issues_url, json=issues)
+        second = sobj.retrieve_sentry_logs('2019-05-15', '2019-05-16')
+    assert [call.request.url for call in responses.calls[3:]] == [
+        issues_url, events_url.format('2')]
+    first_errors = first['error_report']['bayesian-data-importer']['errors']
+    second_errors = second['error_report']['bayesian-data-importer']['errors']
+    assert [error['stacktrace'] for error in second_errors] == \
+        [error['stacktrace'] for error in first_errors]
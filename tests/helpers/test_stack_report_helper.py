@@ -1,7 +1,11 @@
 """Tests for classes from stack_report_helper module."""
 
-from f8a_report.helpers.report_helper import ReportHelper, S3Helper
+from f8a_report.helpers.report_helper import ReportHelper, S3Helper, Postgres, \
+    pooled_connection
+from psycopg2.pool import PoolError
 import pytest
+import threading
+from collections import Counter
 from unittest import mock
 import json
 
@@ -105,6 +109,46 @@ with open('tests/data/ingestiondata.json', 'r') as f:
     ingestiondata = json.loads(ingestiondata)
 
 
+@mock.patch('f8a_report.helpers.report_helper.get_connection_pool')
+def test_postgres_pooled_connection(_mock_pool):
+    """Test that Postgres borrows its connection from the pool and hands it back once."""
+    pool = _mock_pool.return_value
+    with Postgres() as pg:
+        assert pg.conn is pool.getconn.return_value
+        pool.putconn.assert_not_called()
+    pool.putconn.assert_called_once_with(pg.conn)
+    pg.close()
+    pool.putconn.assert_called_once()
+
+
+@mock.patch('f8a_report.helpers.report_helper.get_connection_pool')
+def test_pooled_connection(_mock_pool):
+    """Test that pooled_connection returns the connection even on errors."""
+    pool = _mock_pool.return_value
+    with pytest.raises(ValueError):
+        with pooled_connection() as conn:
+            assert conn is pool.getconn.return_value
+            raise ValueError
+    pool.putconn.assert_called_once_with(pool.getconn.return_value)
+
+
+@mock.patch('f8a_report.helpers.report_helper._connection_slots', threading.BoundedSemaphore(1))
+@mock.patch('f8a_report.helpers.report_helper.get_connection_pool')
+def test_pooled_connection_waits(_mock_pool):
+    """Test that borrowers wait for a connection instead of failing on an exhausted pool."""
+    pg = Postgres()
+    with mock.patch('f8a_report.helpers.report_helper.PG_POOL_TIMEOUT', 0.1):
+        with pytest.raises(PoolError):
+            with pooled_connection():
+                pass
+
+    # A connection handed back meanwhile goes to the waiting borrower
+    threading.Timer(0.05, pg.close).start()
+    with pooled_connection():
+        pass
+    assert _mock_pool.return_value.putconn.call_count == 2
+
+
 def test_validate_and_process_date_success():
     """Test the success scenario of the function validate_and_process_date."""
     res = r.validate_and_process_date('2019-01-01')
@@ -148,13 +192,27 @@ class MockPostgres:
         return stackdata
 
 
-def test_retrieve_stack_analyses_ids():
+@mock.patch('f8a_report.helpers.report_helper.get_connection_pool')
+def test_retrieve_stack_analyses_ids(_mock_pool):
     """Test retrieve stack data function."""
-    r.cursor = MockPostgres()
+    _mock_pool.return_value.getconn.return_value.cursor.return_value = MockPostgres()
     ids = ''.join(r.retrieve_stack_analyses_ids('2018-10-09', '2018-10-09'))
     assert ids is not None
 
 
+@mock.patch('f8a_report.helpers.report_helper.get_connection_pool')
+def test_report_helper_returns_connection(_mock_pool):
+    """Test that the report helper only holds a pooled connection while a query runs."""
+    pool = _mock_pool.return_value
+    pool.getconn.return_value.cursor.return_value = MockPostgres()
+    helper = ReportHelper()
+    pool.getconn.assert_not_called()
+    assert helper.retrieve_stack_analyses_ids('2018-10-09', '2018-10-09')
+    pool.getconn.assert_called_once()
+    pool.putconn.assert_called_once_with(pool.getconn.return_value)
+    assert helper.pg is None
+
+
 def test_retrieve_stack_analyses_ids_wrong_dates():
     """Test the failure scenario of the function retrieve_stack_analyses_ids."""
     # both dates are incorrect
@@ -312,13 +370,36 @@ def test_get_training_data_for_eco():
     assert resp == manifest
 
 
+def mock_iter_collated_data(obj_key, **_kwargs):
+    """Mock the collated user input and big query objects."""
+    if obj_key.startswith('big-query-data'):
+        return iter({eco: data['bigquery_data'] for eco, data in collateddata.items()}.items())
+    return iter(collateddata.items())
+
+
 @mock.patch('f8a_report.helpers.report_helper.S3Helper.store_json_content', return_value=True)
-@mock.patch('f8a_report.helpers.report_helper.S3Helper.read_json_object', return_value=collateddata)
+@mock.patch('f8a_report.helpers.report_helper.S3Helper.iter_json_object',
+            side_effect=mock_iter_collated_data)
 def test_collate_raw_data(_mock1, _mock2):
     """Test result collation success scenario."""
     result = r.collate_raw_data(unique_stacks_with_recurrence_count, 'weekly')
 
     assert result is not None
+    for eco in unique_stacks_with_recurrence_count:
+        expected = dict(Counter(unique_stacks_with_recurrence_count[eco]) +
+                        Counter(collateddata[eco]['user_input_stack']))
+        assert result[eco]['user_input_stack'] == expected
+        assert result[eco]['bigquery_data'] == collateddata[eco]['bigquery_data']
+
+
+@mock.patch('f8a_report.helpers.report_helper.S3Helper.store_json_content', return_value=True)
+@mock.patch('f8a_report.helpers.report_helper.S3Helper.iter_json_object',
+            side_effect=lambda **_kwargs: iter(()))
+def test_collate_raw_data_no_collated_data(_mock1, _mock2):
+    """Test result collation when nothing has been collated yet."""
+    result = r.collate_raw_data({'npm': {'a,b': 2}}, 'weekly')
+
+    assert result == {'npm': {'user_input_stack': {'a,b': 2}}}
 
 
 def mock_emr_api(*_args, **_kwargs):
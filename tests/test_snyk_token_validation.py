@@ -1,8 +1,11 @@
 """Snyk Token Validation Tests."""
 import unittest
 from unittest.mock import patch
+
+import requests
 import f8a_report.snyk_token_validation_main as token_validation
 from f8a_report.snyk_token_validation_main import TokenValidationQueries
+from tests.conftest import InFlightTracker
 
 
 class TestSnykTokenValidation(unittest.TestCase):
@@ -44,3 +47,94 @@ class TestSnykTokenValidation(unittest.TestCase):
         get_registered_user_tokens.assert_called_once()
 
         update_users_to_unregistered.assert_called_once()
+
+    @patch.object(TokenValidationQueries, 'get_registered_user_tokens')
+    @patch.object(TokenValidationQueries, 'update_users_to_unregistered')
+    @patch.object(TokenValidationQueries, 'update_tokens_validated')
+    @patch('f8a_report.snyk_token_validation_main.cache_all_users')
+    @patch('f8a_report.snyk_token_validation_main.decrypt_api_token', side_effect=lambda t: t)
+    @patch('f8a_report.snyk_token_validation_main.is_snyk_token_valid')
+    @patch('f8a_report.snyk_token_validation_main.SNYK_VALIDATION_WINDOW_DAYS', 7)
+    def test_main_incremental(self, is_snyk_token_valid, _decrypt_api_token, _cache_all_users,
+                              update_tokens_validated, update_users_to_unregistered,
+                              get_registered_user_tokens):
+        """Test the checked tokens are recorded, except the ones that could not be checked."""
+        get_registered_user_tokens.return_value = {'user-1': b'valid', 'user-2': b'revoked',
+                                                   'user-3': b'down'}
+
+        def validate(token):
+            if token == 'down':
+                raise requests.exceptions.ConnectionError()
+            return token == 'valid'
+
+        is_snyk_token_valid.side_effect = validate
+        token_validation.main()
+
+        get_registered_user_tokens.assert_called_once_with(7)
+        update_users_to_unregistered.assert_called_once_with(['user-2'])
+        update_tokens_validated.assert_called_once_with(['user-1', 'user-2'])
+
+    @patch('f8a_report.snyk_token_validation_main.decrypt_api_token', side_effect=lambda t: t)
+    @patch('f8a_report.snyk_token_validation_main.is_snyk_token_valid')
+    def test_transient_failures(self, is_snyk_token_valid, _decrypt_api_token):
+        """Test that transient failures are retried and never unregister a user."""
+        attempts = {'flaky': [requests.exceptions.ConnectionError(), False],
+                    'down': [requests.exceptions.ConnectionError()] * 3}
+
+        def validate(token):
+            result = attempts[token].pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        is_snyk_token_valid.side_effect = validate
+        unregistered_users = token_validation.call_snyk_api({'user-1': b'flaky',
+                                                             'user-2': b'down'}, rate=0)
+
+        assert unregistered_users == ['user-1']
+        assert is_snyk_token_valid.call_count == 5
+
+    @patch('f8a_report.snyk_token_validation_main.time')
+    def test_rate_limiter(self, mock_time):
+        """Test that the calls are spaced out to the rate, sleeping outside of the lock."""
+        mock_time.monotonic.return_value = 100.0
+        rate_limiter = token_validation.RateLimiter(50)
+        mock_time.sleep.side_effect = lambda _delay: self.assertFalse(
+            rate_limiter._lock.locked())
+        for _ in range(4):
+            rate_limiter.wait()
+        # All the calls come at once, each one waits for one more interval
+        delays = [c[0][0] for c in mock_time.sleep.call_args_list]
+        self.assertEqual(len(delays), 3)
+        for delay, expected in zip(delays, (0.02, 0.04, 0.06)):
+            self.assertAlmostEqual(delay, expected)
+
+        # Once the interval has passed the next call goes through straight away
+        mock_time.sleep.reset_mock()
+        mock_time.monotonic.return_value = 101.0
+        rate_limiter.wait()
+        mock_time.sleep.assert_not_called()
+
+        token_validation.RateLimiter(0).wait()
+        mock_time.sleep.assert_not_called()
+
+    @patch('f8a_report.snyk_token_validation_main.decrypt_api_token', side_effect=lambda t: t)
+    def test_concurrent_validation(self, _decrypt_api_token):
+        """Test the tokens are validated concurrently, with at most `workers` in flight."""
+        def is_snyk_token_valid(token):
+            return token == 'valid'
+
+        user_to_tokens = {'user-{}'.format(i): b'valid' if i % 4 else b'revoked'
+                          for i in range(40)}
+        in_flight = InFlightTracker()
+        with patch('f8a_report.snyk_token_validation_main.is_snyk_token_valid',
+                   side_effect=in_flight.wrap(is_snyk_token_valid)):
+            concurrent = token_validation.call_snyk_api(user_to_tokens, workers=4, rate=0)
+        assert 2 <= in_flight.peak <= 4
+
+        in_flight = InFlightTracker(hold=False)
+        with patch('f8a_report.snyk_token_validation_main.is_snyk_token_valid',
+                   side_effect=in_flight.wrap(is_snyk_token_valid)):
+            serial = token_validation.call_snyk_api(user_to_tokens, workers=1, rate=0)
+        assert in_flight.peak == 1
+        assert concurrent == serial == ['user-{}'.format(i) for i in range(0, 40, 4)]
@@ -58,6 +58,17 @@ class TestStackReportBuilder(TestCase):
         self.assertGreater(len('stacks_details'), 0)
         self.assertGreater(len('stacks_summary'), 0)
 
+    def test_analyse_stack_aggregates_counts(self):
+        """Test Analyse Stack updates frequency counters incrementally."""
+        report_template = self.ReportBuilder.get_report_template("01-01-2020", "05-01-2020")
+        self.ReportBuilder.analyse_stack(self.stack_analyses_v2, report_template)
+        for eco in self.ReportBuilder.supported_ecosystems:
+            self.assertEqual(sum(self.ReportBuilder.stack_counts[eco].values()),
+                             self.ReportBuilder.total_stack_requests[eco])
+        self.assertEqual(self.ReportBuilder.dep_counts['pypi']['aniso8601 1.2.0'],
+                         self.ReportBuilder.total_stack_requests['pypi'])
+        self.assertGreater(self.ReportBuilder.unknown_license_counts['dual license'], 0)
+
     def test_analyse_stack_with_no_analyse_dep(self):
         """Test Analyse Stack with No Analyses Dependencies."""
         start_date = "01-01-2020"
@@ -69,10 +80,11 @@ class TestStackReportBuilder(TestCase):
         self.assertIn('stacks_summary', result)
         self.assertGreater(len('stacks_summary'), 0)
 
+    @patch('f8a_report.v2.report_generator.WORKER_RESULTS_QUERY_MODE', 'ids')
     @patch('f8a_report.v2.report_generator.StackReportBuilder.create_venus_report')
     @patch('f8a_report.v2.report_generator.StackReportBuilder.save_worker_result_to_s3')
     @patch('f8a_report.v2.report_generator.StackReportBuilder.normalize_worker_data')
-    @patch('f8a_report.v2.report_generator.ReportQueries.get_worker_results_v2')
+    @patch('f8a_report.v2.report_generator.ReportQueries.stream_worker_results_v2')
     @patch('f8a_report.v2.report_generator.ReportQueries.retrieve_stack_analyses_ids')
     def test_get_report(self, _mock1, _mock2, _mock3, _mock4, _mock5):
         """Test Get data."""
@@ -90,16 +102,58 @@ class TestStackReportBuilder(TestCase):
         self.assertEqual(
             result['stack_aggregator_v2']['stacks_summary']['total_stack_requests_count'], 10)
 
-    @patch('f8a_report.v2.report_generator.S3Helper.store_json_content')
+    @patch('f8a_report.v2.report_generator.StackReportBuilder.create_venus_report')
+    @patch('f8a_report.v2.report_generator.StackReportBuilder.normalize_worker_data')
+    @patch('f8a_report.v2.report_generator.ReportQueries.stream_worker_results_v2_by_date')
+    def test_get_report_by_date_join(self, _mock1, _mock2, _mock3):
+        """Test Get data using the date range join."""
+        _mock1.return_value = iter([({'ecosystem': 'npm'},), ({'ecosystem': 'pypi'},)])
+        _mock3.return_value = {'stacks_summary': {}}
+        result = self.ReportBuilder.get_report("2020-01-01", "2020-01-02")
+        self.assertIn('stack_aggregator_v2', result)
+        streamed_rows = list(_mock2.call_args[0][0])
+        self.assertEqual(len(streamed_rows), 2)
+
+    @patch('f8a_report.v2.report_generator.UnknownDepsReportHelperV2')
+    @patch('f8a_report.v2.report_generator.StackReportBuilder.build_report_summary')
+    @patch('f8a_report.v2.report_generator.StackReportBuilder.create_venus_report')
+    @patch('f8a_report.v2.report_generator.ReportQueries.close', autospec=True)
+    @patch('f8a_report.v2.report_generator.ReportQueries.stream_worker_results_v2_by_date')
+    def test_get_report_releases_connection(self, _mock1, _mock2, _mock3, _mock4, _mock5):
+        """Test the pooled connection is handed back before the report is built."""
+        _mock1.return_value = iter(self.stack_analyses_v2)
+        _mock3.return_value = {'stacks_summary': {}}
+        # The summary is built once every row has been streamed
+        _mock4.side_effect = lambda _report: self.assertTrue(_mock2.called) or {}
+        self.ReportBuilder.get_report("2020-01-01", "2020-01-02")
+        _mock4.assert_called_once()
+        _mock3.assert_called_once()
+
+    @patch('f8a_report.v2.report_generator.ReportQueries.stream_worker_results_v2_by_date',
+           return_value=iter([]))
+    def test_get_report_by_date_join_no_stacks(self, _mock1):
+        """Test Get data using the date range join with no stacks."""
+        result = self.ReportBuilder.get_report("2020-01-01", "2020-01-02")
+        self.assertFalse(result)
+
+    @patch('f8a_report.v2.report_generator.S3Helper.store_json_stream')
     def test_save_result(self, _mock1):
         """Test save to s3."""
         result = self.ReportBuilder.save_worker_result_to_s3('daily', 'report_name', 'content')
         self.assertTrue(result)
 
+    @patch('f8a_report.v2.report_generator.S3Helper.store_json_stream',
+           side_effect=Exception('upload failed'))
+    def test_save_result_failure(self, _mock1):
+        """Test that a failed upload is reported."""
+        result = self.ReportBuilder.save_worker_result_to_s3('daily', 'report_name', 'content')
+        self.assertFalse(result)
+
+    @patch('f8a_report.v2.report_generator.WORKER_RESULTS_QUERY_MODE', 'ids')
     @patch('f8a_report.v2.report_generator.StackReportBuilder.create_venus_report')
     @patch('f8a_report.v2.report_generator.StackReportBuilder.save_worker_result_to_s3')
     @patch('f8a_report.v2.report_generator.StackReportBuilder.normalize_worker_data')
-    @patch('f8a_report.v2.report_generator.ReportQueries.get_worker_results_v2')
+    @patch('f8a_report.v2.report_generator.ReportQueries.stream_worker_results_v2')
     @patch('f8a_report.v2.report_generator.ReportQueries.retrieve_stack_analyses_ids')
     def test_get_report_for_golang(self, _mock1, _mock2, _mock3, _mock4, _mock5):
         """Test Entrypoint for Venus Reporting v2 Golang."""